@@ -0,0 +1,345 @@
+"""Handler micro-benchmarks: hot paths in isolation with fake Update/context and in-memory backends.
+
+    python perf/bench.py                          # run everything, compare with perf/bench_baseline.json
+    python perf/bench.py --only send_question     # substring filter (repeatable)
+    python perf/bench.py --save-baseline          # store the current numbers as the new baseline
+    python perf/bench.py --threshold 20           # exit 1 if p50 or peak memory regress by more than 20%
+
+No network: Bot API calls go through a BaseRequest that answers from perf/fakes.FakeBotAPI and
+Supabase goes through an httpx.MockTransport backed by perf/fakes.FakePostgREST. Each case runs
+--repeat timed passes, interleaved across cases so a noisy moment does not land on one case; p50/p95
+are the medians of the per-pass values and "spread" is how far the pass medians disagree. A separate
+tracemalloc pass measures per-call peak and retained bytes, so tracing overhead does not leak into
+the timings. A case only counts as a regression when it is past --threshold percent AND past the
+absolute noise floor (--noise-floor-us / --noise-floor-kib), so microsecond-scale cases do not flap.
+Baselines are machine-specific: regenerate them on the machine that does the comparison.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+TOKEN = "123456:BENCH"
+USER_ID = 20_000_000
+
+# قبل استيراد البوت: بدون خادم WSGI أو لوب خلفي، وحالة في الذاكرة
+os.environ.update({
+    "SERVER_MODE": "asgi",
+    "TELEGRAM_TOKEN": TOKEN,
+    "SUPABASE_URL": "http://supabase.bench",
+    "SUPABASE_KEY": "bench",
+    "STATE_BACKEND": "memory",
+    "CHANNEL_SUBSCRIPTION_REQUIRED": "true",
+    "LOG_FORMAT": "text",
+})
+sys.path.insert(0, REPO_ROOT)
+
+import httpx  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import ExtBot  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import telegram_bot as tb  # noqa: E402
+from fakes import FakeBotAPI, FakePostgREST  # noqa: E402
+
+logging.disable(logging.INFO)
+
+
+class FakeBotRequest(BaseRequest):
+    """Bot API transport that answers in-process from FakeBotAPI (no sockets)."""
+
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        body = request_data.json_payload if request_data else b""
+        status, payload, _ = self.api.handle(method, url, {"content-type": "application/json"}, body)
+        return status, payload
+
+
+class FakeContext:
+    """The parts of CallbackContext the handlers use."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.user_data = {}
+        self.chat_data = {}
+        self.bot_data = {}
+        self.error = None
+
+
+def postgrest_transport(db: FakePostgREST) -> httpx.MockTransport:
+    def handler(request: httpx.Request) -> httpx.Response:
+        headers = {name.lower(): value for name, value in request.headers.items()}
+        status, body, extra = db.handle(request.method, request.url.raw_path.decode(), headers, request.content)
+        return httpx.Response(status, content=body, headers=extra)
+    return httpx.MockTransport(handler)
+
+
+def callback_update(bot, data: str, user_id: int = USER_ID) -> Update:
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"}
+    message = {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": {"id": 1, "is_bot": True, "first_name": "Bench Bot"}, "text": "..."}
+    return Update.de_json({
+        "update_id": 1,
+        "callback_query": {"id": "1", "from": user, "chat_instance": "1", "data": data, "message": message},
+    }, bot)
+
+
+class Case:
+    """One benchmark: call() is timed; before()/after() run around it outside the measurement."""
+
+    def __init__(self, name: str, call, before=None, after=None):
+        self.name = name
+        self.call = call
+        self.before = before
+        self.after = after
+
+    async def once(self, measure):
+        if self.before:
+            await self.before()
+        sample = await measure(self.call)
+        if self.after:
+            await self.after()
+        return sample
+
+
+async def _timed(call):
+    started = time.perf_counter()
+    await call()
+    return time.perf_counter() - started
+
+
+async def _traced(call):
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    await call()
+    after, peak = tracemalloc.get_traced_memory()
+    return peak - current, after - current
+
+
+async def timed_pass(case: Case, iterations: int) -> list:
+    return sorted([await case.once(_timed) for _ in range(iterations)])
+
+
+async def traced_pass(case: Case, iterations: int) -> list:
+    tracemalloc.start()
+    try:
+        return [await case.once(_traced) for _ in range(iterations)]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(passes: list, traced: list) -> dict:
+    """passes: sorted timings of each timed pass; traced: (peak, net) per call."""
+    medians = [statistics.median(timings) for timings in passes]
+    p95s = [timings[min(len(timings) - 1, int(len(timings) * 0.95))] for timings in passes]
+    p50 = statistics.median(medians)
+    return {
+        "p50_us": round(p50 * 1e6, 1),
+        "p95_us": round(statistics.median(p95s) * 1e6, 1),
+        "mean_us": round(statistics.fmean(t for timings in passes for t in timings) * 1e6, 1),
+        "spread_pct": round((max(medians) - min(medians)) / p50 * 100, 1) if p50 else 0.0,
+        "peak_kib": round(statistics.median(peak for peak, _ in traced) / 1024, 2),
+        "net_bytes": int(statistics.median(net for _, net in traced)),
+    }
+
+
+async def build_cases(bot, db: FakePostgREST) -> list:
+    question = db.tables["questions"][0]
+    question_id = question["id"]
+    cases = []
+
+    # send_question: الحالة المستقرة (جلسة مهيأة والبافر ممتلئ)، ومهمة ملء البافر تُنتظر خارج القياس
+    quiz_context = FakeContext(bot)
+    quiz_update = callback_update(bot, "start_quiz")
+
+    async def send_question():
+        await tb.send_question(quiz_update, quiz_context)
+
+    async def drain_buffer_task():
+        task = quiz_context.user_data.get(tb.QUESTION_BUFFER_TASK_KEY)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    cases.append(Case("send_question", send_question, after=drain_buffer_task))
+
+    answer_context = FakeContext(bot)
+    answer_update = callback_update(bot, tb.encode_callback(tb.CB_ANSWER, question_id, "A"))
+
+    async def handle_answer():
+        await tb.handle_answer(answer_update, answer_context)
+
+    cases.append(Case("handle_answer", handle_answer))
+
+    async def render_result():
+        tb.render_result(question, "B")
+
+    async def clear_render_cache():
+        tb.RENDER_CACHE.clear()
+
+    cases.append(Case("render_result[cached]", render_result))
+    cases.append(Case("render_result[cold]", render_result, before=clear_render_cache))
+
+    fill_context = FakeContext(bot)
+
+    async def fill_question_buffer():
+        await tb._fill_question_buffer(fill_context, USER_ID)
+
+    async def reset_buffer():
+        fill_context.user_data.pop(tb.QUESTION_BUFFER_KEY, None)
+        fill_context.user_data.pop(tb.PREFETCH_EXCLUDED_KEY, None)
+
+    cases.append(Case("_fill_question_buffer", fill_question_buffer, before=reset_buffer))
+
+    stats_context = FakeContext(bot)
+    stats_update = callback_update(bot, "stats")
+
+    async def show_stats():
+        await tb.show_stats(stats_update, stats_context)
+
+    cases.append(Case("show_stats", show_stats))
+
+    async def subscription_cached():
+        await tb.check_channel_subscription(USER_ID, bot)
+
+    async def subscription_forced():
+        await tb.check_channel_subscription(USER_ID, bot, force=True)
+
+    cases.append(Case("check_channel_subscription[cached]", subscription_cached))
+    cases.append(Case("check_channel_subscription[force]", subscription_forced))
+    return cases
+
+
+def load_baseline(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _delta(current: float, previous) -> str:
+    if not previous:
+        return "-"
+    return f"{(current - previous) / previous * 100:+.0f}%"
+
+
+def _regressed(current: float, previous: float, threshold: float, floor: float) -> bool:
+    return current > previous * (1 + threshold / 100) and current - previous > floor
+
+
+def report(results: dict, baseline: dict, threshold: float, floor_us: float, floor_kib: float) -> list:
+    """Print the table; returns names of cases past threshold (percent) and the absolute noise floor."""
+    previous = baseline.get("results", {})
+    regressions = []
+    print(f"{'case':<36} {'p50 µs':>9} {'p95 µs':>9} {'mean µs':>9} {'spread':>7} {'peak KiB':>9} {'net B':>7}"
+          f" {'Δp50':>6} {'Δpeak':>6}")
+    for name, row in results.items():
+        old = previous.get(name, {})
+        print(f"{name:<36} {row['p50_us']:>9.1f} {row['p95_us']:>9.1f} {row['mean_us']:>9.1f}"
+              f" {row['spread_pct']:>6.0f}% {row['peak_kib']:>9.2f} {row['net_bytes']:>7}"
+              f" {_delta(row['p50_us'], old.get('p50_us')):>6} {_delta(row['peak_kib'], old.get('peak_kib')):>6}")
+        if old and (_regressed(row["p50_us"], old["p50_us"], threshold, floor_us)
+                    or _regressed(row["peak_kib"], old["peak_kib"], threshold, floor_kib)):
+            regressions.append(name)
+    if baseline:
+        print(f"\nbaseline: {baseline.get('machine', '?')} / Python {baseline.get('python', '?')}")
+    return regressions
+
+
+async def run(args) -> dict:
+    db = FakePostgREST(questions=args.questions, users=(USER_ID,))
+    client = tb.AsyncSupabaseClient(tb.SUPABASE_URL, tb.SUPABASE_KEY)
+    client._http = httpx.AsyncClient(base_url=client.rest_url, headers=client._headers,
+                                     transport=postgrest_transport(db))
+    tb.supabase = client
+
+    bot = ExtBot(TOKEN, request=FakeBotRequest(FakeBotAPI(record_replies=False)))
+    await bot.initialize()
+    # الخدمات كما في الإنتاج، بدون مهمة التحديث الدورية لمخزن الأسئلة
+    if tb.QUESTION_POOL_ENABLED:
+        await tb.QUESTION_POOL.refresh(full=True)
+    await tb.ANSWER_WRITER.start()
+    await tb.LAST_SEEN.start()
+
+    results = {}
+    try:
+        cases = [case for case in await build_cases(bot, db)
+                 if not args.only or any(part in case.name for part in args.only)]
+        for case in cases:
+            for _ in range(args.warmup):
+                await case.once(_timed)
+        passes = {case.name: [] for case in cases}
+        for _ in range(args.repeat):
+            for case in cases:
+                passes[case.name].append(await timed_pass(case, args.iterations))
+        for case in cases:
+            results[case.name] = summarize(passes[case.name], await traced_pass(case, args.alloc_iterations))
+    finally:
+        await tb.ANSWER_WRITER.stop()
+        await tb.LAST_SEEN.stop()
+        await bot.shutdown()
+        await client.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500, help="timed calls per case in each pass")
+    parser.add_argument("--repeat", type=int, default=5, help="timed passes per case (medians are taken across them)")
+    parser.add_argument("--warmup", type=int, default=50, help="untimed calls per case before measuring")
+    parser.add_argument("--alloc-iterations", type=int, default=100, help="calls per case under tracemalloc")
+    parser.add_argument("--only", action="append", help="run cases whose name contains this (repeatable)")
+    parser.add_argument("--questions", type=int, default=500, help="questions in the fake database")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=25.0,
+                        help="percent slowdown / extra peak memory that counts as a regression")
+    parser.add_argument("--noise-floor-us", type=float, default=5.0,
+                        help="p50 must also grow by more than this many µs to count as a regression")
+    parser.add_argument("--noise-floor-kib", type=float, default=0.5,
+                        help="peak memory must also grow by more than this many KiB to count as a regression")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    regressions = report(results, baseline, args.threshold, args.noise_floor_us, args.noise_floor_kib)
+    if args.save_baseline:
+        merged = dict(baseline.get("results", {}), **results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"machine": f"{platform.machine()} {platform.processor() or platform.system()}",
+                       "python": platform.python_version(), "iterations": args.iterations, "repeat": args.repeat,
+                       "results": merged}, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    if regressions:
+        print(f"\nregressions over {args.threshold:g}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
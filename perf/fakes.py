@@ -0,0 +1,325 @@
+"""Local stand-ins for the Telegram Bot API and Supabase (PostgREST) used by the load harness.
+
+Both are small asyncio HTTP servers built on the standard library, so the harness needs nothing
+beyond the bot's own requirements.
+"""
+
+import asyncio
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from urllib.parse import parse_qs, parse_qsl, urlsplit
+
+# الطرق التي تمثل "رد" البوت على المستخدم (نهاية زمن التحديث)
+REPLY_METHODS = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup"})
+
+
+class _Server:
+    """Minimal HTTP/1.1 keep-alive server on its own asyncio loop (background thread).
+
+    Subclasses implement handle(method, path, headers, body) -> (status, body, headers);
+    header names are lower-case. Much cheaper per request than http.server's thread per
+    connection, so the stand-ins do not become the bottleneck being measured. handle() can
+    also be called directly without start() (in-process transport for perf/bench.py).
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._serve, self.host, self.port, backlog=1024))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                # العملاء هنا (httpx) يرسلون Content-Length دائماً - لا حاجة لـ chunked
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status, payload, extra_headers = self.handle(method, path, headers, body)
+                lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+                         "Content-Type: application/json", f"Content-Length: {len(payload)}"]
+                lines.extend(f"{name}: {value}" for name, value in (extra_headers or {}).items())
+                writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeBotAPI(_Server):
+    """Bot API stand-in: answers every method with a plausible result and records replies per chat."""
+
+    def __init__(self, record_replies: bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self.record_replies = record_replies
+        self.calls = {}
+        self._replies = {}
+        self._message_ids = {}
+        self._cond = threading.Condition()
+
+    def handle(self, method, path, headers, body):
+        api_method = path.rsplit("/", 1)[-1]
+        params = self._params(headers, body)
+        with self._cond:
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        result = self._result(api_method, params)
+        if self.record_replies and api_method in REPLY_METHODS:
+            chat_id = int(params.get("chat_id", 0) or 0)
+            with self._cond:
+                self._replies.setdefault(chat_id, []).append((time.perf_counter(), api_method, params))
+                self._cond.notify_all()
+        return 200, json.dumps({"ok": True, "result": result}).encode(), None
+
+    @staticmethod
+    def _params(headers, body: bytes) -> dict:
+        if not body:
+            return {}
+        content_type = headers.get("content-type", "")
+        if "json" in content_type:
+            return json.loads(body)
+        # PTB يرسل application/x-www-form-urlencoded والقيم المركبة كنص JSON
+        return {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+
+    def _result(self, api_method: str, params: dict):
+        now = int(time.time())
+        if api_method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Load Test Bot", "username": "load_test_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if api_method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0) or 0)
+            message_id = params.get("message_id")
+            if message_id is None:
+                with self._cond:
+                    message_id = self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+            return {"message_id": int(message_id), "date": now, "chat": {"id": chat_id, "type": "private"},
+                    "text": params.get("text", "")}
+        if api_method == "getChatMember":
+            user_id = int(params.get("user_id", 0) or 0)
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "user"}}
+        return True
+
+    def reply_count(self, chat_id: int) -> int:
+        with self._cond:
+            return len(self._replies.get(chat_id, ()))
+
+    def wait_reply(self, chat_id: int, after: int, timeout: float):
+        """Block until chat has more than `after` replies; returns (perf_counter time, method, params) or None."""
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while True:
+                replies = self._replies.get(chat_id, ())
+                if len(replies) > after:
+                    return replies[after]
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+
+def _parse_value(text: str):
+    if text == "null":
+        return None
+    if text in ("true", "false"):
+        return text == "true"
+    if text.startswith('"') and text.endswith('"'):
+        return text[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def _split_list(text: str) -> list:
+    items, current, quoted = [], "", False
+    for ch in text:
+        if ch == '"':
+            quoted = not quoted
+        if ch == "," and not quoted:
+            items.append(current)
+            current = ""
+        else:
+            current += ch
+    if current:
+        items.append(current)
+    return [_parse_value(item) for item in items]
+
+
+_OPERATORS = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "gt": lambda a, b: a is not None and a > b,
+    "gte": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b,
+    "lte": lambda a, b: a is not None and a <= b,
+}
+
+
+class FakePostgREST(_Server):
+    """In-process PostgREST stand-in with the bot's tables and random-question RPCs."""
+
+    def __init__(self, questions: int = 500, users=(), **kwargs):
+        super().__init__(**kwargs)
+        self.requests = 0
+        self._lock = threading.Lock()
+        now = datetime.now(timezone.utc).isoformat()
+        self.tables = {
+            "questions": [
+                {
+                    "id": i, "question": f"Load test question {i}?",
+                    "option_a": "Option A", "option_b": "Option B", "option_c": "Option C", "option_d": "Option D",
+                    "correct_answer": "ABCD"[i % 4], "explanation": f"Explanation {i}",
+                    "date_added": now, "ai_review_status": "correct",
+                }
+                for i in range(1, questions + 1)
+            ],
+            "target_users": [
+                {"id": n, "telegram_id": telegram_id, "username": f"user{telegram_id}", "first_name": "Load",
+                 "last_name": "Test", "phone_number": "+000", "language_code": "en",
+                 "joined_at": now, "last_interaction": now}
+                for n, telegram_id in enumerate(users, start=1)
+            ],
+            "user_answers_bot": [],
+        }
+        self._next_id = {name: len(rows) + 1 for name, rows in self.tables.items()}
+
+    def handle(self, method, path, headers, body):
+        parts = urlsplit(path)
+        resource = parts.path.split("/rest/v1/", 1)[-1]
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        prefer = headers.get("prefer", "")
+        payload = json.loads(body) if body else None
+        with self._lock:
+            self.requests += 1
+            if resource.startswith("rpc/"):
+                return self._rpc(resource[4:], payload or {})
+            table = self.tables.get(resource)
+            if table is None:
+                return 404, json.dumps({"message": f"relation {resource} does not exist"}).encode(), None
+            if method == "GET":
+                return self._select(table, params, prefer)
+            if method == "POST":
+                return self._insert(resource, table, payload, params, prefer)
+            if method == "PATCH":
+                return self._update(table, payload or {}, params, prefer)
+        return 405, b"", None
+
+    @staticmethod
+    def _matches(row: dict, filters) -> bool:
+        for column, expression in filters:
+            operator, _, raw = expression.partition(".")
+            if operator == "in":
+                if row.get(column) not in _split_list(raw.strip("()")):
+                    return False
+            elif not _OPERATORS[operator](row.get(column), _parse_value(raw)):
+                return False
+        return True
+
+    def _filtered(self, table, params):
+        filters = [(k, v) for k, v in params if k not in ("select", "order", "limit", "offset", "on_conflict")]
+        return [row for row in table if self._matches(row, filters)]
+
+    def _select(self, table, params, prefer):
+        rows = self._filtered(table, params)
+        total = len(rows)
+        options = dict(params)
+        if "order" in options:
+            column, _, direction = options["order"].partition(".")
+            rows.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=direction == "desc")
+        if "limit" in options:
+            rows = rows[:int(options["limit"])]
+        columns = options.get("select", "*")
+        if columns != "*":
+            names = [c.strip() for c in columns.split(",")]
+            rows = [{name: row.get(name) for name in names} for row in rows]
+        headers = {}
+        if "count=exact" in prefer:
+            headers["Content-Range"] = f"0-{max(len(rows) - 1, 0)}/{total}" if rows else f"*/{total}"
+        return 200, json.dumps(rows).encode(), headers
+
+    def _insert(self, name, table, payload, params, prefer):
+        rows = payload if isinstance(payload, list) else [payload]
+        conflict = dict(params).get("on_conflict") if "merge-duplicates" in prefer else None
+        stored = []
+        for row in rows:
+            row = dict(row)
+            existing = None
+            if conflict:
+                existing = next((r for r in table if r.get(conflict) == row.get(conflict)), None)
+            if existing is not None:
+                existing.update(row)
+                stored.append(existing)
+                continue
+            row.setdefault("id", self._next_id[name])
+            self._next_id[name] = max(self._next_id[name], row["id"]) + 1
+            table.append(row)
+            stored.append(row)
+        if "return=minimal" in prefer:
+            return 201, b"", None
+        return 201, json.dumps(stored).encode(), None
+
+    def _update(self, table, payload, params, prefer):
+        rows = self._filtered(table, params)
+        for row in rows:
+            row.update(payload)
+        if "return=minimal" in prefer:
+            return 204, b"", None
+        return 200, json.dumps(rows).encode(), None
+
+    def _rpc(self, name, payload):
+        candidates = [q for q in self.tables["questions"] if q["ai_review_status"] == "correct"]
+        if name == "get_random_question_for_user":
+            user_id = payload.get("p_user_id")
+            answered = {a["question_id"] for a in self.tables["user_answers_bot"] if a.get("user_id") == user_id}
+        elif name == "get_random_question":
+            answered = set(payload.get("excluded_ids") or ())
+        else:
+            return 404, json.dumps({"message": f"function {name} does not exist"}).encode(), None
+        candidates = [q for q in candidates if q["id"] not in answered]
+        rows = [random.choice(candidates)] if candidates else []
+        return 200, json.dumps(rows).encode(), None
@@ -0,0 +1,335 @@
+"""End-to-end load test: runs the bot against local Bot API / PostgREST stand-ins and drives /webhook.
+
+    python perf/loadtest.py --users 50 --rate 10                 # scripted journeys, WSGI (gunicorn)
+    python perf/loadtest.py --server asgi --users 200 --rate 40  # same through uvicorn
+    python perf/loadtest.py --users 20 --record updates.jsonl    # also save the generated updates
+    python perf/loadtest.py --replay updates.jsonl --rate 100    # replay recorded updates (one JSON update per line)
+
+Latency is measured end to end: from POSTing the update to /webhook until the stand-in Bot API
+receives the bot's reply (sendMessage/editMessageText) for that chat.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from fakes import FakeBotAPI, FakePostgREST
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:LOADTEST"
+FIRST_USER_ID = 10_000_000
+
+# مسار المستخدم: /start ← بدء الاختبار ← إجابة ← السؤال التالي ← إجابة ← الإحصائيات
+JOURNEY = ("start", "quiz", "answer", "quiz", "answer", "stats")
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest-rank
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class Recorder:
+    """Collects per-step latencies, failures and (optionally) the updates that were sent."""
+
+    def __init__(self, record_path: str = None):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+        self._record = open(record_path, "w") if record_path else None
+
+    def sent(self, update: dict):
+        if self._record is not None:
+            with self._lock:
+                self._record.write(json.dumps(update, ensure_ascii=False) + "\n")
+
+    def ok(self, step: str, seconds: float):
+        with self._lock:
+            self.latencies.setdefault(step, []).append(seconds)
+
+    def fail(self, step: str, reason: str):
+        with self._lock:
+            key = f"{step}: {reason}"
+            self.failures[key] = self.failures.get(key, 0) + 1
+
+    def close(self):
+        if self._record is not None:
+            self._record.close()
+
+    def report(self, elapsed: float) -> dict:
+        all_values = sorted(v for values in self.latencies.values() for v in values)
+
+        def summary(values):
+            values = sorted(values)
+            return {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1) if values else 0.0,
+            }
+
+        return {
+            "duration_s": round(elapsed, 2),
+            "updates": len(all_values) + sum(self.failures.values()),
+            "updates_per_sec": round(len(all_values) / elapsed, 1) if elapsed else 0.0,
+            "latency": summary(all_values),
+            "steps": {step: summary(values) for step, values in sorted(self.latencies.items())},
+            "failures": self.failures,
+        }
+
+
+class WebhookClient:
+    """Posts updates to the app and waits for the bot's reply on the stand-in Bot API."""
+
+    def __init__(self, app_url: str, bot: FakeBotAPI, recorder: Recorder, timeout: float):
+        self.app_url = app_url
+        self.bot = bot
+        self.recorder = recorder
+        self.timeout = timeout
+        self._update_ids = itertools.count(1)
+        self._local = threading.local()
+
+    def _http(self) -> httpx.Client:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = httpx.Client(base_url=self.app_url, timeout=self.timeout)
+        return client
+
+    def next_update_id(self) -> int:
+        return next(self._update_ids)
+
+    def send(self, step: str, update: dict, chat_id):
+        """Returns the reply params, or None on failure (already recorded)."""
+        self.recorder.sent(update)
+        seen = self.bot.reply_count(chat_id) if chat_id is not None else 0
+        started = time.perf_counter()
+        try:
+            response = self._http().post("/webhook", json=update)
+        except httpx.HTTPError as e:
+            self.recorder.fail(step, type(e).__name__)
+            return None
+        if response.status_code != 200:
+            self.recorder.fail(step, f"HTTP {response.status_code}")
+            return None
+        if chat_id is None:
+            self.recorder.ok(step, time.perf_counter() - started)
+            return {}
+        reply = self.bot.wait_reply(chat_id, seen, self.timeout)
+        if reply is None:
+            self.recorder.fail(step, "no reply")
+            return None
+        replied_at, _, params = reply
+        self.recorder.ok(step, replied_at - started)
+        return params
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Load", "last_name": "Test",
+            "username": f"user{user_id}", "language_code": "en"}
+
+
+def _buttons(reply: dict) -> list:
+    markup = reply.get("reply_markup")
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    if not markup or "inline_keyboard" not in markup:
+        return []
+    return [button.get("callback_data") for row in markup["inline_keyboard"] for button in row]
+
+
+def run_journey(client: WebhookClient, user_id: int, think_time: float):
+    message_id = 0
+    last_reply = {}
+    for step in JOURNEY:
+        update_id = client.next_update_id()
+        if step == "start":
+            update = {"update_id": update_id, "message": {
+                "message_id": update_id, "date": int(time.time()), "from": _user(user_id),
+                "chat": {"id": user_id, "type": "private"}, "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+        else:
+            data = step
+            if step == "answer":
+                # نضغط زر إجابة من الرسالة الأخيرة كما يفعل المستخدم
+                answers = [b for b in _buttons(last_reply) if b and b.startswith("a1:")]
+                if not answers:
+                    client.recorder.fail(step, "no answer buttons")
+                    return
+                data = random.choice(answers)
+            update = {"update_id": update_id, "callback_query": {
+                "id": str(update_id), "from": _user(user_id), "chat_instance": str(user_id), "data": data,
+                "message": {"message_id": message_id, "date": int(time.time()),
+                            "chat": {"id": user_id, "type": "private"}, "text": "..."}}}
+        reply = client.send(step, update, user_id)
+        if reply is None:
+            return
+        last_reply = reply
+        message_id = int(reply.get("message_id") or message_id or 1)
+        if think_time:
+            time.sleep(random.uniform(0.5, 1.5) * think_time)
+
+
+def run_replay(client: WebhookClient, path: str, rate: float, workers: int):
+    with open(path) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    interval = 1.0 / rate if rate else 0.0
+
+    def chat_of(update: dict):
+        for key in ("message", "edited_message", "callback_query", "my_chat_member", "chat_member"):
+            body = update.get(key)
+            if body:
+                chat = body.get("chat") or (body.get("message") or {}).get("chat")
+                if chat:
+                    return chat["id"]
+        return None
+
+    def send(update: dict):
+        kind = next((k for k in update if k != "update_id"), "update")
+        if kind == "callback_query":
+            kind = "callback:" + str(update["callback_query"].get("data", "")).split(":", 1)[0]
+        update = dict(update, update_id=client.next_update_id())  # أرقام جديدة حتى لا يتجاهلها dedup
+        client.send(kind, update, chat_of(update))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        started = time.perf_counter()
+        for n, update in enumerate(updates):
+            if interval:
+                delay = started + n * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, update)
+
+
+def start_app(args, bot_url: str, db_url: str):
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": TOKEN,
+        "TELEGRAM_API_BASE_URL": bot_url + "/bot",
+        "SUPABASE_URL": db_url,
+        "SUPABASE_KEY": "loadtest",
+        "CHANNEL_SUBSCRIPTION_REQUIRED": "false",
+        "STATE_BACKEND": "memory",
+        "SERVER_MODE": args.server,
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    if args.server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "telegram_bot:asgi_app", "--host", "127.0.0.1",
+                   "--port", str(args.port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "telegram_bot:app", "--bind", f"127.0.0.1:{args.port}",
+                   "--workers", "1", "--threads", str(args.threads), "--timeout", "300"]
+    log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+    return subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(app_url: str, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(app_url + "/health", timeout=2).json().get("ready"):
+                return
+        except (httpx.HTTPError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"App at {app_url} did not become ready within {timeout:.0f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="virtual users, one journey each")
+    parser.add_argument("--rate", type=float, default=5.0,
+                        help="journeys started per second (replay: updates per second, 0 = as fast as possible)")
+    parser.add_argument("--think-time", type=float, default=0.5, help="average pause between a user's steps (s)")
+    parser.add_argument("--replay", help="JSONL file of Telegram updates to replay instead of journeys")
+    parser.add_argument("--record", help="write every update sent to this JSONL file (replayable)")
+    parser.add_argument("--server", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads (wsgi)")
+    parser.add_argument("--app-url", help="use an already running app (configured for the stand-ins) instead of starting one")
+    parser.add_argument("--app-log", help="write the app's output to this file")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra env for the app")
+    parser.add_argument("--questions", type=int, default=500)
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="added latency per Bot API call (s)")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="added latency per PostgREST request (s)")
+    parser.add_argument("--timeout", type=float, default=30.0, help="max wait for a reply (s)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+    bot = FakeBotAPI(latency=args.bot_latency).start()
+    db = FakePostgREST(questions=args.questions, users=user_ids, latency=args.db_latency).start()
+    app_process = None
+    app_url = args.app_url or f"http://127.0.0.1:{args.port}"
+    if args.app_url:
+        print(f"Using {app_url}; it must run with TELEGRAM_API_BASE_URL={bot.url}/bot SUPABASE_URL={db.url}",
+              file=sys.stderr)
+    else:
+        app_process = start_app(args, bot.url, db.url)
+
+    recorder = Recorder(args.record)
+    try:
+        wait_ready(app_url)
+        client = WebhookClient(app_url, bot, recorder, args.timeout)
+        started = time.perf_counter()
+        if args.replay:
+            run_replay(client, args.replay, args.rate, workers=max(args.users, 1))
+        else:
+            with ThreadPoolExecutor(max_workers=args.users) as pool:
+                for n, user_id in enumerate(user_ids):
+                    if args.rate:
+                        delay = started + n / args.rate - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    pool.submit(run_journey, client, user_id, args.think_time)
+        elapsed = time.perf_counter() - started
+        report = recorder.report(elapsed)
+        try:
+            report["app"] = {key: value for key, value in httpx.get(app_url + "/health", timeout=5).json().items()
+                             if key in ("dispatcher", "outbound", "single_flight", "startup")}
+        except (httpx.HTTPError, ValueError):
+            pass
+        report["bot_api_calls"] = dict(bot.calls)
+        report["db_requests"] = db.requests
+    finally:
+        recorder.close()
+        if app_process is not None:
+            app_process.terminate()
+            try:
+                app_process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                app_process.kill()
+        bot.stop()
+        db.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    latency = report["latency"]
+    print(f"updates: {report['updates']}  duration: {report['duration_s']}s  "
+          f"throughput: {report['updates_per_sec']} updates/s")
+    print(f"latency: p50 {latency['p50_ms']} ms  p95 {latency['p95_ms']} ms  "
+          f"p99 {latency['p99_ms']} ms  max {latency['max_ms']} ms")
+    for step, summary in report["steps"].items():
+        print(f"  {step:<16} n={summary['count']:<6} p50 {summary['p50_ms']:>8} ms  "
+              f"p95 {summary['p95_ms']:>8} ms  p99 {summary['p99_ms']:>8} ms")
+    for failure, count in report["failures"].items():
+        print(f"  FAILED {failure}: {count}")
+
+
+if __name__ == "__main__":
+    main()
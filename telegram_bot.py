@@ -1,29 +1,181 @@
+import time
+_IMPORT_STARTED_AT = time.perf_counter()  # بداية الإقلاع (لقياس cold start)
+
 import os
 import asyncio
-from datetime import datetime
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram.error import RetryAfter
 from telegram.request import HTTPXRequest
 from threading import Thread
-from telegram.ext import Application, ApplicationBuilder, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, TypeHandler, filters
-from supabase import create_client, Client
-from dotenv import load_dotenv
+from telegram.ext import Application, ApplicationBuilder, BasePersistence, BaseRateLimiter, CallbackQueryHandler, ChatMemberHandler, CommandHandler, ContextTypes, MessageHandler, PersistenceInput, TypeHandler, filters
+import atexit
+import copy
+import functools
+import hmac
+import importlib.util
+import inspect
+import json
 import logging
-import time
+import logging.handlers
+import pickle
+import queue
+import random
+import sys
+import threading
 import httpx
 
 # Configure logging to integrate with Cloud Run's logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# السجلات تمر عبر طابور (QueueHandler) ويكتبها ثريد خلفي (QueueListener)، فلا تنتظر
+# الـ handlers ولا اللوب الكتابة على stdout. LOG_FORMAT=json (structured logging في Cloud Run) أو text.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+# نسبة ما يُكتب لكل فئة (extra={'category': ...} أو اسم الـ logger)؛ WARNING وما فوق تُكتب دائماً
+DEFAULT_LOG_SAMPLE_RATES = "webhook_payload=0.01,update=0.01,db=0.1,httpx=0.1"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", DEFAULT_LOG_SAMPLE_RATES)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """سطر JSON لكل سجل بالحقول التي يفهمها Cloud Logging (severity, message)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'severity': record.levelname,
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        category = getattr(record, 'category', None)
+        if category:
+            entry['category'] = category
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogSampler(logging.Filter):
+    """عينات لكل فئة قبل دخول الطابور: السجل المُسقط لا يُنسّق ولا يُكتب."""
+
+    def __init__(self, rates: dict, spec_error: str = None):
+        super().__init__()
+        self.rates = rates
+        self.spec_error = spec_error  # يُسجَّل كتحذير بعد تهيئة السجلات
+        self.dropped = {}
+
+    @staticmethod
+    def _parse(spec: str) -> dict:
+        rates = {}
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            name, sep, rate = item.partition("=")
+            rate = float(rate) if sep and name.strip() else None
+            if rate is None or not 0.0 <= rate <= 1.0:
+                raise ValueError(f"bad entry {item.strip()!r} (expected category=rate, 0 <= rate <= 1)")
+            rates[name.strip()] = rate
+        return rates
+
+    @classmethod
+    def from_spec(cls, spec: str, default: str = DEFAULT_LOG_SAMPLE_RATES):
+        """قيمة LOG_SAMPLE_RATES خاطئة لا توقف البوت: تحذير والعودة للقيم الافتراضية."""
+        try:
+            return cls(cls._parse(spec))
+        except ValueError as e:
+            return cls(cls._parse(default), spec_error=f"Invalid LOG_SAMPLE_RATES {spec!r}: {e}; using {default!r}")
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        category = getattr(record, 'category', None) or record.name
+        rate = self.rates.get(category)
+        if rate is None or rate >= 1.0 or random.random() < rate:
+            return True
+        self.dropped[category] = self.dropped.get(category, 0) + 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            'format': LOG_FORMAT,
+            'queue_depth': LOG_QUEUE.qsize(),
+            'sample_rates': self.rates,
+            'dropped': dict(self.dropped),
+        }
+
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # نسخة مسطحة آمنة للنقل بين الثريدات، مع إبقاء نص الاستثناء منفصلاً للـ JSON
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _configure_logging() -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    queue_handler = _LogQueueHandler(LOG_QUEUE)
+    queue_handler.addFilter(LOG_SAMPLER)
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(LOG_QUEUE, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # يُسجَّل أولاً فيعمل أخيراً: تفريغ كل السجلات عند الخروج
+    return listener
+
+
+_EXC_FORMATTER = logging.Formatter()
+LOG_QUEUE = queue.SimpleQueue()
+LOG_SAMPLER = LogSampler.from_spec(LOG_SAMPLE_RATES)
+LOG_LISTENER = _configure_logging()
 logger = logging.getLogger(__name__)
+if LOG_SAMPLER.spec_error:
+    logger.warning(LOG_SAMPLER.spec_error)
+DB_LOG = {'category': 'db'}  # سجلات INFO المتكررة لكل استعلام
+UPDATE_LOG = {'category': 'update'}  # سجلات INFO لكل تحديث
 
 # Increase verbosity for PTB internals when debugging Cloud Run behavior
 logging.getLogger("telegram").setLevel(logging.INFO)  # ← خففنا من DEBUG إلى INFO
 logging.getLogger("telegram.ext").setLevel(logging.INFO)  # ← خففنا من DEBUG إلى INFO
 logging.getLogger("httpx").setLevel(logging.INFO)
 
-from flask import Flask, request, jsonify
+
+class StartupTimeline:
+    """مراحل الإقلاع بالـ ms منذ بداية استيراد الموديول (import ← supabase ← ptb ← ready ← first_update)."""
+
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.phases = {}
+
+    def mark(self, phase: str):
+        if phase in self.phases:
+            return
+        elapsed_ms = round((time.perf_counter() - self.started_at) * 1000, 1)
+        self.phases[phase] = elapsed_ms
+        logger.info("Startup phase '%s' at %.1f ms", phase, elapsed_ms)
+
+    def stats(self) -> dict:
+        return {
+            'phases_ms': dict(self.phases),
+            'ready_ms': self.phases.get('ready'),
+        }
+
+
+STARTUP_TIMELINE = StartupTimeline(_IMPORT_STARTED_AT)
+
+from flask import Flask, Response, request, jsonify
 
 # تحميل متغيرات البيئة
 
@@ -34,20 +186,101 @@ SUPABASE_KEY = (os.getenv("SUPABASE_KEY") or "").strip()
 TELEGRAM_CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID", "@Vignora")
 TELEGRAM_CHANNEL_LINK = os.getenv("TELEGRAM_CHANNEL_LINK", "https://t.me/Vignora")
 CHANNEL_SUBSCRIPTION_REQUIRED = os.getenv("CHANNEL_SUBSCRIPTION_REQUIRED", "false").lower() == "true"
+# عنوان Bot API بديل (مثلاً خادم محلي أو الخادم الوهمي في perf/) - الصيغة: http://host:port/bot
+TELEGRAM_API_BASE_URL = (os.getenv("TELEGRAM_API_BASE_URL") or "").strip()
 
 # متغير للتحكم في إظهار التاريخ (يمكن تغييره لاحقاً)
 SHOW_DATE_ADDED = False
 
 # إعدادات التخزين المؤقت للأسئلة
-MAX_PREFETCH_QUESTIONS = 5
+MIN_PREFETCH_QUESTIONS = 2
+DEFAULT_PREFETCH_QUESTIONS = 5
+MAX_PREFETCH_QUESTIONS = 10
+PREFETCH_HORIZON_SECONDS = 60  # نجهّز ما يكفي تقريباً لدقيقة من الإجابات
 QUESTION_BUFFER_KEY = "prefetched_questions"
 QUESTION_BUFFER_TASK_KEY = "question_buffer_task"
 PREFETCH_EXCLUDED_KEY = "prefetch_excluded_ids"
 RECENTLY_ANSWERED_KEY = "recently_answered_ids"
+ANSWER_PACE_KEY = "answer_pace_seconds"
+LAST_ANSWER_AT_KEY = "last_answer_at"
+# مفاتيح لا تُحفظ مع الجلسة (كائنات وقت التشغيل فقط)
+TRANSIENT_USER_DATA_KEYS = frozenset({QUESTION_BUFFER_TASK_KEY})
+
+# إعدادات مخزن الأسئلة في الذاكرة (اختيار السؤال محلياً بدل RPC)
+QUESTION_POOL_ENABLED = os.getenv("QUESTION_POOL_ENABLED", "true").lower() == "true"
+QUESTION_POOL_REFRESH_INTERVAL = float(os.getenv("QUESTION_POOL_REFRESH_INTERVAL", "60"))  # تحديث تدريجي
+QUESTION_POOL_FULL_REFRESH = float(os.getenv("QUESTION_POOL_FULL_REFRESH", "1800"))  # إعادة تحميل كاملة
+QUESTION_POOL_RANDOM_TRIES = 32
+QUESTION_COLUMNS = 'id, question, option_a, option_b, option_c, option_d, correct_answer, explanation, date_added'
+# كاش الأسئلة المجاب عليها لكل مستخدم (bitmaps مضغوطة مع LRU)
+ANSWERED_CACHE_MAX_BYTES = int(os.getenv("ANSWERED_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+ANSWERED_CACHE_MAX_USERS = int(os.getenv("ANSWERED_CACHE_MAX_USERS", "50000"))
+ANSWERED_SYNC_INTERVAL = float(os.getenv("ANSWERED_SYNC_INTERVAL", "300"))  # مزامنة تدريجية من DB
+DB_PAGE_SIZE = 1000  # حد PostgREST الافتراضي لعدد الصفوف في الطلب
+
+# فهرس المستخدمين المسجلين (لتجاوز check_user_exists على /start)
+KNOWN_USERS_REFRESH_INTERVAL = float(os.getenv("KNOWN_USERS_REFRESH_INTERVAL", "300"))  # تحديث تدريجي
+KNOWN_USERS_FULL_REFRESH = float(os.getenv("KNOWN_USERS_FULL_REFRESH", "3600"))  # إعادة تحميل كاملة
+
+# عدادات إحصائيات المستخدمين في الذاكرة
+USER_STATS_MAX_USERS = int(os.getenv("USER_STATS_MAX_USERS", "100000"))
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "600"))  # مطابقة مع DB
 
-# Cache for total questions count (correct-only)
-TOTAL_QUESTIONS_CACHE = {"value": None, "ts": 0}
+# Cache for total questions count (correct-only) - stale-while-revalidate
 TOTAL_TTL = 60  # مدة صلاحية كاش عدد الأسئلة (بالثواني)
+AGGREGATE_TTL = 300  # مدة صلاحية كاش أعداد المستخدمين والإجابات (db_info)
+
+# إعدادات طابور حفظ الإجابات (write-behind)
+ANSWER_BATCH_SIZE = int(os.getenv("ANSWER_BATCH_SIZE", "100"))
+ANSWER_FLUSH_INTERVAL = float(os.getenv("ANSWER_FLUSH_INTERVAL", "1.0"))  # بالثواني
+ANSWER_QUEUE_MAX = int(os.getenv("ANSWER_QUEUE_MAX", "5000"))
+ANSWER_FLUSH_MAX_RETRIES = 3
+
+# إعدادات تتبع آخر تفاعل (last_interaction)
+LAST_SEEN_FLUSH_INTERVAL = float(os.getenv("LAST_SEEN_FLUSH_INTERVAL", "30"))  # بالثواني
+LAST_SEEN_RESOLUTION = 60  # دقة الوقت المكتوب (بالثواني)
+LAST_SEEN_CHUNK_SIZE = 500  # أقصى عدد معرفات في طلب update واحد
+
+# إعدادات الاتصال بـ Supabase
+DB_TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", "10"))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "50"))
+
+# وضع الخادم: wsgi (gunicorn + Flask، الافتراضي) أو asgi (uvicorn على لوب البوت نفسه)
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi").strip().lower()
+# الإقلاع السريع: الخادم يستقبل الطلبات فوراً والتهيئة تكمل في الخلفية (/webhook يرجع 503 حتى الجاهزية)
+FAST_START = os.getenv("FAST_START", "true").lower() == "true"
+
+# القياس: نسبة الاستدعاءات التي تُوقّت، والتقاط cProfile/stack للتحديثات البطيئة (0 = معطّل)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "1.0"))
+PROFILE_CAPTURE_EVERY = int(os.getenv("PROFILE_CAPTURE_EVERY", "0"))  # تحديث واحد من كل N
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "1000"))
+# /profile معطّل بدون توكن، ويتطلب Authorization: Bearer <PROFILE_ENDPOINT_TOKEN>
+PROFILE_ENDPOINT_TOKEN = os.getenv("PROFILE_ENDPOINT_TOKEN", "").strip()
+
+# إعدادات توزيع التحديثات (webhook → process_update)
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "32"))  # أقصى عدد مستخدمين يتعالجون بالتوازي
+DISPATCH_QUEUE_MAX = int(os.getenv("DISPATCH_QUEUE_MAX", "1000"))
+DISPATCH_DEDUP_SIZE = 10000  # عدد آخر update_id المحفوظة لتجاهل التكرار
+DISPATCH_MAX_LOOP_LAG = float(os.getenv("DISPATCH_MAX_LOOP_LAG", "1.0"))  # بالثواني
+
+# مخزن الحالة (الجلسات والكاش المشترك): sqlite (نسخة واحدة) أو redis (عدة workers/نسخ) أو memory
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").strip().lower()
+# حفظ الجلسات (user_data / bot_data) محلياً في SQLite - فارغ = بدون حفظ
+# على Cloud Run يفضل أن يكون المسار على volume مركّب حتى يبقى بعد إعادة التشغيل
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_state.sqlite3").strip()
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5"))  # بالثواني
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "quizbot")
+# الكاش المحلي أمام المخزن المشترك
+NEAR_CACHE_TTL = float(os.getenv("NEAR_CACHE_TTL", "5"))  # بالثواني
+NEAR_CACHE_MAX_ENTRIES = 10000
+
+# حدود الطلبات الصادرة لـ Bot API (رسائل/ثانية)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))  # حد تيليجرام العام تقريباً
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))  # لكل محادثة خاصة (معدل مستمر)
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "5"))  # دفعة مسموحة للنقرات السريعة
+OUTBOUND_GROUP_RATE = 20 / 60  # المجموعات والقنوات: 20 رسالة في الدقيقة
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))  # إعادة المحاولة بعد RetryAfter
 
 # Session TTL (مثلاً 12 ساعة)
 SESSION_TTL_SECONDS = 12 * 60 * 60  # تقدر تخليها 24 * 60 * 60 لو تبي يوم كامل
@@ -65,11 +298,26 @@ def is_session_stale(user_data: dict) -> bool:
 # متغير عام للتطبيق (مطلوب للويبهوك)
 application = None
 # متغير عام لعميل Supabase
-supabase: Client = None
+supabase: "AsyncSupabaseClient" = None
 
-# Simple in-memory cache for channel subscription checks
-_subscription_cache = {}
-_SUBSCRIPTION_TTL_SECONDS = 60
+# صيغة callback_data المستقلة عن الجلسة (v1): النوع:رقم_السؤال:...
+#   a1:{qid}:{A-D}            إجابة
+#   r1:{qid}:{A-D}            قائمة الإبلاغ (مع الإجابة المختارة للرجوع)
+#   rp1:{qid}:{A-D}:{reason}  سبب الإبلاغ
+#   b1:{qid}:{A-D}            الرجوع لشاشة النتيجة
+# الصيغ القديمة (answer_A, report, report_x_{qid}, back_to_answer) ما زالت مدعومة للرسائل السابقة.
+CB_ANSWER = "a1"
+CB_REPORT = "r1"
+CB_REPORT_REASON = "rp1"
+CB_BACK = "b1"
+REPORT_REASON_CODES = {'i': 'incorrect', 't': 'typo', 'u': 'unclear', 'p': 'topic'}
+QUESTION_CACHE_TTL = 3600  # مدة بقاء السؤال في الكاش المشترك (بالثواني)
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "5000"))  # نصوص وأزرار الأسئلة المرسومة
+
+# فهرس الاشتراك في القناة (يُحدّث من تحديثات chat_member - البوت لازم يكون admin في القناة)
+MEMBERSHIP_TTL = float(os.getenv("MEMBERSHIP_TTL", "3600"))  # العضو
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "60"))  # غير العضو
+MEMBERSHIP_MAX_USERS = int(os.getenv("MEMBERSHIP_MAX_USERS", "100000"))
 
 def validate_environment():
     """Checks for required environment variables and raises a single, comprehensive error if any are missing."""
@@ -99,21 +347,690 @@ def format_timestamp(timestamp):
     except (ValueError, TypeError):
         return "Unknown"
 
-def time_it_sync(func):
-    """A decorator to time synchronous functions and log their execution time."""
-    def wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
-        result = func(*args, **kwargs)
-        end_time = time.perf_counter()
-        logger.info(f"SYNC function '{func.__name__}' took {end_time - start_time:.4f} seconds")
-        return result
+class SingleFlight:
+    """دمج القراءات المتطابقة الجارية: نفس العملية بنفس المعاملات تنتظر نفس الاستعلام.
+
+    النتيجة مشتركة بين كل المنتظرين، لذلك لا يجوز تعديلها في مكان الاستدعاء.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._calls = {}
+        self._coalesced = {}
+
+    def wrap(self, func):
+        name = func.__qualname__
+        self._calls[name] = 0
+        self._coalesced[name] = 0
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            self._calls[name] += 1
+            try:
+                key = (name, args, frozenset(kwargs.items()))
+                hash(key)
+            except TypeError:
+                return await func(*args, **kwargs)
+            task = self._inflight.get(key)
+            if task is not None:
+                self._coalesced[name] += 1
+            else:
+                task = asyncio.create_task(func(*args, **kwargs))
+                self._inflight[key] = task
+                task.add_done_callback(lambda t, key=key: self._done(key, t))
+            # shield: إلغاء أحد المنتظرين لا يلغي الاستعلام على الباقين
+            return await asyncio.shield(task)
+        return wrapper
+
+    def _done(self, key, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # تجنب "exception was never retrieved" إذا لم يبقَ منتظر
+
+    def stats(self) -> dict:
+        calls = sum(self._calls.values())
+        coalesced = sum(self._coalesced.values())
+        return {
+            "inflight": len(self._inflight),
+            "calls": calls,
+            "coalesced": coalesced,
+            "hit_rate": round(coalesced / calls, 3) if calls else 0.0,
+            "by_operation": {
+                name: {"calls": n, "coalesced": self._coalesced[name]}
+                for name, n in self._calls.items() if n
+            },
+        }
+
+
+SINGLE_FLIGHT = SingleFlight()
+single_flight = SINGLE_FLIGHT.wrap
+
+
+# --- Metrics (Prometheus text format on /metrics) ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # الأخير = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Histograms وعدادات في الذاكرة تُعرض بصيغة Prometheus.
+
+    التسجيل بدون أقفال: الكتابة تتم على لوب البوت فقط، والقراءة (/metrics) تأخذ نسخة من القواميس.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, /, **labels):
+        series = self._histograms.get(name)
+        if series is None:
+            series = self._histograms[name] = {}
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, /, **labels):
+        series = self._counters.get(name)
+        if series is None:
+            series = self._counters[name] = {}
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+    def render(self, gauges: dict = None) -> str:
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            if name in self._help:
+                lines.append("# HELP %s %s" % (name, self._help[name]))
+            lines.append("# TYPE %s counter" % name)
+            for key, value in list(series.items()):
+                lines.append("%s%s %s" % (name, self._labels(key), value))
+        for name, series in sorted(self._histograms.items()):
+            if name in self._help:
+                lines.append("# HELP %s %s" % (name, self._help[name]))
+            lines.append("# TYPE %s histogram" % name)
+            for key, histogram in list(series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), list(histogram.counts)):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("%s_bucket%s %s" % (name, self._labels(key + (("le", le),)), cumulative))
+                lines.append("%s_sum%s %s" % (name, self._labels(key), round(histogram.sum, 6)))
+                lines.append("%s_count%s %s" % (name, self._labels(key), histogram.count))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.describe("bot_webhook_queue_seconds", "Time from webhook receipt until the update starts processing.")
+METRICS.describe("bot_update_seconds", "Time spent in application.process_update per update.")
+METRICS.describe("bot_handler_seconds", "End-to-end latency of each handler.")
+METRICS.describe("bot_handler_errors_total", "Handler invocations that raised.")
+METRICS.describe("bot_db_request_seconds", "Supabase (PostgREST) request latency per operation.")
+METRICS.describe("bot_db_errors_total", "Failed Supabase requests per operation.")
+METRICS.describe("bot_api_request_seconds", "Telegram Bot API request latency per method.")
+METRICS.describe("bot_api_wait_seconds", "Time a Bot API request waited in the outbound limiter.")
+METRICS.describe("bot_api_errors_total", "Failed Telegram Bot API requests per method.")
+METRICS.describe("bot_api_superseded_total", "Message edits skipped because a newer callback for the same message was waiting.")
+
+
+def observe_handler(func):
+    """تغليف handler لتسجيل زمنه (bot_handler_seconds) وأخطائه باسم الدالة."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception:
+            METRICS.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            METRICS.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
     return wrapper
 
-@time_it_sync
-def check_user_exists(telegram_id: int):
+
+# --- Profiling (sampled timings + slow-update captures) ---
+
+class _ProfileStats:
+    __slots__ = ("sampled", "total", "max")
+
+    def __init__(self):
+        self.sampled = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class _ProfileBlock:
+    __slots__ = ("profiler", "name", "started")
+
+    def __init__(self, profiler, name: str, sampled: bool):
+        self.profiler = profiler
+        self.name = name
+        self.started = time.perf_counter() if sampled else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.started is not None:
+            self.profiler.record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Profiler:
+    """توقيت الدوال (sync و async) والمقاطع بعينات، بدون سطر log لكل استدعاء.
+
+    - profiled / profile_block: تجميعات في الذاكرة (عدد، متوسط، أقصى) + bot_profiled_seconds في /metrics.
+    - التقاط التحديثات البطيئة (عند تفعيل capture_every=N): cProfile لتحديث واحد من كل N
+      (يُحفظ فقط إن كان بطيئاً)، و stack للتحديث الجاري لواحد من كل N تحديثات تجاوزت slow_seconds.
+    - cProfile يقيس كل ما يعمل على ثريد اللوب وليس التحديث وحده، لذلك يبدأ فقط عندما لا يوجد
+      تحديث آخر قيد المعالجة، و overlapping_updates في الالتقاط = عدد التحديثات التي بدأت أثناءه
+      (عملها داخل في الأرقام). الـ stack خاص بمهمة التحديث نفسه.
+    """
+
+    def __init__(self, sample_rate: float, capture_every: int, slow_seconds: float, max_captures: int = 5):
+        self.sample_rate = sample_rate
+        self.capture_every = capture_every
+        self.slow_seconds = slow_seconds
+        self._stats = {}
+        self._captures = deque(maxlen=max_captures)
+        self._capturing = False
+        self._capture_due = False
+        self._capture_started_at = 0  # _updates_seen عند بدء cProfile
+        self._updates_seen = 0
+        self.slow_updates = 0
+        self.captured = 0
+
+    def _sampled(self, rate) -> bool:
+        rate = self.sample_rate if rate is None else rate
+        return rate >= 1.0 or random.random() < rate
+
+    def record(self, name: str, elapsed: float):
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = _ProfileStats()
+        stats.sampled += 1
+        stats.total += elapsed
+        if elapsed > stats.max:
+            stats.max = elapsed
+        METRICS.observe("bot_profiled_seconds", elapsed, name=name)
+
+    def wrap(self, func=None, *, name: str = None, sample_rate: float = None):
+        """Decorator: @profiled أو @profiled(name=..., sample_rate=...)، للدوال العادية و coroutines."""
+        if func is None:
+            return lambda f: self.wrap(f, name=name, sample_rate=sample_rate)
+        label = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not self._sampled(sample_rate):
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.record(label, time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self._sampled(sample_rate):
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(label, time.perf_counter() - started)
+        return wrapper
+
+    def block(self, name: str, sample_rate: float = None) -> _ProfileBlock:
+        """Context manager لتوقيت مقطع (يعمل داخل الدوال العادية و async)."""
+        return _ProfileBlock(self, name, self._sampled(sample_rate))
+
+    def configure(self, capture_every: int = None, slow_seconds: float = None, sample_rate: float = None):
+        """تفعيل/تعديل الالتقاط وقت التشغيل (POST /profile)."""
+        if capture_every is not None:
+            self.capture_every = max(0, int(capture_every))
+        if slow_seconds is not None:
+            self.slow_seconds = max(0.0, float(slow_seconds))
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+
+    def start_update(self, label, concurrent: int = 0):
+        """يُستدعى قبل معالجة التحديث: يرجع (profile, watchdog) أو (None, None) إذا الالتقاط معطّل.
+
+        concurrent: عدد التحديثات الأخرى قيد المعالجة - cProfile ينتظر أول تحديث يبدأ وحده.
+        """
+        if not self.capture_every:
+            return None, None
+        watchdog = asyncio.get_running_loop().call_later(
+            self.slow_seconds, self._on_slow, asyncio.current_task(), label)
+        self._updates_seen += 1
+        if self._updates_seen % self.capture_every == 0:
+            self._capture_due = True
+        profile = None
+        if self._capture_due and not self._capturing and concurrent == 0:
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self._capturing = True
+                self._capture_due = False
+                self._capture_started_at = self._updates_seen
+            except ValueError:  # profiler آخر مفعّل على هذا الثريد
+                profile = None
+        return profile, watchdog
+
+    def finish_update(self, label, elapsed: float, profile, watchdog):
+        if watchdog is not None:
+            watchdog.cancel()
+        if profile is None:
+            return
+        profile.disable()
+        self._capturing = False
+        if elapsed < self.slow_seconds:
+            return
+        import io
+        import pstats
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(25)
+        self._capture("cprofile", label, out.getvalue(), elapsed,
+                      overlapping_updates=self._updates_seen - self._capture_started_at)
+
+    def _on_slow(self, task, label):
+        self.slow_updates += 1
+        if task is None or task.done() or self.slow_updates % self.capture_every:
+            return
+        # سلسلة await كاملة (task.print_stack يعرض الإطار الخارجي فقط)
+        lines = []
+        coro = task.get_coro()
+        while coro is not None:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is not None:
+                lines.append('  File "%s", line %s, in %s' % (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        self._capture("stack", label, "\n".join(lines), self.slow_seconds)
+
+    def _capture(self, kind: str, label, text: str, elapsed: float, overlapping_updates: int = None):
+        self.captured += 1
+        capture = {
+            'kind': kind,
+            'update': label,
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'at': datetime.now(timezone.utc).isoformat(),
+            'profile': text,
+        }
+        if overlapping_updates is not None:
+            capture['overlapping_updates'] = overlapping_updates
+        self._captures.append(capture)
+        logger.warning("Slow update %s (%.0f ms): %s captured, see GET /profile", label, elapsed * 1000, kind)
+
+    def captures(self) -> list:
+        return list(self._captures)
+
+    def stats(self) -> dict:
+        return {
+            'sample_rate': self.sample_rate,
+            'capture_every': self.capture_every,
+            'slow_ms': round(self.slow_seconds * 1000, 1),
+            'slow_updates': self.slow_updates,
+            'captured': self.captured,
+            'timings': {
+                name: {
+                    'sampled': stats.sampled,
+                    'avg_ms': round(stats.total / stats.sampled * 1000, 2),
+                    'max_ms': round(stats.max * 1000, 2),
+                }
+                for name, stats in list(self._stats.items())
+            },
+        }
+
+
+PROFILER = Profiler(
+    sample_rate=PROFILE_SAMPLE_RATE,
+    capture_every=PROFILE_CAPTURE_EVERY,
+    slow_seconds=PROFILE_SLOW_MS / 1000,
+)
+METRICS.describe("bot_profiled_seconds", "Sampled timings of @profiled functions and profile_block sections.")
+profiled = PROFILER.wrap
+profile_block = PROFILER.block
+
+
+# --- Async Supabase (PostgREST) data access ---
+
+class SupabaseError(Exception):
+    """خطأ من PostgREST (استجابة HTTP غير ناجحة)."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+class SupabaseResponse:
+    """نتيجة الاستعلام بنفس شكل استجابة مكتبة supabase (data + count)."""
+
+    __slots__ = ("data", "count")
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _postgrest_value(value) -> str:
+    """تحويل قيمة Python لصيغة فلاتر PostgREST."""
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def _postgrest_list_item(value) -> str:
+    text = _postgrest_value(value)
+    if isinstance(value, str) and any(ch in text for ch in ',()"\\ '):
+        text = '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return text
+
+
+class AsyncQuery:
+    """Builder for one PostgREST request, mirroring the supabase-py fluent API."""
+
+    def __init__(self, client: "AsyncSupabaseClient", path: str):
+        self._client = client
+        self._path = path
+        self._method = "GET"
+        self._params = []
+        self._json = None
+        self._prefer = []
+
+    # --- verbs ---
+    def select(self, columns: str = "*", count: str = None):
+        self._method = "GET"
+        self._params.append(("select", columns.replace(" ", "")))
+        if count:
+            self._prefer.append(f"count={count}")
+        return self
+
+    def insert(self, json, returning: str = "representation"):
+        self._method = "POST"
+        self._json = json
+        self._prefer.append(f"return={returning}")
+        return self
+
+    def upsert(self, json, on_conflict: str = "", returning: str = "representation"):
+        self._method = "POST"
+        self._json = json
+        self._prefer.append("resolution=merge-duplicates")
+        self._prefer.append(f"return={returning}")
+        if on_conflict:
+            self._params.append(("on_conflict", on_conflict))
+        return self
+
+    def update(self, json, returning: str = "representation"):
+        self._method = "PATCH"
+        self._json = json
+        self._prefer.append(f"return={returning}")
+        return self
+
+    # --- filters & modifiers ---
+    def _filter(self, column: str, operator: str, value):
+        self._params.append((column, f"{operator}.{_postgrest_value(value)}"))
+        return self
+
+    def eq(self, column: str, value):
+        return self._filter(column, "eq", value)
+
+    def neq(self, column: str, value):
+        return self._filter(column, "neq", value)
+
+    def gt(self, column: str, value):
+        return self._filter(column, "gt", value)
+
+    def gte(self, column: str, value):
+        return self._filter(column, "gte", value)
+
+    def lt(self, column: str, value):
+        return self._filter(column, "lt", value)
+
+    def lte(self, column: str, value):
+        return self._filter(column, "lte", value)
+
+    def in_(self, column: str, values):
+        items = ",".join(_postgrest_list_item(v) for v in values)
+        self._params.append((column, f"in.({items})"))
+        return self
+
+    def order(self, column: str, desc: bool = False):
+        self._params.append(("order", f"{column}.{'desc' if desc else 'asc'}"))
+        return self
+
+    def limit(self, size: int):
+        self._params.append(("limit", str(size)))
+        return self
+
+    async def execute(self, timeout: float = None) -> SupabaseResponse:
+        return await self._client.request(
+            self._method,
+            self._path,
+            params=self._params,
+            json=self._json,
+            prefer=self._prefer,
+            timeout=timeout,
+        )
+
+
+class AsyncSupabaseClient:
+    """عميل Supabase غير متزامن (PostgREST عبر httpx) يعمل على لوب البوت.
+
+    يستخدم اتصالاً واحداً مشتركاً (keep-alive، و HTTP/2 إذا كانت مكتبة h2 متوفرة)
+    بدلاً من عميل supabase المتزامن و asyncio.to_thread لكل استعلام.
+    """
+
+    def __init__(self, url: str, key: str, timeout: float = DB_TIMEOUT_SECONDS,
+                 max_connections: int = DB_MAX_CONNECTIONS):
+        self.rest_url = url.rstrip("/") + "/rest/v1"
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.http2 = importlib.util.find_spec("h2") is not None
+        self._headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        self._http = None
+
+    def table(self, name: str) -> AsyncQuery:
+        return AsyncQuery(self, f"/{name}")
+
+    def rpc(self, name: str, params: dict = None) -> AsyncQuery:
+        query = AsyncQuery(self, f"/rpc/{name}")
+        query._method = "POST"
+        query._json = params or {}
+        return query
+
+    def _client(self) -> httpx.AsyncClient:
+        # يُنشأ عند أول استخدام حتى يرتبط بلوب البوت نفسه
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.rest_url,
+                headers=self._headers,
+                http2=self.http2,
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self._http
+
+    async def request(self, method: str, path: str, params=None, json=None,
+                      prefer=None, timeout: float = None) -> SupabaseResponse:
+        headers = {"Prefer": ",".join(prefer)} if prefer else None
+        operation = method + " " + path.lstrip("/")
+        started = time.perf_counter()
+        try:
+            response = await self._client().request(
+                method,
+                path,
+                params=params,
+                json=json,
+                headers=headers,
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+            )
+        except Exception:
+            METRICS.inc("bot_db_errors_total", op=operation)
+            raise
+        finally:
+            METRICS.observe("bot_db_request_seconds", time.perf_counter() - started, op=operation)
+        if response.status_code >= 400:
+            METRICS.inc("bot_db_errors_total", op=operation)
+            raise SupabaseError(response.status_code, response.text[:500])
+
+        data = response.json() if response.content else []
+        count = None
+        content_range = response.headers.get("content-range")
+        if content_range and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                count = int(total)
+        return SupabaseResponse(data, count)
+
+    async def warmup(self):
+        """فتح الاتصال مسبقاً (DNS + TLS) بطلب خفيف، حتى لا يدفع أول مستخدم ثمنه."""
+        try:
+            await self.table('questions').select('id').limit(1).execute()
+        except Exception as e:
+            logger.warning("Supabase warmup failed (will connect on first query): %s", e)
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+class StaleWhileRevalidateCache:
+    """كاش لقيمة تجميعية (مثل count) بأسلوب stale-while-revalidate.
+
+    - القيمة الموجودة تُرجع فوراً حتى لو انتهت صلاحيتها، ويبدأ تحديث واحد فقط في الخلفية.
+    - أول طلب (بدون قيمة) ينتظر نفس التحميل المشترك (single-flight).
+    - عند الخطأ نحتفظ بآخر قيمة سليمة ونعيد المحاولة بعد error_backoff.
+    كل الاستخدام على لوب البوت، فلا حاجة لأقفال.
+    """
+
+    def __init__(self, name: str, loader, ttl: float, default=None, error_backoff: float = 10.0):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.default = default
+        self.error_backoff = error_backoff
+        self._value = default
+        self._has_value = False
+        self._expires_at = 0.0
+        self._refresh_task = None
+        # Metrics
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def peek(self):
+        """آخر قيمة معروفة بدون أي تحميل (آمن من أي ثريد)."""
+        return self._value
+
+    async def get(self):
+        if self._has_value:
+            if time.time() >= self._expires_at:
+                self.stale_hits += 1
+                self._start_refresh()
+            else:
+                self.hits += 1
+            return self._value
+
+        self.misses += 1
+        await asyncio.shield(self._start_refresh())
+        return self._value
+
+    def invalidate(self):
+        """اعتبار القيمة منتهية (التحديث يبدأ مع الطلب التالي)."""
+        self._expires_at = 0.0
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def _refresh(self):
+        try:
+            value = await self.loader()
+        except Exception as e:
+            self.errors += 1
+            self._expires_at = time.time() + self.error_backoff
+            logger.error("Could not refresh %s (keeping last value %s): %s", self.name, self._value, e)
+            return
+        finally:
+            self._refresh_task = None
+        self._value = value
+        self._has_value = True
+        self._expires_at = time.time() + self.ttl
+        self.refreshes += 1
+
+    def stats(self) -> dict:
+        return {
+            'value': self._value,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+        }
+
+
+@profiled
+async def check_user_exists(telegram_id: int):
+    """التحقق من وجود المستخدم: من فهرس المستخدمين في الذاكرة، و DB فقط عند عدم وجوده."""
+    return await KNOWN_USERS.exists(telegram_id)
+
+@single_flight
+async def _db_user_exists(telegram_id: int):
     """التحقق من وجود المستخدم في قاعدة البيانات (بدون تنزيل صفوف)."""
     try:
-        response = supabase.table('target_users').select('telegram_id', count='exact').eq('telegram_id', telegram_id).limit(1).execute()
+        response = await supabase.table('target_users').select('telegram_id', count='exact').eq('telegram_id', telegram_id).limit(1).execute()
         count_val = getattr(response, 'count', None)
         if count_val is not None:
             return count_val > 0
@@ -123,8 +1040,8 @@ def check_user_exists(telegram_id: int):
         # في حالة فشل الاتصال، نفترض أن المستخدم جديد
         return False
 
-@time_it_sync
-def save_user_data(telegram_id: int, username: str, first_name: str, last_name: str, phone_number: str, language_code: str):
+@profiled
+async def save_user_data(telegram_id: int, username: str, first_name: str, last_name: str, phone_number: str, language_code: str):
     """حفظ أو تحديث بيانات المستخدم في قاعدة البيانات (upsert)"""
     try:
         user_data = {
@@ -138,129 +1055,1196 @@ def save_user_data(telegram_id: int, username: str, first_name: str, last_name:
             'last_interaction': 'now()'
         }
         
-        supabase.table('target_users').upsert(user_data, on_conflict='telegram_id').execute()
-        logger.info("User saved/updated successfully: %s", telegram_id)
+        await supabase.table('target_users').upsert(user_data, on_conflict='telegram_id').execute()
+        KNOWN_USERS.add(telegram_id)
+        logger.info("User saved/updated successfully: %s", telegram_id, extra=DB_LOG)
         return True
     except Exception as e:
         logger.warning("Could not save user data for telegram_id %s: %s", telegram_id, e)
         # في حالة فشل الحفظ، نسمح للمستخدم بالمتابعة
         return True
 
-@time_it_sync
-def update_last_interaction(telegram_id: int):
-    """تحديث آخر تفاعل للمستخدم"""
+@profiled
+async def save_last_interactions(groups: dict):
+    """كتابة آخر تفاعل لمجموعة مستخدمين: {timestamp: [telegram_id, ...]}"""
     if not supabase:
-        return
+        return False
     
     try:
-        supabase.table('target_users').update({'last_interaction': 'now()'}).eq('telegram_id', telegram_id).execute()
-    except Exception as e:
-        logger.warning("Could not update last interaction for telegram_id %s: %s", telegram_id, e)
-        # لا نوقف البوت بسبب فشل تحديث آخر تفاعل
-
-@time_it_sync
-def save_user_answer(telegram_id: int, question_id: int, selected_answer: str, correct_answer: str, is_correct: bool):
-    """حفظ إجابة المستخدم في قاعدة البيانات"""
-    try:
-        answer_data = {
-            'user_id': telegram_id,
-            'question_id': question_id,
-            'selected_answer': selected_answer,
-            'correct_answer': correct_answer,
-            'is_correct': is_correct,
-            'answered_at': 'now()'
-        }
-        
-        response = supabase.table('user_answers_bot').insert(answer_data).execute()
-        logger.info("User answer saved: User %s, Question %s, Correct: %s", telegram_id, question_id, is_correct)
+        for ts, telegram_ids in groups.items():
+            value = datetime.fromtimestamp(ts, timezone.utc).isoformat()
+            for i in range(0, len(telegram_ids), LAST_SEEN_CHUNK_SIZE):
+                chunk = telegram_ids[i:i + LAST_SEEN_CHUNK_SIZE]
+                await supabase.table('target_users').update({'last_interaction': value}, returning='minimal').in_('telegram_id', chunk).execute()
         return True
     except Exception as e:
-        logger.warning("Could not save user answer for telegram_id %s: %s", telegram_id, e)
+        logger.warning("Could not update last interaction for %s users: %s", sum(len(ids) for ids in groups.values()), e)
+        # لا نوقف البوت بسبب فشل تحديث آخر تفاعل
         return False
 
-@time_it_sync
-def get_user_stats(telegram_id: int):
-    """جلب إحصائيات المستخدم - محسّن للسرعة باستخدام count"""
-    try:
-        # ✅ جلب العدد الكلي باستخدام count (سريع حتى مع 50 ألف سؤال!)
-        total_resp = supabase.table('user_answers_bot').select('id', count='exact').eq('user_id', telegram_id).limit(1).execute()
-        total_answers = total_resp.count or 0
-        
-        # ✅ جلب عدد الإجابات الصحيحة فقط باستخدام count
-        correct_resp = supabase.table('user_answers_bot').select('id', count='exact').eq('user_id', telegram_id).eq('is_correct', True).limit(1).execute()
-        correct_answers = correct_resp.count or 0
-        
-        accuracy = (correct_answers / total_answers) * 100 if total_answers > 0 else 0
-        logger.info("User %s stats: %s total, %s correct, %s%% accuracy", telegram_id, total_answers, correct_answers, round(accuracy, 1))
-        
+
+class LastSeenTracker:
+    """تتبع آخر تفاعل لكل مستخدم في الذاكرة وكتابته دورياً دفعة واحدة.
+
+    يحتفظ فقط بأحدث وقت لكل telegram_id، وعند التفريغ يجمع المستخدمين حسب
+    الدقيقة (LAST_SEEN_RESOLUTION) ويكتب كل مجموعة بطلب update واحد.
+    """
+
+    def __init__(self, flush_interval: float, resolution: int):
+        self.flush_interval = flush_interval
+        self.resolution = resolution
+        self._dirty = {}
+        self._task = None
+        # Metrics
+        self.touches = 0
+        self.written_users = 0
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.last_flush_seconds = 0.0
+
+    def touch(self, telegram_id: int, ts: float = None):
+        """تسجيل تفاعل (عملية في الذاكرة فقط، بدون أي طلب لقاعدة البيانات)."""
+        self.touches += 1
+        ts = ts or time.time()
+        if ts > self._dirty.get(telegram_id, 0):
+            self._dirty[telegram_id] = ts
+
+    async def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Last-seen flush crashed: %s", e, exc_info=True)
+
+    async def flush(self):
+        """كتابة المستخدمين المتغيّرين منذ آخر تفريغ."""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        groups = {}
+        for telegram_id, ts in dirty.items():
+            bucket = int(ts // self.resolution) * self.resolution
+            groups.setdefault(bucket, []).append(telegram_id)
+
+        started = time.perf_counter()
+        ok = await save_last_interactions(groups)
+        self.last_flush_seconds = time.perf_counter() - started
+        self.flush_count += 1
+        if ok:
+            self.written_users += len(dirty)
+            return
+        # فشل الكتابة → نرجع القيم للمجموعة المتسخة (بدون الكتابة فوق الأحدث)
+        self.failed_flushes += 1
+        for telegram_id, ts in dirty.items():
+            if ts > self._dirty.get(telegram_id, 0):
+                self._dirty[telegram_id] = ts
+
+    def stats(self) -> dict:
         return {
-            'total_answers': total_answers,
-            'correct_answers': correct_answers,
-            'accuracy': round(accuracy, 1)
+            'dirty_users': len(self._dirty),
+            'touches': self.touches,
+            'written_users': self.written_users,
+            'flushes': self.flush_count,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_ms': round(self.last_flush_seconds * 1000, 1),
         }
-    except Exception as e:
-        logger.warning("Could not fetch user stats for telegram_id %s: %s", telegram_id, e)
-        return {'total_answers': 0, 'correct_answers': 0, 'accuracy': 0}
 
-@time_it_sync
-def get_user_answered_questions(telegram_id: int):
-    """جلب الأسئلة التي أجاب عليها المستخدم (بدون head)."""
+
+LAST_SEEN = LastSeenTracker(flush_interval=LAST_SEEN_FLUSH_INTERVAL, resolution=LAST_SEEN_RESOLUTION)
+
+
+def update_last_interaction(telegram_id: int):
+    """تحديث آخر تفاعل للمستخدم (في الذاكرة، ويُكتب دورياً عبر LAST_SEEN)"""
+    LAST_SEEN.touch(telegram_id)
+
+def build_answer_row(telegram_id: int, question_id: int, selected_answer: str, correct_answer: str, is_correct: bool):
+    """تجهيز صف إجابة المستخدم (وقت الإجابة الفعلي وليس وقت الحفظ)"""
+    return {
+        'user_id': telegram_id,
+        'question_id': question_id,
+        'selected_answer': selected_answer,
+        'correct_answer': correct_answer,
+        'is_correct': is_correct,
+        'answered_at': datetime.now(timezone.utc).isoformat(),
+        # نفس المفاتيح في كل الصفوف (شرط bulk insert) - البلاغ قد يُضاف والصف ما زال في الطابور
+        'is_reported': False,
+        'report_reason': None,
+    }
+
+@profiled
+async def save_user_answers(rows: list):
+    """حفظ مجموعة إجابات في قاعدة البيانات بطلب insert واحد"""
+    if not rows:
+        return True
     try:
-        response = supabase.table('user_answers_bot').select('question_id').eq('user_id', telegram_id).execute()
-        rows = response.data or []
-        logger.info("User %s answered %s questions", telegram_id, len(rows))
-        return [answer['question_id'] for answer in rows if 'question_id' in answer]
+        await supabase.table('user_answers_bot').insert(rows, returning='minimal').execute()
+        logger.info("Saved %s user answers in one batch", len(rows), extra=DB_LOG)
+        return True
     except Exception as e:
-        logger.warning("Could not fetch user answers for telegram_id %s: %s", telegram_id, e)
-        return []
+        logger.warning("Could not save batch of %s user answers: %s", len(rows), e)
+        return False
 
-@time_it_sync
-def get_total_questions_count():
-    """جلب عدد الأسئلة الكلي (فقط correct) مع كاش بسيط لمدة 60 ثانية."""
-    now = time.time()
 
-    # لو عندنا قيمة كاش وما عدا عليها أكثر من TOTAL_TTL → رجّعها مباشرة
-    if TOTAL_QUESTIONS_CACHE["value"] is not None and now - TOTAL_QUESTIONS_CACHE["ts"] < TOTAL_TTL:
-        return TOTAL_QUESTIONS_CACHE["value"]
+class AnswerWriteBehind:
+    """طابور كتابة مؤجلة (write-behind) لإجابات المستخدمين.
 
-    try:
-        resp = (
-            supabase.table('questions')
-            .select('id', count='exact')
-            .eq('ai_review_status', 'correct')  # مهم: فقط الأسئلة الـ correct
-            .limit(1)
-            .execute()
+    يجمع الإجابات في الذاكرة ويحفظها كـ bulk insert عند امتلاء الدفعة أو مرور
+    ANSWER_FLUSH_INTERVAL، ويوقف المعالج (backpressure) عند امتلاء الطابور.
+    كل العمليات تعمل على لوب البوت.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_size: int, max_retries: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self._buffer = []
+        self._inflight = []  # دفعات قيد الكتابة
+        self._batch_ready = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._flush_lock = asyncio.Lock()
+        self._written = asyncio.Condition()  # يُنبَّه عند انتهاء كتابة أي دفعة
+        self._task = None
+        self._closing = False
+        # Metrics
+        self.enqueued_rows = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.backpressure_waits = 0
+        self.flush_count = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """تشغيل مهمة التفريغ الدوري على اللوب الحالي."""
+        if self.running:
+            return
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+        logger.info(
+            "Answer write-behind started (batch=%s, interval=%ss, max=%s)",
+            self.batch_size, self.flush_interval, self.max_size,
         )
-        if hasattr(resp, 'count') and resp.count is not None:
-            TOTAL_QUESTIONS_CACHE["value"] = resp.count
-            TOTAL_QUESTIONS_CACHE["ts"] = now
-            return resp.count
-
-        val = len(resp.data or [])
-        TOTAL_QUESTIONS_CACHE["value"] = val
-        TOTAL_QUESTIONS_CACHE["ts"] = now
-        return val
-    except Exception as e:
-        logger.error("Could not get total questions count (fallback): %s", e)
-        # لو صار خطأ، رجّع آخر قيمة معروفة أو 0
-        return TOTAL_QUESTIONS_CACHE["value"] or 0
 
-@time_it_sync
-def fetch_random_question(telegram_id: int = None, answered_ids: list = None):
-    """جلب سؤال عشوائي من قاعدة البيانات باستخدام RPC مع استثناء المجاب عليها."""
-    try:
-        # ✅ استخدام RPC الجديد الأسرع - يستثني المجاب عليها داخل DB
-        if telegram_id:
-            # RPC جديد يستثني المجاب عليها داخلياً بدون إرسال arrays ضخمة
-            response = supabase.rpc("get_random_question_for_user", {"p_user_id": telegram_id}).execute()
-        else:
-            # Fallback للـ RPC القديم (للحالات النادرة بدون user_id)
+    async def stop(self):
+        """إيقاف المهمة بعد تفريغ كل الإجابات المتبقية."""
+        task = self._task
+        if task is None:
+            return
+        self._closing = True
+        self._batch_ready.set()
+        await task
+        self._task = None
+        logger.info("Answer write-behind stopped (flushed=%s, failed=%s)", self.flushed_rows, self.failed_rows)
+
+    async def put(self, row: dict):
+        """إضافة إجابة للطابور، مع الانتظار إذا كان الطابور ممتلئاً."""
+        if not self.running or self._closing:
+            # الطابور غير شغال (قبل التهيئة أو أثناء الإيقاف) → حفظ مباشر
+            await self._write([row])
+            return
+        while len(self._buffer) >= self.max_size:
+            self.backpressure_waits += 1
+            self._not_full.clear()
+            await self._not_full.wait()
+        self._buffer.append(row)
+        self.enqueued_rows += 1
+        if len(self._buffer) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self):
+        """تفريغ كل ما في الطابور الآن (وانتظار أي دفعة جارية)."""
+        async with self._flush_lock:
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                self._not_full.set()
+                await self._write(batch)
+
+    async def _run(self):
+        while True:
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Answer write-behind flush crashed: %s", e, exc_info=True)
+            if self._closing and not self._buffer:
+                return
+
+    async def _write(self, batch: list):
+        self._inflight.append(batch)
+        try:
+            for attempt in range(1, self.max_retries + 1):
+                started = time.perf_counter()
+                ok = await save_user_answers(batch)
+                self._record_flush(time.perf_counter() - started)
+                if ok:
+                    self.flushed_rows += len(batch)
+                    return
+                if attempt < self.max_retries:
+                    await asyncio.sleep(0.5 * attempt)
+            self.failed_rows += len(batch)
+            logger.error("Dropping %s answers after %s failed flush attempts", len(batch), self.max_retries)
+        finally:
+            self._inflight.remove(batch)
+            async with self._written:
+                self._written.notify_all()
+
+    async def report(self, telegram_id: int, question_id: int, reason: str) -> bool:
+        """تسجيل بلاغ على صف إجابة هذا المستخدم فقط، بدون تفريغ الطابور كله.
+
+        True إذا كان الصف ما زال في الطابور (يُكتب البلاغ مع نفس الـ insert).
+        إذا كان في دفعة جارية ننتظر تلك الدفعة وحدها، ثم False ليُحدَّث الصف في قاعدة البيانات.
+        """
+        def matches(row):
+            return row.get('user_id') == telegram_id and row.get('question_id') == question_id
+
+        for row in reversed(self._buffer):
+            if matches(row):
+                row['is_reported'] = True
+                row['report_reason'] = reason
+                return True
+        batch = next((b for b in self._inflight if any(matches(row) for row in b)), None)
+        if batch is not None:
+            async with self._written:
+                await self._written.wait_for(lambda: all(b is not batch for b in self._inflight))
+        return False
+
+    def _pending_rows(self, telegram_id: int):
+        for batch in (self._buffer, *self._inflight):
+            for row in batch:
+                if row.get('user_id') == telegram_id:
+                    yield row
+
+    def pending_question_ids(self, telegram_id: int) -> set:
+        """معرفات الأسئلة التي أجاب عليها المستخدم وما زالت في الطابور."""
+        return {row['question_id'] for row in self._pending_rows(telegram_id)}
+
+    def pending_counts(self, telegram_id: int):
+        """(total, correct) لإجابات المستخدم التي لم تصل لقاعدة البيانات بعد."""
+        total = correct = 0
+        for row in self._pending_rows(telegram_id):
+            total += 1
+            if row.get('is_correct'):
+                correct += 1
+        return total, correct
+
+    def _record_flush(self, elapsed: float):
+        self.flush_count += 1
+        self.last_flush_seconds = elapsed
+        self.total_flush_seconds += elapsed
+        if elapsed > self.max_flush_seconds:
+            self.max_flush_seconds = elapsed
+
+    def stats(self) -> dict:
+        """Queue depth and flush latency for /health."""
+        avg = self.total_flush_seconds / self.flush_count if self.flush_count else 0.0
+        return {
+            'running': self.running,
+            'queue_depth': len(self._buffer),
+            'inflight': sum(len(batch) for batch in self._inflight),
+            'queue_max': self.max_size,
+            'enqueued_rows': self.enqueued_rows,
+            'flushed_rows': self.flushed_rows,
+            'failed_rows': self.failed_rows,
+            'backpressure_waits': self.backpressure_waits,
+            'flushes': self.flush_count,
+            'last_flush_ms': round(self.last_flush_seconds * 1000, 1),
+            'avg_flush_ms': round(avg * 1000, 1),
+            'max_flush_ms': round(self.max_flush_seconds * 1000, 1),
+        }
+
+
+ANSWER_WRITER = AnswerWriteBehind(
+    batch_size=ANSWER_BATCH_SIZE,
+    flush_interval=ANSWER_FLUSH_INTERVAL,
+    max_size=ANSWER_QUEUE_MAX,
+    max_retries=ANSWER_FLUSH_MAX_RETRIES,
+)
+
+@single_flight
+@profiled
+async def count_user_answers(telegram_id: int):
+    """(total, correct) من قاعدة البيانات باستخدام count - الاستعلامان بالتوازي."""
+    total_resp, correct_resp = await asyncio.gather(
+        supabase.table('user_answers_bot').select('id', count='exact').eq('user_id', telegram_id).limit(1).execute(),
+        supabase.table('user_answers_bot').select('id', count='exact').eq('user_id', telegram_id).eq('is_correct', True).limit(1).execute(),
+    )
+    return total_resp.count or 0, correct_resp.count or 0
+
+@single_flight
+@profiled
+async def get_user_stats(telegram_id: int):
+    """جلب إحصائيات المستخدم - محسّن للسرعة باستخدام count"""
+    try:
+        total_answers, correct_answers = await count_user_answers(telegram_id)
+        
+        accuracy = (correct_answers / total_answers) * 100 if total_answers > 0 else 0
+        logger.info("User %s stats: %s total, %s correct, %s%% accuracy", telegram_id, total_answers, correct_answers, round(accuracy, 1), extra=DB_LOG)
+        
+        return {
+            'total_answers': total_answers,
+            'correct_answers': correct_answers,
+            'accuracy': round(accuracy, 1)
+        }
+    except Exception as e:
+        logger.warning("Could not fetch user stats for telegram_id %s: %s", telegram_id, e)
+        return {'total_answers': 0, 'correct_answers': 0, 'accuracy': 0}
+
+@single_flight
+@profiled
+async def fetch_answered_question_ids(telegram_id: int, after_id: int = 0):
+    """جلب معرفات الأسئلة المجاب عليها على صفحات (id > after_id).
+
+    ترجع (question_ids, last_answer_id) حتى يمكن متابعة التحميل لاحقاً من نفس المؤشر.
+    """
+    question_ids = []
+    cursor = after_id
+    while True:
+        response = await (
+            supabase.table('user_answers_bot')
+            .select('id, question_id')
+            .eq('user_id', telegram_id)
+            .gt('id', cursor)
+            .order('id')
+            .limit(DB_PAGE_SIZE)
+            .execute()
+        )
+        rows = response.data or []
+        for row in rows:
+            question_id = row.get('question_id')
+            if question_id is not None:
+                question_ids.append(question_id)
+        if rows:
+            cursor = rows[-1]['id']
+        if len(rows) < DB_PAGE_SIZE:
+            return question_ids, cursor
+
+@single_flight
+@profiled
+async def get_user_answered_questions(telegram_id: int):
+    """جلب الأسئلة التي أجاب عليها المستخدم (كل الصفحات)."""
+    try:
+        question_ids, _ = await fetch_answered_question_ids(telegram_id)
+        logger.info("User %s answered %s questions", telegram_id, len(question_ids), extra=DB_LOG)
+        return question_ids
+    except Exception as e:
+        logger.warning("Could not fetch user answers for telegram_id %s: %s", telegram_id, e)
+        return []
+
+@single_flight
+async def _count_rows(table: str, column: str, **filters) -> int:
+    """عدد الصفوف باستخدام count='exact' بدون تنزيل الصفوف."""
+    query = supabase.table(table).select(column, count='exact')
+    for key, value in filters.items():
+        query = query.eq(key, value)
+    resp = await query.limit(1).execute()
+    if resp.count is not None:
+        return resp.count
+    return len(resp.data or [])
+
+@profiled
+async def _load_total_questions_count():
+    # مهم: فقط الأسئلة الـ correct
+    return await _count_rows('questions', 'id', ai_review_status='correct')
+
+@profiled
+async def _load_users_count():
+    return await _count_rows('target_users', 'telegram_id')
+
+@profiled
+async def _load_answers_count():
+    return await _count_rows('user_answers_bot', 'id')
+
+def _shared_loader(name: str, loader, ttl: float):
+    """تغليف loader بحيث تُشارك النتيجة بين النسخ عبر SHARED_CACHE (نسخة واحدة تستعلم DB)."""
+    async def load():
+        value = await SHARED_CACHE.get("aggregates", name)
+        if value is None:
+            value = await loader()
+            await SHARED_CACHE.set("aggregates", name, value, ttl=ttl)
+        return value
+    return load
+
+TOTAL_QUESTIONS_CACHE = StaleWhileRevalidateCache(
+    "total_questions", _shared_loader("total_questions", _load_total_questions_count, TOTAL_TTL), ttl=TOTAL_TTL, default=0)
+USERS_COUNT_CACHE = StaleWhileRevalidateCache(
+    "users_count", _shared_loader("users_count", _load_users_count, AGGREGATE_TTL), ttl=AGGREGATE_TTL, default=0)
+ANSWERS_COUNT_CACHE = StaleWhileRevalidateCache(
+    "answers_count", _shared_loader("answers_count", _load_answers_count, AGGREGATE_TTL), ttl=AGGREGATE_TTL, default=0)
+
+async def get_total_questions_count():
+    """جلب عدد الأسئلة الكلي (فقط correct) - يرجع فوراً من الكاش ويحدّثه في الخلفية."""
+    return await TOTAL_QUESTIONS_CACHE.get()
+
+class QuestionPool:
+    """نسخة في الذاكرة من الأسئلة المعتمدة (ai_review_status='correct').
+
+    تُحمّل كاملة عند التشغيل، ثم تُحدّث تدريجياً (الأسئلة الجديدة id > آخر id)
+    مع إعادة تحميل كاملة كل QUESTION_POOL_FULL_REFRESH لالتقاط الحذف والتعديل.
+    """
+
+    def __init__(self, refresh_interval: float, full_refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self._questions = {}
+        self._ids = []
+        self._max_id = 0
+        self._full_loaded_at = 0.0
+        self._task = None
+        self._refresh_lock = asyncio.Lock()
+        # Metrics
+        self.local_picks = 0
+        self.rpc_fallbacks = 0
+        self.refresh_count = 0
+        self.last_refresh_seconds = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return bool(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get(self, question_id: int):
+        return self._questions.get(question_id)
+
+    async def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Question pool refresh failed: %s", e)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def _load_after(self, after_id: int) -> list:
+        rows = []
+        cursor = after_id
+        while True:
+            response = await (
+                supabase.table('questions')
+                .select(QUESTION_COLUMNS)
+                .eq('ai_review_status', 'correct')
+                .gt('id', cursor)
+                .order('id')
+                .limit(DB_PAGE_SIZE)
+                .execute()
+            )
+            page = response.data or []
+            rows.extend(page)
+            if page:
+                cursor = page[-1]['id']
+            if len(page) < DB_PAGE_SIZE:
+                return rows
+
+    async def refresh(self, full: bool = False):
+        """تحديث الأسئلة (تدريجي أو كامل)."""
+        async with self._refresh_lock:
+            started = time.perf_counter()
+            full = full or not self.ready or time.time() - self._full_loaded_at > self.full_refresh_interval
+            if full:
+                rows = await self._load_after(0)
+                questions = {row['id']: row for row in rows if row.get('id') is not None}
+                self._questions = questions
+                self._ids = sorted(questions)
+                self._full_loaded_at = time.time()
+                RENDER_CACHE.clear()  # نصوص الأسئلة قد تكون تعدّلت
+            else:
+                rows = await self._load_after(self._max_id)
+                for row in rows:
+                    question_id = row.get('id')
+                    if question_id is not None and question_id not in self._questions:
+                        self._questions[question_id] = row
+                        self._ids.append(question_id)
+            if self._ids:
+                self._max_id = self._ids[-1]
+            self.refresh_count += 1
+            self.last_refresh_seconds = time.perf_counter() - started
+            if full or rows:
+                logger.info(
+                    "Question pool %s refresh: %s questions (+%s) in %.3fs",
+                    "full" if full else "incremental", len(self._ids), len(rows), self.last_refresh_seconds,
+                )
+
+    def sample(self, is_answered, count: int, exclude_ids=None) -> list:
+        """اختيار حتى count أسئلة عشوائية مختلفة، غير مجاب عليها وغير مستثناة (محلياً بدون قاعدة البيانات)."""
+        ids = self._ids
+        if not ids or count <= 0:
+            return []
+        exclude_ids = exclude_ids or ()
+        chosen = []
+        chosen_ids = set()
+        # أغلب المستخدمين أجابوا على جزء صغير → محاولات عشوائية سريعة أولاً
+        for _ in range(QUESTION_POOL_RANDOM_TRIES * count):
+            if len(chosen) >= count:
+                return chosen
+            question_id = random.choice(ids)
+            if question_id in chosen_ids or question_id in exclude_ids or is_answered(question_id):
+                continue
+            chosen_ids.add(question_id)
+            chosen.append(self._questions[question_id])
+        if len(chosen) < count:
+            candidates = [
+                qid for qid in ids
+                if qid not in chosen_ids and qid not in exclude_ids and not is_answered(qid)
+            ]
+            for question_id in random.sample(candidates, min(count - len(chosen), len(candidates))):
+                chosen.append(self._questions[question_id])
+        return chosen
+
+    def pick(self, is_answered, exclude_ids=None):
+        """اختيار سؤال عشوائي واحد غير مجاب عليه وغير مستثنى."""
+        chosen = self.sample(is_answered, 1, exclude_ids)
+        return chosen[0] if chosen else None
+
+    def stats(self) -> dict:
+        return {
+            'questions': len(self._ids),
+            'max_id': self._max_id,
+            'local_picks': self.local_picks,
+            'rpc_fallbacks': self.rpc_fallbacks,
+            'refreshes': self.refresh_count,
+            'last_refresh_ms': round(self.last_refresh_seconds * 1000, 1),
+        }
+
+
+class AnsweredSet:
+    """مجموعة مضغوطة لمعرفات الأسئلة المجاب عليها لمستخدم واحد.
+
+    تبدأ كمصفوفة أعداد مرتبة (array) وتتحول إلى bitmap عندما يصبح الـ bitmap
+    أصغر (كثير من الإجابات). مستخدم أجاب على 20 ألف سؤال ≈ بضعة KB.
+    """
+
+    __slots__ = ("_sorted", "_bits", "count", "cursor", "synced_at")
+
+    def __init__(self):
+        self._sorted = array('I')
+        self._bits = None
+        self.count = 0
+        self.cursor = 0  # آخر user_answers_bot.id تمت مزامنته
+        self.synced_at = 0.0
+
+    def __contains__(self, question_id) -> bool:
+        if self._bits is not None:
+            index = question_id >> 3
+            return index < len(self._bits) and bool(self._bits[index] & (1 << (question_id & 7)))
+        position = bisect_left(self._sorted, question_id)
+        return position < len(self._sorted) and self._sorted[position] == question_id
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, question_id: int):
+        if question_id is None or question_id < 0:
+            return
+        if self._bits is not None:
+            index = question_id >> 3
+            if index >= len(self._bits):
+                self._bits.extend(bytes(index + 1 - len(self._bits)))
+            mask = 1 << (question_id & 7)
+            if not self._bits[index] & mask:
+                self._bits[index] |= mask
+                self.count += 1
+            return
+        position = bisect_left(self._sorted, question_id)
+        if position < len(self._sorted) and self._sorted[position] == question_id:
+            return
+        self._sorted.insert(position, question_id)
+        self.count += 1
+        # التحويل إلى bitmap عندما يصبح أصغر من المصفوفة (بعد عدد معقول من الإجابات)
+        if self.count >= 64 and self.count * self._sorted.itemsize > (self._sorted[-1] >> 3) + 1:
+            self._to_bitmap()
+
+    def update(self, question_ids):
+        for question_id in question_ids:
+            self.add(question_id)
+
+    def _to_bitmap(self):
+        bits = bytearray((self._sorted[-1] >> 3) + 1)
+        for question_id in self._sorted:
+            bits[question_id >> 3] |= 1 << (question_id & 7)
+        self._bits = bits
+        self._sorted = array('I')
+
+    @property
+    def nbytes(self) -> int:
+        if self._bits is not None:
+            return len(self._bits)
+        return len(self._sorted) * self._sorted.itemsize
+
+
+class AnsweredIdCache:
+    """كاش LRU لمجموعات الأسئلة المجاب عليها لكل مستخدم.
+
+    تُحمّل عند الحاجة في الخلفية، وتُحدّث مع كل إجابة، وتُزامن تدريجياً من
+    قاعدة البيانات (id > cursor) كل ANSWERED_SYNC_INTERVAL، مع حد أقصى للذاكرة.
+    """
+
+    def __init__(self, max_bytes: int, max_users: int, sync_interval: float):
+        self.max_bytes = max_bytes
+        self.max_users = max_users
+        self.sync_interval = sync_interval
+        self._sets = OrderedDict()
+        self._loading = {}
+        self._pending = {}
+        self._bytes = 0
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, telegram_id: int):
+        """ترجع AnsweredSet للمستخدم، أو None إذا لم تُحمّل بعد."""
+        answered = self._sets.get(telegram_id)
+        if answered is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._sets.move_to_end(telegram_id)
+        if time.time() - answered.synced_at > self.sync_interval:
+            self.schedule_load(telegram_id)
+        return answered
+
+    def peek(self, telegram_id: int):
+        """مثل get بدون عدادات أو مزامنة (للتحقق فقط)."""
+        return self._sets.get(telegram_id)
+
+    def add(self, telegram_id: int, question_id: int):
+        answered = self._sets.get(telegram_id)
+        if answered is not None:
+            before = answered.nbytes
+            answered.add(question_id)
+            self._bytes += answered.nbytes - before
+            self._evict()
+        elif telegram_id in self._loading:
+            self._pending.setdefault(telegram_id, set()).add(question_id)
+
+    def invalidate(self, telegram_id: int):
+        """نسخة أخرى سجّلت إجابات لهذا المستخدم → مزامنة تدريجية فورية بدل انتظار ANSWERED_SYNC_INTERVAL."""
+        if telegram_id in self._sets:
+            self.invalidations += 1
+            self.schedule_load(telegram_id)
+
+    def schedule_load(self, telegram_id: int):
+        """تحميل (أو مزامنة تدريجية) مجموعة المستخدم في الخلفية، مرة واحدة في نفس الوقت."""
+        if telegram_id in self._loading:
+            return
+        self._loading[telegram_id] = asyncio.create_task(self._load(telegram_id))
+
+    async def _load(self, telegram_id: int):
+        existing = self._sets.get(telegram_id)
+        cursor = existing.cursor if existing is not None else 0
+        try:
+            question_ids, cursor = await fetch_answered_question_ids(telegram_id, after_id=cursor)
+        except Exception as e:
+            logger.warning("Could not load answered ids for user %s: %s", telegram_id, e)
+            self._pending.pop(telegram_id, None)
+            if existing is not None:
+                existing.synced_at = time.time()  # لا نعيد المحاولة فوراً
+            return
+        finally:
+            self._loading.pop(telegram_id, None)
+
+        answered = self._sets.get(telegram_id)
+        if answered is None:
+            answered = AnsweredSet()
+            self._sets[telegram_id] = answered
+        before = answered.nbytes
+        answered.update(question_ids)
+        answered.update(self._pending.pop(telegram_id, ()))
+        # إجابات لم تُحفظ بعد في قاعدة البيانات (ما زالت في طابور الكتابة)
+        answered.update(ANSWER_WRITER.pending_question_ids(telegram_id))
+        answered.cursor = max(answered.cursor, cursor)
+        answered.synced_at = time.time()
+        self._bytes += answered.nbytes - before
+        self._sets.move_to_end(telegram_id)
+        self._evict()
+
+    def _evict(self):
+        while self._sets and (self._bytes > self.max_bytes or len(self._sets) > self.max_users):
+            _, answered = self._sets.popitem(last=False)
+            self._bytes -= answered.nbytes
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._sets),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'loading': len(self._loading),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+QUESTION_POOL = QuestionPool(
+    refresh_interval=QUESTION_POOL_REFRESH_INTERVAL,
+    full_refresh_interval=QUESTION_POOL_FULL_REFRESH,
+)
+class KnownUserIndex:
+    """فهرس telegram_id للمستخدمين المسجلين (array مرتبة 8 بايت لكل مستخدم + set للإضافات الحديثة).
+
+    يُحمّل في الخلفية عند التشغيل ثم يُحدّث تدريجياً (id > آخر id في target_users)،
+    مع إعادة تحميل كاملة كل KNOWN_USERS_FULL_REFRESH لالتقاط ما فات المؤشر (معاملات
+    تُثبَّت بترتيب مختلف عن id). إذا لم يكن id عموداً رقمياً تُستخدم إعادة التحميل الكاملة فقط.
+    ويُضاف له مباشرة من save_user_data. قاعدة البيانات تُسأل فقط عند عدم وجود المستخدم.
+    """
+
+    MERGE_THRESHOLD = 1024  # دمج الإضافات الحديثة في المصفوفة المرتبة
+
+    def __init__(self, refresh_interval: float, full_refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self._sorted = array('q')
+        self._recent = set()
+        self._cursor = 0
+        self._incremental = True  # target_users.id رقمي ومتزايد (يُتحقق منه في كل تحميل كامل)
+        self._full_loaded_at = 0.0
+        self._loaded = False
+        self._merged_during_load = None  # ما دُمج في المصفوفة القديمة أثناء تحميل كامل
+        self._task = None
+        # Metrics
+        self.hits = 0
+        self.db_checks = 0
+        self.refresh_count = 0
+        self.full_refresh_count = 0
+        self.last_refresh_seconds = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def __contains__(self, telegram_id: int) -> bool:
+        if telegram_id in self._recent:
+            return True
+        ids = self._sorted
+        i = bisect_left(ids, telegram_id)
+        return i < len(ids) and ids[i] == telegram_id
+
+    def add(self, telegram_id: int):
+        if telegram_id not in self:
+            self._recent.add(telegram_id)
+            if len(self._recent) >= self.MERGE_THRESHOLD:
+                self._merge_recent()
+
+    def _merge_recent(self):
+        recent, self._recent = self._recent, set()
+        self._merge(recent)
+
+    def _merge(self, new_ids):
+        """دمج معرفات جديدة فقط: نسخ شرائح المصفوفة بين مواقع الإدراج (bisect) بدون set لكل المستخدمين."""
+        ids = self._sorted
+        merged = array('q')
+        start = 0
+        for telegram_id in sorted(set(new_ids)):
+            i = bisect_left(ids, telegram_id, start)
+            merged.extend(ids[start:i])
+            start = i
+            if i < len(ids) and ids[i] == telegram_id:
+                continue  # موجود أصلاً - يُنسخ مع الشريحة التالية
+            merged.append(telegram_id)
+        merged.extend(ids[start:])
+        self._sorted = merged
+        if self._merged_during_load is not None:
+            self._merged_during_load.extend(new_ids)
+
+    async def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Known-user index refresh failed: %s", e)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def _load_all(self) -> int:
+        """تحميل كامل مرتب حسب telegram_id (الصفحات تُضاف للمصفوفة مباشرة بدون ترتيب)."""
+        self._merged_during_load = []
+        try:
+            ids, max_id = await self._fetch_all()
+        finally:
+            merged_during, self._merged_during_load = self._merged_during_load, None
+        added = len(ids) - len(self._sorted)
+        self._sorted = ids
+        self._cursor = max_id
+        self._full_loaded_at = time.time()
+        self.full_refresh_count += 1
+        # إضافات وصلت أثناء التحميل: في _recent أو دُمجت في المصفوفة القديمة
+        merged_during.extend(self._recent)
+        self._recent = set()
+        if merged_during:
+            self._merge(merged_during)
+        return max(added, 0)
+
+    async def _fetch_all(self):
+        """كل telegram_id مرتبة + أكبر id (صفحات حسب telegram_id)."""
+        columns = 'id, telegram_id' if self._incremental else 'telegram_id'
+        ids = array('q')
+        cursor = None
+        max_id = 0
+        monotonic = self._incremental
+        while True:
+            query = supabase.table('target_users').select(columns).order('telegram_id').limit(DB_PAGE_SIZE)
+            if cursor is not None:
+                query = query.gt('telegram_id', cursor)
+            try:
+                response = await query.execute()
+            except SupabaseError as e:
+                if not self._incremental or e.status_code != 400:
+                    raise
+                # عمود id غير موجود - نكمل بالتحميل الكامل فقط
+                logger.warning("target_users.id unavailable (%s); known-user index uses full refreshes only", e)
+                self._incremental = False
+                return await self._fetch_all()
+            page = response.data or []
+            for row in page:
+                telegram_id = row.get('telegram_id')
+                if telegram_id is None:
+                    continue
+                ids.append(telegram_id)
+                row_id = row.get('id')
+                if isinstance(row_id, int):
+                    max_id = max(max_id, row_id)
+                else:
+                    monotonic = False
+            if page:
+                cursor = page[-1]['telegram_id']
+            if len(page) < DB_PAGE_SIZE:
+                break
+        if self._incremental and not monotonic:
+            logger.warning("target_users.id is not an integer column; known-user index uses full refreshes only")
+            self._incremental = False
+        return ids, max_id
+
+    async def _load_new(self) -> int:
+        """المستخدمون الجدد فقط (id > آخر id محمّل)."""
+        new_ids = []
+        while True:
+            response = await (
+                supabase.table('target_users')
+                .select('id, telegram_id')
+                .gt('id', self._cursor)
+                .order('id')
+                .limit(DB_PAGE_SIZE)
+                .execute()
+            )
+            page = response.data or []
+            new_ids.extend(row['telegram_id'] for row in page if row.get('telegram_id') is not None)
+            if page:
+                self._cursor = page[-1]['id']
+            if len(page) < DB_PAGE_SIZE:
+                break
+        if self._recent:
+            new_ids.extend(self._recent)
+            self._recent = set()
+        if new_ids:
+            self._merge(new_ids)
+        return len(new_ids)
+
+    async def refresh(self, full: bool = False):
+        """تحديث تدريجي، أو كامل عند أول تحميل / كل full_refresh_interval / بدون id رقمي."""
+        started = time.perf_counter()
+        full = (full or not self._loaded or not self._incremental
+                or time.time() - self._full_loaded_at > self.full_refresh_interval)
+        added = await (self._load_all() if full else self._load_new())
+        self.refresh_count += 1
+        self.last_refresh_seconds = time.perf_counter() - started
+        if not self._loaded or added:
+            logger.info("Known-user index: %s users (+%s, %s) in %.3fs",
+                        len(self), added, "full" if full else "incremental", self.last_refresh_seconds)
+        self._loaded = True
+
+    async def exists(self, telegram_id: int) -> bool:
+        if telegram_id in self:
+            self.hits += 1
+            return True
+        # غير موجود محلياً: ممكن سجّل من نسخة أخرى بعد آخر تحديث
+        self.db_checks += 1
+        found = await _db_user_exists(telegram_id)
+        if found:
+            self.add(telegram_id)
+        return found
+
+    def stats(self) -> dict:
+        return {
+            'ready': self.ready,
+            'users': len(self),
+            'bytes': self._sorted.itemsize * len(self._sorted),
+            'hits': self.hits,
+            'db_checks': self.db_checks,
+            'refresh_count': self.refresh_count,
+            'full_refresh_count': self.full_refresh_count,
+            'incremental': self._incremental,
+            'last_refresh_ms': round(self.last_refresh_seconds * 1000, 1),
+        }
+
+
+KNOWN_USERS = KnownUserIndex(
+    refresh_interval=KNOWN_USERS_REFRESH_INTERVAL,
+    full_refresh_interval=KNOWN_USERS_FULL_REFRESH,
+)
+
+
+ANSWERED_IDS = AnsweredIdCache(
+    max_bytes=ANSWERED_CACHE_MAX_BYTES,
+    max_users=ANSWERED_CACHE_MAX_USERS,
+    sync_interval=ANSWERED_SYNC_INTERVAL,
+)
+
+
+def _stats_dict(total: int, correct: int) -> dict:
+    accuracy = (correct / total) * 100 if total > 0 else 0
+    return {'total_answers': total, 'correct_answers': correct, 'accuracy': round(accuracy, 1)}
+
+
+class UserStatsCache:
+    """عدادات الإحصائيات (الكلي/الصحيح) لكل مستخدم في الذاكرة.
+
+    تُحدّث مباشرة من handle_answer، وتُطابق مع قاعدة البيانات في الخلفية كل
+    STATS_RECONCILE_INTERVAL (count + الإجابات التي ما زالت في طابور الكتابة).
+    """
+
+    def __init__(self, max_users: int, reconcile_interval: float):
+        self.max_users = max_users
+        self.reconcile_interval = reconcile_interval
+        self._entries = OrderedDict()  # telegram_id -> [total, correct, synced_at]
+        self._loading = {}
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.reconciles = 0
+        self.invalidations = 0
+
+    def invalidate(self, telegram_id: int):
+        """نسخة أخرى سجّلت إجابات لهذا المستخدم → إعادة التحميل من قاعدة البيانات عند الطلب التالي."""
+        if self._entries.pop(telegram_id, None) is not None:
+            self.invalidations += 1
+
+    def record_answer(self, telegram_id: int, is_correct: bool):
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return  # سيُحمّل من قاعدة البيانات (مع الطابور) عند الحاجة
+        entry[0] += 1
+        if is_correct:
+            entry[1] += 1
+
+    def peek(self, telegram_id: int):
+        """الإحصائيات من الذاكرة فقط، أو None."""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        return _stats_dict(entry[0], entry[1])
+
+    async def get(self, telegram_id: int) -> dict:
+        """الإحصائيات بدون قاعدة بيانات إذا كانت في الذاكرة، وإلا تحميل واحد مشترك."""
+        entry = self._entries.get(telegram_id)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(telegram_id)
+            if time.time() - entry[2] > self.reconcile_interval:
+                self._schedule(telegram_id)
+            return _stats_dict(entry[0], entry[1])
+
+        self.misses += 1
+        try:
+            await asyncio.shield(self._schedule(telegram_id))
+        except Exception as e:
+            logger.warning("Could not fetch user stats for telegram_id %s: %s", telegram_id, e)
+            return _stats_dict(0, 0)
+        entry = self._entries.get(telegram_id)
+        return _stats_dict(entry[0], entry[1]) if entry else _stats_dict(0, 0)
+
+    def _schedule(self, telegram_id: int) -> asyncio.Task:
+        task = self._loading.get(telegram_id)
+        if task is None:
+            task = asyncio.create_task(self._reconcile(telegram_id))
+            self._loading[telegram_id] = task
+        return task
+
+    async def _reconcile(self, telegram_id: int):
+        try:
+            total, correct = await count_user_answers(telegram_id)
+        except Exception:
+            entry = self._entries.get(telegram_id)
+            if entry is not None:
+                entry[2] = time.time()  # نحتفظ بالقيم المحلية ونعيد المحاولة لاحقاً
+                return
+            raise
+        finally:
+            self._loading.pop(telegram_id, None)
+        # الإجابات التي لم تصل لقاعدة البيانات بعد
+        pending_total, pending_correct = ANSWER_WRITER.pending_counts(telegram_id)
+        self._entries[telegram_id] = [total + pending_total, correct + pending_correct, time.time()]
+        self._entries.move_to_end(telegram_id)
+        self.reconciles += 1
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'reconciles': self.reconciles,
+            'invalidations': self.invalidations,
+        }
+
+
+USER_STATS = UserStatsCache(max_users=USER_STATS_MAX_USERS, reconcile_interval=STATS_RECONCILE_INTERVAL)
+
+
+def sample_local_questions(telegram_id: int, count: int, exclude_ids=None):
+    """اختيار أسئلة من الذاكرة إذا كانت البيانات جاهزة، وإلا None (مع بدء التحميل)."""
+    if not QUESTION_POOL_ENABLED or not QUESTION_POOL.ready:
+        return None
+    answered = ANSWERED_IDS.get(telegram_id)
+    if answered is None:
+        ANSWERED_IDS.schedule_load(telegram_id)
+        return None
+    questions = QUESTION_POOL.sample(answered.__contains__, count, exclude_ids)
+    QUESTION_POOL.local_picks += len(questions)
+    return questions
+
+async def get_question_by_id(question_id: int):
+    """جلب سؤال بالمعرف: مخزن الأسئلة في الذاكرة ← الكاش المشترك ← قاعدة البيانات."""
+    question = QUESTION_POOL.get(question_id)
+    if question is not None:
+        return question
+    question = await SHARED_CACHE.get("questions", question_id)
+    if question is not None:
+        return question
+    return await _db_question_by_id(question_id)
+
+@single_flight
+async def _db_question_by_id(question_id: int):
+    try:
+        response = await (
+            supabase.table('questions')
+            .select(QUESTION_COLUMNS)
+            .eq('id', question_id)
+            .limit(1)
+            .execute()
+        )
+    except Exception as e:
+        logger.warning("Could not load question %s: %s", question_id, e)
+        return None
+    if not response.data:
+        return None
+    question = response.data[0]
+    await SHARED_CACHE.set("questions", question_id, question, ttl=QUESTION_CACHE_TTL)
+    return question
+
+
+async def remember_question(question: dict):
+    """حفظ السؤال المعروض في الكاش المشترك حتى تتحقق أي نسخة من الإجابة بدون DB."""
+    question_id = question.get('id')
+    if isinstance(question_id, int) and QUESTION_POOL.get(question_id) is None:
+        await SHARED_CACHE.set("questions", question_id, question, ttl=QUESTION_CACHE_TTL)
+
+@profiled
+async def fetch_random_question(telegram_id: int = None, answered_ids: list = None, exclude_ids=None):
+    """جلب سؤال عشوائي: من الذاكرة إن أمكن، وإلا من قاعدة البيانات باستخدام RPC مع استثناء المجاب عليها."""
+    if telegram_id:
+        questions = sample_local_questions(telegram_id, 1, exclude_ids)
+        if questions is not None:
+            return questions[0] if questions else None  # [] = لا يوجد سؤال متبقٍ، بدون RPC
+        QUESTION_POOL.rpc_fallbacks += 1
+
+    question = await _rpc_random_question(telegram_id, answered_ids)
+    if question is not None and telegram_id and _already_seen(telegram_id, exclude_ids)(question.get('id')):
+        return None
+    return question
+
+def _already_seen(telegram_id: int, exclude_ids=None):
+    """فحص لنتائج الـ RPC: المستثناة + المجاب عليها محلياً (بما فيها ما زال في طابور الكتابة ولم يصل DB)."""
+    exclude_ids = exclude_ids or ()
+    answered = ANSWERED_IDS.peek(telegram_id)
+    pending = ANSWER_WRITER.pending_question_ids(telegram_id)
+    return lambda question_id: (
+        question_id in exclude_ids
+        or question_id in pending
+        or (answered is not None and question_id in answered)
+    )
+
+async def _rpc_random_question(telegram_id: int = None, answered_ids: list = None):
+    """جلب سؤال عشوائي من قاعدة البيانات باستخدام RPC مع استثناء المجاب عليها."""
+    try:
+        # ✅ استخدام RPC الجديد الأسرع - يستثني المجاب عليها داخل DB
+        if telegram_id:
+            # RPC جديد يستثني المجاب عليها داخلياً بدون إرسال arrays ضخمة
+            response = await supabase.rpc("get_random_question_for_user", {"p_user_id": telegram_id}).execute()
+        else:
+            # Fallback للـ RPC القديم (للحالات النادرة بدون user_id)
             if answered_ids is None:
                 answered_ids = []
             elif not isinstance(answered_ids, list):
                 answered_ids = list(answered_ids)
             payload = {"excluded_ids": answered_ids or None}
-            response = supabase.rpc("get_random_question", payload).execute()
+            response = await supabase.rpc("get_random_question", payload).execute()
         
         rows = response.data or []
         if isinstance(rows, dict):
@@ -268,49 +2252,93 @@ def fetch_random_question(telegram_id: int = None, answered_ids: list = None):
 
         if not rows:
             if telegram_id:
-                logger.info("User %s has no more questions available via RPC", telegram_id)
+                logger.info("User %s has no more questions available via RPC", telegram_id, extra=DB_LOG)
             else:
                 logger.warning("No questions found in database for fetch_random_question (RPC).")
             return None
 
         question = rows[0]
-        logger.info("Fetched question_id %s for user %s (RPC)", question.get('id'), telegram_id)
+        logger.info("Fetched question_id %s for user %s (RPC)", question.get('id'), telegram_id, extra=DB_LOG)
         return question
     except Exception as e:
         logger.warning("Could not fetch question (RPC): %s", e)
         return None
 
+@profiled
+async def fetch_random_questions(telegram_id: int, count: int, exclude_ids=None):
+    """جلب حتى count أسئلة عشوائية مختلفة وغير مجاب عليها في جولة واحدة.
+
+    من الذاكرة إن أمكن، وإلا طلبات RPC متوازية على نفس الاتصال (بدون إعادة
+    محاولة عند التكرار، فأسوأ حالة جولة واحدة فقط).
+    """
+    if count <= 0:
+        return []
+    exclude_ids = exclude_ids or ()
+    questions = sample_local_questions(telegram_id, count, exclude_ids)
+    if questions is not None:
+        return questions  # [] = المخزن جاهز ولم يبقَ شيء خارج المستثناة، فلا داعي لـ RPC
+    QUESTION_POOL.rpc_fallbacks += 1
+
+    results = await asyncio.gather(*(_rpc_random_question(telegram_id) for _ in range(count)))
+    seen = _already_seen(telegram_id, exclude_ids)
+    questions = []
+    seen_ids = set()
+    for question in results:
+        if not question:
+            continue
+        question_id = question.get('id')
+        if question_id in seen_ids or seen(question_id):
+            continue
+        seen_ids.add(question_id)
+        questions.append(question)
+    return questions
+
+
+def _prefetch_depth(user_data: dict) -> int:
+    """عدد الأسئلة المطلوب تجهيزها حسب سرعة إجابة المستخدم."""
+    pace = user_data.get(ANSWER_PACE_KEY)
+    if not pace:
+        return DEFAULT_PREFETCH_QUESTIONS
+    depth = int(PREFETCH_HORIZON_SECONDS / max(pace, 1.0))
+    return max(MIN_PREFETCH_QUESTIONS, min(MAX_PREFETCH_QUESTIONS, depth))
+
+
+def _record_answer_pace(user_data: dict):
+    """تحديث متوسط الوقت بين الإجابات (EMA) لاستخدامه في عمق التجهيز المسبق."""
+    now_ts = time.time()
+    last_ts = user_data.get(LAST_ANSWER_AT_KEY)
+    user_data[LAST_ANSWER_AT_KEY] = now_ts
+    if not last_ts:
+        return
+    interval = now_ts - last_ts
+    if interval > PREFETCH_HORIZON_SECONDS * 5:
+        return  # استراحة طويلة وليست سرعة إجابة
+    pace = user_data.get(ANSWER_PACE_KEY)
+    user_data[ANSWER_PACE_KEY] = interval if not pace else 0.7 * pace + 0.3 * interval
+
 
 async def _fill_question_buffer(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """ملء المخزن المؤقت بالأسئلة حتى الحد الأقصى المحدد."""
+    """ملء المخزن المؤقت بالأسئلة بطلب واحد حتى العمق المناسب للمستخدم."""
     buffer = context.user_data.setdefault(QUESTION_BUFFER_KEY, [])
     excluded_store = context.user_data.setdefault(PREFETCH_EXCLUDED_KEY, set())
 
-    while len(buffer) < MAX_PREFETCH_QUESTIONS:
-        # ✅ الآن أبسط بكثير - الـ RPC يستثني المجاب عليها تلقائياً
-        # نحتاج فقط نتأكد أننا ما نكرر الأسئلة في الـ buffer نفسه
-        buffer_ids = {q.get('id') for q in buffer if isinstance(q, dict) and q.get('id')}
-        
-        # لو السؤال موجود في البافر، نعيد المحاولة
-        try:
-            question = await asyncio.to_thread(
-                fetch_random_question,
-                user_id  # ✅ فقط user_id - الباقي يصير داخل DB
-            )
-        except asyncio.CancelledError:
-            raise
-        except Exception as e:
-            logger.warning("Buffer fill failed for user %s: %s", user_id, e)
-            break
+    needed = _prefetch_depth(context.user_data) - len(buffer)
+    if needed <= 0:
+        return
 
-        if not question:
-            break
-        
-        # تأكد أن السؤال مو موجود في البافر (احتمال نادر لكن ممكن مع random)
-        question_id = question.get('id')
-        if question_id in buffer_ids or question_id in excluded_store:
-            continue  # اطلب سؤال آخر
+    # ✅ طلب واحد لعدة أسئلة - المستثناة (البافر + السابقة) والمجاب عليها لا ترجع
+    try:
+        questions = await fetch_random_questions(user_id, needed, exclude_ids=excluded_store)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning("Buffer fill failed for user %s: %s", user_id, e)
+        return
 
+    for question in questions:
+        question_id = question.get('id')
+        if question_id in excluded_store:
+            continue
         buffer.append(question)
         if question_id is not None:
             excluded_store.add(question_id)
@@ -348,15 +2376,14 @@ def _schedule_question_buffer_fill(
 
     context.user_data[QUESTION_BUFFER_TASK_KEY] = asyncio.create_task(runner())
 
-@time_it_sync
-def get_latest_questions(limit: int = 10):
+@single_flight
+@profiled
+async def get_latest_questions(limit: int = 10):
     """جلب أحدث الأسئلة من قاعدة البيانات"""
     try:
-        response = (
+        response = await (
             supabase.table('questions')
-            .select(
-                'id, question, option_a, option_b, option_c, option_d, correct_answer, explanation, date_added'
-            )
+            .select(QUESTION_COLUMNS)
             .eq('ai_review_status', 'correct')
             .order('date_added', desc=True)
             .limit(limit)
@@ -364,7 +2391,7 @@ def get_latest_questions(limit: int = 10):
         )
         
         if response.data:
-            logger.info("Fetched %s latest questions", len(response.data))
+            logger.info("Fetched %s latest questions", len(response.data), extra=DB_LOG)
             return response.data
         else:
             logger.warning("No questions found when fetching latest questions.")
@@ -374,85 +2401,186 @@ def get_latest_questions(limit: int = 10):
         logger.warning("Could not fetch latest questions: %s", e)
         return []
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """بداية التفاعل مع البوت"""
-    logger.info("START HANDLER fired for user_id=%s", update.effective_user.id if update.effective_user else None)
+# --- Rendering: pre-built screens and keyboards ---
+# الشاشات والأزرار الثابتة تُبنى مرة واحدة (كائنات PTB غير قابلة للتعديل بعد الإنشاء)،
+# ونصوص/أزرار كل سؤال تُخزن في LRU حسب رقم السؤال.
 
-    user = update.effective_user
-    telegram_id = user.id
-    
-    # التحقق من وجود المستخدم
-    user_exists = await asyncio.to_thread(check_user_exists, telegram_id)
-    if not user_exists:
-        # المستخدم جديد - طلب رقم الجوال
-        
-        # إنشاء لوحة مفاتيح لطلب رقم الجوال
-        keyboard = [[KeyboardButton("Share Phone Number / مشاركة رقم الجوال", request_contact=True)]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-        
-        welcome_message = (
-            "Welcome to Vignora Medical Questions Bot!\n"
-            "مرحباً بك في بوت فيجنورا للأسئلة الطبية!\n\n"
-            "🦷 **Available Now:** Dentistry Questions\n"
-            "🦷 **متوفر الآن:** أسئلة طب الأسنان\n\n"
-            "🌟 More medical specialties coming soon!\n"
-            "🌟 المزيد من التخصصات الطبية قريباً!\n\n"
-            f"📢 **Follow our channel for bot updates and new questions:**\n"
-            f"📢 **تابع قناتنا لمعرفة تحديثات البوت والأسئلة الجديدة:**\n"
-            f"🔗 {TELEGRAM_CHANNEL_LINK}\n\n"
-            "To get started, please click the button below to share your phone number.\n"
-            "للبدء، يرجى النقر على الزر أدناه لمشاركة رقم الجوال."
-        )
-        
-        await update.message.reply_text(welcome_message, reply_markup=reply_markup)
-    else:
-        # المستخدم موجود - عرض قائمة الاختبار
-        await show_quiz_menu(update, context)
+class RenderCache:
+    """LRU بسيط لنتائج الرسم (نص + أزرار) حسب المفتاح."""
 
-async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالجة مشاركة رقم الجوال"""
-    if not update.message.contact:
-        await update.message.reply_text("Please share your phone number to continue.")
-        return
-    
-    user = update.effective_user
-    contact = update.message.contact
-    
-    # حفظ بيانات المستخدم
-    success = await asyncio.to_thread(save_user_data,
-        telegram_id=user.id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name,
-        phone_number=contact.phone_number,
-        language_code=user.language_code
-    )
-    
-    if success:
-        # إزالة لوحة المفاتيح
-        await update.message.reply_text(
-            "تم حفظ معلوماتك بنجاح.\n"
-            "Your information has been saved successfully.",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        
-        # عرض مقدمة البوت مباشرة
-        await show_bot_introduction(update, context)
-    else:
-        await update.message.reply_text("Sorry, there was an error saving your information. Please try again.")
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-async def show_bot_introduction(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض مقدمة البوت للمستخدمين الجدد"""
-    user = update.effective_user
-    telegram_id = user.id
+    def get_or_build(self, key, builder):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = builder()
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+RENDER_CACHE = RenderCache(max_entries=RENDER_CACHE_MAX_ENTRIES)
+
+
+def encode_callback(kind: str, *parts) -> str:
+    """بناء callback_data بالصيغة المستقلة عن الجلسة (حد تيليجرام 64 بايت)."""
+    return ":".join((kind,) + tuple(str(part) for part in parts))
+
+
+def parse_callback(data: str):
+    """تحليل callback_data بالصيغة الجديدة: يرجع (kind, question_id, rest) أو None."""
+    kind, sep, payload = (data or "").partition(":")
+    if not sep:
+        return None
+    question_id, _, rest = payload.partition(":")
+    try:
+        return kind, int(question_id), rest
+    except ValueError:
+        return None
+
+
+def _keyboard(*rows) -> InlineKeyboardMarkup:
+    """بناء لوحة أزرار من صفوف (نص، callback_data)."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=data) for text, data in row]
+        for row in rows
+    ])
+
+
+BTN_START_QUIZ = ("🚀 Start Quiz / بدء الاختبار", "quiz")
+BTN_MY_STATS = ("📊 My Stats / إحصائياتي", "stats")
+BTN_NEXT_QUESTION = ("Next Question / السؤال التالي", "quiz")
+BTN_END_SESSION = ("🔚 End Session / إنهاء الجلسة", "end_session")
+
+INTRO_KEYBOARD = _keyboard([BTN_START_QUIZ], [BTN_MY_STATS], [("ℹ️ About / حول البوت", "about")])
+QUIZ_MENU_KEYBOARD = _keyboard([("Start Quiz / بدء الاختبار", "quiz")], [("My Stats / إحصائياتي", "stats")])
+BACK_TO_MENU_KEYBOARD = _keyboard([("Back to Menu / العودة للقائمة", "menu")])
+END_SESSION_KEYBOARD = _keyboard(
+    [("🚀 Start New Quiz / بدء اختبار جديد", "quiz")],
+    [BTN_MY_STATS],
+    [("🏠 Main Menu / القائمة الرئيسية", "menu")],
+)
+REPORT_DONE_KEYBOARD = _keyboard([BTN_NEXT_QUESTION], [BTN_END_SESSION])
+PHONE_REQUEST_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("Share Phone Number / مشاركة رقم الجوال", request_contact=True)]],
+    one_time_keyboard=True, resize_keyboard=True,
+)
+
+NEW_USER_WELCOME_MESSAGE = (
+    "Welcome to Vignora Medical Questions Bot!\n"
+    "مرحباً بك في بوت فيجنورا للأسئلة الطبية!\n\n"
+    "🦷 **Available Now:** Dentistry Questions\n"
+    "🦷 **متوفر الآن:** أسئلة طب الأسنان\n\n"
+    "🌟 More medical specialties coming soon!\n"
+    "🌟 المزيد من التخصصات الطبية قريباً!\n\n"
+    f"📢 **Follow our channel for bot updates and new questions:**\n"
+    f"📢 **تابع قناتنا لمعرفة تحديثات البوت والأسئلة الجديدة:**\n"
+    f"🔗 {TELEGRAM_CHANNEL_LINK}\n\n"
+    "To get started, please click the button below to share your phone number.\n"
+    "للبدء، يرجى النقر على الزر أدناه لمشاركة رقم الجوال."
+)
+
+END_SESSION_MESSAGE = (
+    "🔚 **تم إنهاء الجلسة**\n"
+    "**Session Ended**\n\n"
+    "شكراً لك على المشاركة في الاختبار!\n"
+    "Thank you for participating in the quiz!\n\n"
+    "يمكنك العودة للقائمة الرئيسية أو بدء جلسة جديدة.\n"
+    "You can return to the main menu or start a new session."
+)
+
+REPORT_MENU_MESSAGE = (
+    "🚨 **Report Question / الإبلاغ عن السؤال**\n\n"
+    "Please select the reason for reporting:\n"
+    "يرجى اختيار سبب الإبلاغ:\n\n"
+    "Choose the most appropriate reason to help us improve the question quality.\n"
+    "اختر السبب الأكثر ملاءمة لمساعدتنا في تحسين جودة السؤال."
+)
+
+ABOUT_MESSAGE = (
+    "ℹ️ **حول بوت فيجنورا / About Vignora Bot**\n\n"
     
-    # تحديث آخر تفاعل
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, telegram_id))
+    "🏥 **الغرض:**\n"
+    "**Purpose:**\n"
+    "بوت تعليمي متطور يهدف إلى مساعدة الطلاب والمهنيين الطبيين على اختبار معرفتهم الطبية.\n"
+    "An advanced educational bot designed to help medical students and professionals test their medical knowledge.\n\n"
     
-    # جلب عدد الأسئلة المتاحة
-    total_questions = await asyncio.to_thread(get_total_questions_count)
+    "🎓 **الفئة المستهدفة:**\n"
+    "**Target Audience:**\n"
+    "• طلاب طب الأسنان\n"
+    "• المهنيون الطبيون\n"
+    "• أي شخص مهتم بالمعرفة الطبية\n\n"
+    
+    "• Dental students\n"
+    "• Medical professionals\n"
+    "• Anyone interested in medical knowledge\n\n"
+    
+    "🦷 **المحتوى المتوفر الآن:**\n"
+    "**Currently Available:**\n"
+    "أسئلة طب الأسنان متنوعة تغطي مختلف المستويات.\n"
+    "Diverse dentistry questions covering various levels.\n\n"
+    
+    "🚀 **خطة التطوير:**\n"
+    "**Development Plan:**\n"
+    "سيتم إضافة باقي التخصصات الطبية قريباً لتغطية جميع احتياجاتك التعليمية.\n"
+    "Other medical specialties will be added soon to cover all your educational needs.\n\n"
     
-    intro_message = (
+    "📱 **كيفية الاستخدام:**\n"
+    "**How to Use:**\n"
+    "1. اضغط على 'بدء الاختبار'\n"
+    "2. اقرأ السؤال بعناية\n"
+    "3. اختر الإجابة الصحيحة\n"
+    "4. اقرأ الشرح\n"
+    "5. انتقل للسؤال التالي\n\n"
+    
+    "1. Click 'Start Quiz'\n"
+    "2. Read the question carefully\n"
+    "3. Choose the correct answer\n"
+    "4. Read the explanation\n"
+    "5. Move to next question\n\n"
+    
+    "🌟 **مميزات بوت فيجنورا:**\n"
+    "**Vignora Bot Features:**\n"
+    "• لا تكرار للأسئلة\n"
+    "• إحصائيات شخصية\n"
+    "• تتبع التقدم\n"
+    "• واجهة ثنائية اللغة\n"
+    "• تطوير مستمر ومحتوى محدث\n\n"
+    
+    "• No question repetition\n"
+    "• Personal statistics\n"
+    "• Progress tracking\n"
+    "• Bilingual interface\n"
+    "• Continuous development and updated content"
+)
+
+
+@functools.lru_cache(maxsize=16)
+def render_intro(total_questions: int) -> str:
+    """رسالة مقدمة البوت (تتغير فقط مع عدد الأسئلة)."""
+    return (
         "🎯 **مرحباً بك في بوت فيجنورا للأسئلة الطبية!**\n"
         "**Welcome to Vignora Medical Questions Bot!**\n\n"
         
@@ -508,34 +2636,12 @@ async def show_bot_introduction(update: Update, context: ContextTypes.DEFAULT_TY
         "🎉 **هل أنت مستعد للبدء مع فيجنورا؟**\n"
         "**Are you ready to start with Vignora?**"
     )
-    
-    keyboard = [
-        [InlineKeyboardButton("🚀 Start Quiz / بدء الاختبار", callback_data="quiz")],
-        [InlineKeyboardButton("📊 My Stats / إحصائياتي", callback_data="stats")],
-        [InlineKeyboardButton("ℹ️ About / حول البوت", callback_data="about")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(intro_message, reply_markup=reply_markup, parse_mode='Markdown')
 
-async def show_quiz_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض قائمة الاختبار"""
-    user = update.effective_user
-    telegram_id = user.id
-    
-    # تحديث آخر تفاعل
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, telegram_id))
-    
-    # جلب عدد الأسئلة المتاحة
-    total_questions = await asyncio.to_thread(get_total_questions_count)
-    
-    keyboard = [
-        [InlineKeyboardButton("Start Quiz / بدء الاختبار", callback_data="quiz")],
-        [InlineKeyboardButton("My Stats / إحصائياتي", callback_data="stats")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    welcome_message = (
+
+@functools.lru_cache(maxsize=16)
+def render_quiz_menu(total_questions: int) -> str:
+    """رسالة القائمة الرئيسية (تتغير فقط مع عدد الأسئلة)."""
+    return (
         "🎯 **مرحباً بك مرة أخرى في بوت فيجنورا للأسئلة الطبية!**\n"
         "**Welcome back to Vignora Medical Questions Bot!**\n\n"
         "🦷 **متوفر الآن:** أسئلة طب الأسنان\n"
@@ -549,7 +2655,175 @@ async def show_quiz_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🚀 **اختر ما تريد القيام به:**\n"
         "**Choose what you want to do:**"
     )
+
+
+def _cached_render(key, question_id, builder):
+    """رسم من LRU إذا كان للسؤال رقم، وإلا بناء مباشر."""
+    if question_id is None:
+        return builder()
+    return RENDER_CACHE.get_or_build(key, builder)
+
+
+def render_question(question: dict):
+    """(رأس السؤال، الخيارات، أزرار الإجابة) - سطر "Remaining" فقط يضاف لكل مستخدم."""
+    question_id = question.get('id')
+
+    def build():
+        date_added_text = ""
+        if SHOW_DATE_ADDED:
+            date_added_text = f"📅 **Added:** {format_timestamp(question.get('date_added'))}\n\n"
+        header = (
+            f"📚 **Question / السؤال:**\n"
+            f"{question.get('question', 'No question')}\n\n"
+        )
+        footer = (
+            f"{date_added_text}"
+            "**Options / الخيارات:**\n"
+            f"A) {question.get('option_a', '')}\n"
+            f"B) {question.get('option_b', '')}\n"
+            f"C) {question.get('option_c', '')}\n"
+            f"D) {question.get('option_d', '')}"
+        )
+        # رقم السؤال داخل الزر، لا حاجة للجلسة
+        markup = _keyboard(
+            [("A", encode_callback(CB_ANSWER, question_id, "A")), ("B", encode_callback(CB_ANSWER, question_id, "B"))],
+            [("C", encode_callback(CB_ANSWER, question_id, "C")), ("D", encode_callback(CB_ANSWER, question_id, "D"))],
+            [BTN_END_SESSION],
+        )
+        return header, footer, markup
+
+    return _cached_render(('question', question_id), question_id, build)
+
+
+def render_result(question: dict, selected_answer: str):
+    """(رسالة النتيجة، الأزرار) بعد الإجابة - مخزنة حسب السؤال والإجابة المختارة."""
+    question_id = question.get('id')
+
+    def build():
+        correct_answer = question.get('correct_answer', '')
+        explanation = question.get('explanation', '')
+
+        if selected_answer == correct_answer:
+            result_message = "✅ إجابة صحيحة!\nCorrect answer!\n\n"
+        else:
+            correct_answer_text = ""
+            if correct_answer in ("A", "B", "C", "D"):
+                correct_answer_text = f"{correct_answer}: {question.get('option_' + correct_answer.lower(), '')}"
+            result_message = (
+                f"❌ إجابة خاطئة\n"
+                f"Wrong answer\n\n"
+                f"**Correct Answer / الإجابة الصحيحة:**\n"
+                f"{correct_answer_text}\n\n"
+            )
+
+        if explanation:
+            result_message += f"**Explanation / الشرح:**\n{explanation}"
+        else:
+            result_message += "**No explanation available / لا يوجد شرح متاح**"
+
+        markup = _keyboard(
+            [BTN_NEXT_QUESTION],
+            [("🚨 Report Question / الإبلاغ عن السؤال", encode_callback(CB_REPORT, question_id, selected_answer))],
+            [BTN_END_SESSION],
+        )
+        return result_message, markup
+
+    return _cached_render(('result', question_id, selected_answer), question_id, build)
+
+
+def render_report_menu(question_id: int, selected_answer: str) -> InlineKeyboardMarkup:
+    """أزرار أسباب الإبلاغ لسؤال معين."""
+    def build():
+        def reason(label: str, code: str):
+            return [(label, encode_callback(CB_REPORT_REASON, question_id, selected_answer, code))]
+
+        return _keyboard(
+            reason("❌ Incorrect Answer / إجابة خاطئة", "i"),
+            reason("📝 Typo or Grammar / خطأ إملائي أو نحوي", "t"),
+            reason("🔍 Unclear Question / سؤال غير واضح", "u"),
+            reason("📚 Wrong Topic / موضوع خاطئ", "p"),
+            [("🔙 Back / العودة", encode_callback(CB_BACK, question_id, selected_answer))],
+        )
+
+    return _cached_render(('report', question_id, selected_answer), question_id, build)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بداية التفاعل مع البوت"""
+    logger.info("START HANDLER fired for user_id=%s", update.effective_user.id if update.effective_user else None, extra=UPDATE_LOG)
+
+    user = update.effective_user
+    telegram_id = user.id
+    
+    # التحقق من وجود المستخدم
+    user_exists = await check_user_exists(telegram_id)
+    if not user_exists:
+        # المستخدم جديد - طلب رقم الجوال
+        
+        await update.message.reply_text(NEW_USER_WELCOME_MESSAGE, reply_markup=PHONE_REQUEST_KEYBOARD)
+    else:
+        # المستخدم موجود - عرض قائمة الاختبار
+        await show_quiz_menu(update, context)
+
+async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالجة مشاركة رقم الجوال"""
+    if not update.message.contact:
+        await update.message.reply_text("Please share your phone number to continue.")
+        return
+    
+    user = update.effective_user
+    contact = update.message.contact
+    
+    # حفظ بيانات المستخدم
+    success = await save_user_data(
+        telegram_id=user.id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        phone_number=contact.phone_number,
+        language_code=user.language_code
+    )
+    
+    if success:
+        # إزالة لوحة المفاتيح
+        await update.message.reply_text(
+            "تم حفظ معلوماتك بنجاح.\n"
+            "Your information has been saved successfully.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        
+        # عرض مقدمة البوت مباشرة
+        await show_bot_introduction(update, context)
+    else:
+        await update.message.reply_text("Sorry, there was an error saving your information. Please try again.")
+
+async def show_bot_introduction(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض مقدمة البوت للمستخدمين الجدد"""
+    user = update.effective_user
+    telegram_id = user.id
+    
+    # تحديث آخر تفاعل
+    update_last_interaction(telegram_id)
+    
+    # جلب عدد الأسئلة المتاحة
+    total_questions = await get_total_questions_count()
+    
+    await update.message.reply_text(render_intro(total_questions), reply_markup=INTRO_KEYBOARD, parse_mode='Markdown')
+
+async def show_quiz_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض قائمة الاختبار"""
+    user = update.effective_user
+    telegram_id = user.id
+    
+    # تحديث آخر تفاعل
+    update_last_interaction(telegram_id)
+    
+    # جلب عدد الأسئلة المتاحة
+    total_questions = await get_total_questions_count()
     
+    welcome_message = render_quiz_menu(total_questions)
+    reply_markup = QUIZ_MENU_KEYBOARD
+
     if hasattr(update, 'callback_query') and update.callback_query:
         await update.callback_query.edit_message_text(welcome_message, reply_markup=reply_markup, parse_mode='Markdown')
     else:
@@ -561,36 +2835,13 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     user = query.from_user
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, user.id))
+    update_last_interaction(user.id)
 
-    def get_stats_and_questions():
-        """Fetch user stats and answered IDs without RPC."""
-        stats = get_user_stats(user.id)
-        answered_questions = get_user_answered_questions(user.id)
-        total_questions = get_total_questions_count()
-        return stats, answered_questions, total_questions
-
-    # ✅ نستخدم count بدل جلب كل الصفوف (أسرع بكثير!)
-    def _fetch_answers_and_compute():
-        try:
-            # ✅ العدد الكلي
-            total_resp = supabase.table('user_answers_bot').select('id', count='exact').eq('user_id', user.id).limit(1).execute()
-            total = total_resp.count or 0
-            
-            # ✅ عدد الصحيحة
-            correct_resp = supabase.table('user_answers_bot').select('id', count='exact').eq('user_id', user.id).eq('is_correct', True).limit(1).execute()
-            correct = correct_resp.count or 0
-            
-            accuracy = round(((correct / total) * 100) if total > 0 else 0, 1)
-            stats_loc = {'total_answers': total, 'correct_answers': correct, 'accuracy': accuracy}
-            total_questions_loc = get_total_questions_count()
-            return stats_loc, total_questions_loc
-        except Exception as e:
-            logger.warning("Stats fetch failed: %s", e)
-            # Fallback
-            return {'total_answers': 0, 'correct_answers': 0, 'accuracy': 0}, get_total_questions_count()
-
-    stats, total_questions = await asyncio.to_thread(_fetch_answers_and_compute)
+    # ✅ العدادات من الذاكرة (بدون قاعدة بيانات)، وتحميل واحد فقط لأول مرة
+    stats, total_questions = await asyncio.gather(
+        USER_STATS.get(user.id),
+        get_total_questions_count(),
+    )
 
     # جلب عدد الأسئلة الكلي والمتبقية
     remaining_questions = total_questions - stats['total_answers']
@@ -606,11 +2857,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"استمر! 🚀"
     )
     
-        # أزرار العودة
-    keyboard = [[InlineKeyboardButton("Back to Menu / العودة للقائمة", callback_data="menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(stats_message, reply_markup=reply_markup, parse_mode='Markdown')
+    await query.edit_message_text(stats_message, reply_markup=BACK_TO_MENU_KEYBOARD, parse_mode='Markdown')
 
 async def end_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إنهاء جلسة الاختبار والعودة للقائمة الرئيسية"""
@@ -631,91 +2878,26 @@ async def end_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop(RECENTLY_ANSWERED_KEY, None)
     
     # عرض رسالة إنهاء الجلسة
-    end_message = (
-        "🔚 **تم إنهاء الجلسة**\n"
-        "**Session Ended**\n\n"
-        "شكراً لك على المشاركة في الاختبار!\n"
-        "Thank you for participating in the quiz!\n\n"
-        "يمكنك العودة للقائمة الرئيسية أو بدء جلسة جديدة.\n"
-        "You can return to the main menu or start a new session."
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("🚀 Start New Quiz / بدء اختبار جديد", callback_data="quiz")],
-        [InlineKeyboardButton("📊 My Stats / إحصائياتي", callback_data="stats")],
-        [InlineKeyboardButton("🏠 Main Menu / القائمة الرئيسية", callback_data="menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(end_message, reply_markup=reply_markup, parse_mode='Markdown')
+    await query.edit_message_text(END_SESSION_MESSAGE, reply_markup=END_SESSION_KEYBOARD, parse_mode='Markdown')
 
 async def show_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """عرض معلومات حول البوت"""
     query = update.callback_query
     await query.answer()
     
-    about_message = (
-        "ℹ️ **حول بوت فيجنورا / About Vignora Bot**\n\n"
-        
-        "🏥 **الغرض:**\n"
-        "**Purpose:**\n"
-        "بوت تعليمي متطور يهدف إلى مساعدة الطلاب والمهنيين الطبيين على اختبار معرفتهم الطبية.\n"
-        "An advanced educational bot designed to help medical students and professionals test their medical knowledge.\n\n"
-        
-        "🎓 **الفئة المستهدفة:**\n"
-        "**Target Audience:**\n"
-        "• طلاب طب الأسنان\n"
-        "• المهنيون الطبيون\n"
-        "• أي شخص مهتم بالمعرفة الطبية\n\n"
-        
-        "• Dental students\n"
-        "• Medical professionals\n"
-        "• Anyone interested in medical knowledge\n\n"
-        
-        "🦷 **المحتوى المتوفر الآن:**\n"
-        "**Currently Available:**\n"
-        "أسئلة طب الأسنان متنوعة تغطي مختلف المستويات.\n"
-        "Diverse dentistry questions covering various levels.\n\n"
-        
-        "🚀 **خطة التطوير:**\n"
-        "**Development Plan:**\n"
-        "سيتم إضافة باقي التخصصات الطبية قريباً لتغطية جميع احتياجاتك التعليمية.\n"
-        "Other medical specialties will be added soon to cover all your educational needs.\n\n"
-        
-        "📱 **كيفية الاستخدام:**\n"
-        "**How to Use:**\n"
-        "1. اضغط على 'بدء الاختبار'\n"
-        "2. اقرأ السؤال بعناية\n"
-        "3. اختر الإجابة الصحيحة\n"
-        "4. اقرأ الشرح\n"
-        "5. انتقل للسؤال التالي\n\n"
-        
-        "1. Click 'Start Quiz'\n"
-        "2. Read the question carefully\n"
-        "3. Choose the correct answer\n"
-        "4. Read the explanation\n"
-        "5. Move to next question\n\n"
-        
-        "🌟 **مميزات بوت فيجنورا:**\n"
-        "**Vignora Bot Features:**\n"
-        "• لا تكرار للأسئلة\n"
-        "• إحصائيات شخصية\n"
-        "• تتبع التقدم\n"
-        "• واجهة ثنائية اللغة\n"
-        "• تطوير مستمر ومحتوى محدث\n\n"
-        
-        "• No question repetition\n"
-        "• Personal statistics\n"
-        "• Progress tracking\n"
-        "• Bilingual interface\n"
-        "• Continuous development and updated content"
-    )
-    
-    # أزرار العودة
-    keyboard = [[InlineKeyboardButton("Back to Menu / العودة للقائمة", callback_data="menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(about_message, reply_markup=reply_markup, parse_mode='Markdown')
+    await query.edit_message_text(ABOUT_MESSAGE, reply_markup=BACK_TO_MENU_KEYBOARD, parse_mode='Markdown')
+
+def _legacy_current_question(user_data: dict):
+    """السؤال الحالي من الجلسة (للأزرار القديمة answer_X / report / back_to_answer)."""
+    current = user_data.get("current_question")
+    if not current:
+        return None
+    question = dict(user_data.get("current_question_data") or {})
+    question['id'] = current.get("question_id")
+    question['correct_answer'] = current.get("correct_answer", '')
+    question['explanation'] = current.get("explanation", '')
+    return question
+
 
 async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إرسال سؤال للمستخدم"""
@@ -724,28 +2906,19 @@ async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # تحديث آخر تفاعل
     user = query.from_user
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, user.id))
-
-    loop_local = asyncio.get_running_loop()
+    update_last_interaction(user.id)
 
     # ✅ تحسين: نجيب عدد الأسئلة المجابة بدون تحميل كل الـ IDs (أسرع بكثير!)
     if ("session_initialized" not in context.user_data) or is_session_stale(context.user_data):
         # جلسة جديدة أو قديمة تحتاج إعادة مزامنة من قاعدة البيانات
-        total_future = loop_local.run_in_executor(None, get_total_questions_count)
         
-        # ✅ بدل ما نجيب كل الـ IDs، نجيب العدد فقط (للإحصائيات)
-        def get_answered_count():
-            try:
-                resp = supabase.table('user_answers_bot').select('id', count='exact').eq('user_id', user.id).limit(1).execute()
-                return resp.count or 0  # ✅ نعتمد على count فقط
-            except Exception as e:
-                logger.warning("Could not get answered count for user %s: %s", user.id, e)
-                return 0
-        
-        answered_count_future = loop_local.run_in_executor(None, get_answered_count)
-
-        total_questions = await total_future
-        answered_count = await answered_count_future
+        # ✅ عدد الإجابات من عدادات الذاكرة (بدون count على جدول الإجابات)
+        with profile_block("send_question.session_sync"):
+            total_questions, user_stats = await asyncio.gather(
+                get_total_questions_count(),
+                USER_STATS.get(user.id),
+            )
+        answered_count = user_stats['total_answers']
 
         context.user_data["total_questions"] = total_questions
         context.user_data["answered_count"] = answered_count
@@ -780,10 +2953,10 @@ async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
         question_data = question_buffer.pop(0)
     else:
         # ✅ الآن fetch_random_question أسرع بكثير - لا يحتاج excluded_ids!
-        question_data = await asyncio.to_thread(
-            fetch_random_question,
-            user.id  # فقط user_id، الباقي يصير داخل DB
-        )
+        exclude_ids = set(context.user_data.get(PREFETCH_EXCLUDED_KEY, ()))
+        exclude_ids.update(context.user_data.get(RECENTLY_ANSWERED_KEY, ()))
+        with profile_block("send_question.fetch"):
+            question_data = await fetch_random_question(user.id, exclude_ids=exclude_ids)  # المجاب عليها تُستثنى محلياً أو داخل DB
     
     if not question_data:
         # التحقق من سبب عدم وجود أسئلة
@@ -816,57 +2989,13 @@ async def send_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     _schedule_question_buffer_fill(context, user.id, base_excluded_ids)
     
-    # تنسيق السؤال مع عدد الأسئلة المتبقية
-    date_added_text = ""
-    if SHOW_DATE_ADDED:
-        date_added_text = f"📅 **Added:** {format_timestamp(question_data.get('date_added'))}\n\n"
-    
-    option_a = question_data.get('option_a', '')
-    option_b = question_data.get('option_b', '')
-    option_c = question_data.get('option_c', '')
-    option_d = question_data.get('option_d', '')
-
-    question_text = (
-        f"📚 **Question / السؤال:**\n"
-        f"{question_data.get('question', 'No question')}\n\n"
-        f"📊 **Remaining:** {remaining_questions} / {total_questions}\n\n"
-        f"{date_added_text}"
-        "**Options / الخيارات:**\n"
-        f"A) {option_a}\n"
-        f"B) {option_b}\n"
-        f"C) {option_c}\n"
-        f"D) {option_d}"
-    )
-    
-    # إنشاء أزرار الخيارات - بدون ترجمة
-    keyboard = [
-        [
-            InlineKeyboardButton("A", callback_data="answer_A"),
-            InlineKeyboardButton("B", callback_data="answer_B"),
-        ],
-        [
-            InlineKeyboardButton("C", callback_data="answer_C"),
-            InlineKeyboardButton("D", callback_data="answer_D"),
-        ],
-        [InlineKeyboardButton("🔚 End Session / إنهاء الجلسة", callback_data="end_session")]
-    ]
-    
-    # حفظ بيانات السؤال في سياق المستخدم
-    context.user_data["current_question"] = {
-        "question_id": question_data.get('id', ''),
-        "correct_answer": question_data.get('correct_answer', ''),
-        "explanation": question_data.get('explanation', '')
-    }
-    
-    # حفظ بيانات السؤال الكاملة لعرض الإجابة الصحيحة
-    context.user_data["current_question_data"] = {
-        "option_a": option_a,
-        "option_b": option_b,
-        "option_c": option_c,
-        "option_d": option_d
-    }
+    # تنسيق السؤال مع عدد الأسئلة المتبقية (النص والأزرار من كاش الرسم)
+    header, footer, reply_markup = render_question(question_data)
+    question_text = f"{header}📊 **Remaining:** {remaining_questions} / {total_questions}\n\n{footer}"
+
+    # أي نسخة تستقبل الإجابة تجد السؤال في الكاش المشترك
+    await remember_question(question_data)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(question_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -876,22 +3005,27 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # تحديث آخر تفاعل
     user = query.from_user
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, user.id))
+    update_last_interaction(user.id)
     
-    # التحقق من وجود بيانات السؤال
-    if "current_question" not in context.user_data:
+    # السؤال من callback_data (a1:{qid}:{X}) أو من الجلسة للأزرار القديمة (answer_X)
+    parsed = parse_callback(query.data)
+    if parsed is not None:
+        _, question_id, selected_answer = parsed
+        question = await get_question_by_id(question_id)
+    else:
+        selected_answer = query.data.split("_")[1]
+        question = _legacy_current_question(context.user_data)
+
+    if not question:
         await query.edit_message_text("عذراً، حدث خطأ. يرجى البدء من جديد.")
         return
-    
-    selected_answer = query.data.split("_")[1]
-    correct_answer = context.user_data["current_question"]["correct_answer"]
-    explanation = context.user_data["current_question"]["explanation"]
-    question_id = context.user_data["current_question"]["question_id"]
-    
-    # حفظ الإجابة المختارة للعودة إليها
-    context.user_data["last_selected_answer"] = selected_answer
+
+    question_id = question.get('id')
+    correct_answer = question.get('correct_answer', '')
+    _record_answer_pace(context.user_data)
     
     if isinstance(question_id, int):
+        ANSWERED_IDS.add(user.id, question_id)
         recent_list = context.user_data.setdefault(RECENTLY_ANSWERED_KEY, [])
         if question_id in recent_list:
             recent_list.remove(question_id)
@@ -902,8 +3036,9 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # تحديد ما إذا كانت الإجابة صحيحة
     is_correct = selected_answer == correct_answer
     
-    # حفظ إجابة المستخدم (Fire-and-forget لتقليل زمن الاستجابة)
-    asyncio.create_task(asyncio.to_thread(save_user_answer, user.id, question_id, selected_answer, correct_answer, is_correct))
+    # حفظ إجابة المستخدم عبر طابور الكتابة المؤجلة (bulk insert في الخلفية)
+    await ANSWER_WRITER.put(build_answer_row(user.id, question_id, selected_answer, correct_answer, is_correct))
+    USER_STATS.record_answer(user.id, is_correct)
     
     # ✅ تحديث العدد فقط (أسرع من تتبع كل الـ IDs)
     try:
@@ -918,85 +3053,31 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning("Could not update session answered/remaining cache: %s", e)
 
     # إنشاء رسالة النتيجة والأزرار باستخدام الدالة المساعدة
-    result_message, reply_markup = await _create_result_message_and_keyboard(context)
+    result_message, reply_markup = render_result(question, selected_answer)
     await query.edit_message_text(result_message, reply_markup=reply_markup, parse_mode='Markdown')
 
-async def _create_result_message_and_keyboard(context: ContextTypes.DEFAULT_TYPE):
-    """Helper function to create the result message and keyboard after an answer."""
-    selected_answer = context.user_data.get("last_selected_answer", "")
-    correct_answer = context.user_data["current_question"]["correct_answer"]
-    explanation = context.user_data["current_question"]["explanation"]
-    
-    if selected_answer == correct_answer:
-        result_message = "✅ إجابة صحيحة!\nCorrect answer!\n\n"
-    else:
-        correct_answer_text = ""
-        question_data = context.user_data.get("current_question_data", {})
-        if question_data:
-            if correct_answer == "A":
-                correct_answer_text = f"A: {question_data.get('option_a', '')}"
-            elif correct_answer == "B":
-                correct_answer_text = f"B: {question_data.get('option_b', '')}"
-            elif correct_answer == "C":
-                correct_answer_text = f"C: {question_data.get('option_c', '')}"
-            elif correct_answer == "D":
-                correct_answer_text = f"D: {question_data.get('option_d', '')}"
-        
-        result_message = (
-            f"❌ إجابة خاطئة\n"
-            f"Wrong answer\n\n"
-            f"**Correct Answer / الإجابة الصحيحة:**\n"
-            f"{correct_answer_text}\n\n"
-        )
-    
-    if explanation:
-        result_message += f"**Explanation / الشرح:**\n{explanation}"
-    else:
-        result_message += "**No explanation available / لا يوجد شرح متاح**"
-    
-    keyboard = [
-        [InlineKeyboardButton("Next Question / السؤال التالي", callback_data="quiz")],
-        [InlineKeyboardButton("🚨 Report Question / الإبلاغ عن السؤال", callback_data="report")],
-        [InlineKeyboardButton("🔚 End Session / إنهاء الجلسة", callback_data="end_session")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    return result_message, reply_markup
 async def handle_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة الإبلاغ عن السؤال"""
     query = update.callback_query
     await query.answer()
     
     user = query.from_user
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, user.id))
-    
-    # التحقق من وجود بيانات السؤال
-    if "current_question" not in context.user_data:
-        await query.edit_message_text("عذراً، حدث خطأ. يرجى البدء من جديد.")
-        return
+    update_last_interaction(user.id)
     
-    question_id = context.user_data["current_question"]["question_id"]
+    # السؤال والإجابة المختارة من callback_data (r1:{qid}:{X}) أو من الجلسة (report)
+    parsed = parse_callback(query.data)
+    if parsed is not None:
+        _, question_id, selected_answer = parsed
+    else:
+        question = _legacy_current_question(context.user_data)
+        if not question:
+            await query.edit_message_text("عذراً، حدث خطأ. يرجى البدء من جديد.")
+            return
+        question_id = question['id']
+        selected_answer = context.user_data.get("last_selected_answer", "")
     
     # عرض خيارات الإبلاغ
-    report_keyboard = [
-        [InlineKeyboardButton("❌ Incorrect Answer / إجابة خاطئة", callback_data=f"report_incorrect_{question_id}")],
-        [InlineKeyboardButton("📝 Typo or Grammar / خطأ إملائي أو نحوي", callback_data=f"report_typo_{question_id}")],
-        [InlineKeyboardButton("🔍 Unclear Question / سؤال غير واضح", callback_data=f"report_unclear_{question_id}")],
-        [InlineKeyboardButton("📚 Wrong Topic / موضوع خاطئ", callback_data=f"report_topic_{question_id}")],
-        [InlineKeyboardButton("🔙 Back / العودة", callback_data="back_to_answer")]
-    ]
-    
-    report_markup = InlineKeyboardMarkup(report_keyboard)
-    
-    report_message = (
-        "🚨 **Report Question / الإبلاغ عن السؤال**\n\n"
-        "Please select the reason for reporting:\n"
-        "يرجى اختيار سبب الإبلاغ:\n\n"
-        "Choose the most appropriate reason to help us improve the question quality.\n"
-        "اختر السبب الأكثر ملاءمة لمساعدتنا في تحسين جودة السؤال."
-    )
-    
-    await query.edit_message_text(report_message, reply_markup=report_markup, parse_mode='Markdown')
+    await query.edit_message_text(REPORT_MENU_MESSAGE, reply_markup=render_report_menu(question_id, selected_answer), parse_mode='Markdown')
 
 async def handle_report_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة سبب الإبلاغ المحدد"""
@@ -1004,18 +3085,24 @@ async def handle_report_reason(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     
     user = query.from_user
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, user.id))
+    update_last_interaction(user.id)
     
-    # استخراج نوع البلاغ ومعرف السؤال
+    # استخراج نوع البلاغ ومعرف السؤال: rp1:{qid}:{X}:{code} أو report_{type}_{qid}
     callback_data = query.data
-    parts = callback_data.split('_')
-    
-    if len(parts) < 3:
-        await query.edit_message_text("عذراً، حدث خطأ في معالجة البلاغ.")
-        return
-    
-    report_type = parts[1]
-    question_id = int(parts[2])
+    parsed = parse_callback(callback_data)
+    if parsed is not None:
+        _, question_id, rest = parsed
+        selected_answer, _, code = rest.partition(":")
+        report_type = REPORT_REASON_CODES.get(code, code)
+        back_data = encode_callback(CB_BACK, question_id, selected_answer)
+    else:
+        parts = callback_data.split('_')
+        if len(parts) < 3:
+            await query.edit_message_text("عذراً، حدث خطأ في معالجة البلاغ.")
+            return
+        report_type = parts[1]
+        question_id = int(parts[2])
+        back_data = "back_to_answer"
     
     # تحديد سبب البلاغ
     report_reasons = {
@@ -1027,8 +3114,11 @@ async def handle_report_reason(update: Update, context: ContextTypes.DEFAULT_TYP
     
     report_reason = report_reasons.get(report_type, 'Other / أخرى')
     
-    # حفظ البلاغ
-    success = await asyncio.to_thread(report_question, user.id, question_id, report_reason)
+    # حفظ البلاغ: على الصف المعلّق في طابور الكتابة إن وُجد، وإلا تحديث مباشر في قاعدة البيانات
+    success = (
+        await ANSWER_WRITER.report(user.id, question_id, report_reason)
+        or await report_question(user.id, question_id, report_reason)
+    )
     
     if success:
         success_message = (
@@ -1041,13 +3131,7 @@ async def handle_report_reason(update: Update, context: ContextTypes.DEFAULT_TYP
             "سنراجع بلاغك ونتخذ الإجراء المناسب."
         )
         
-        keyboard = [
-            [InlineKeyboardButton("Next Question / السؤال التالي", callback_data="quiz")],
-            [InlineKeyboardButton("🔚 End Session / إنهاء الجلسة", callback_data="end_session")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(success_message, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(success_message, reply_markup=REPORT_DONE_KEYBOARD, parse_mode='Markdown')
     else:
         error_message = (
             "❌ **Report Failed / فشل في إرسال البلاغ**\n\n"
@@ -1058,7 +3142,7 @@ async def handle_report_reason(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         
         keyboard = [
-            [InlineKeyboardButton("🔙 Back / العودة", callback_data="back_to_answer")],
+            [InlineKeyboardButton("🔙 Back / العودة", callback_data=back_data)],
             [InlineKeyboardButton("🔚 End Session / إنهاء الجلسة", callback_data="end_session")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1070,10 +3154,18 @@ async def back_to_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    # إعادة عرض الإجابة مع الأزرار
-    if "current_question" in context.user_data:
+    # إعادة عرض الإجابة مع الأزرار: b1:{qid}:{X} أو من الجلسة (back_to_answer)
+    parsed = parse_callback(query.data)
+    if parsed is not None:
+        _, question_id, selected_answer = parsed
+        question = await get_question_by_id(question_id)
+    else:
+        question = _legacy_current_question(context.user_data)
+        selected_answer = context.user_data.get("last_selected_answer", "")
+
+    if question:
         # إعادة إنشاء رسالة النتيجة والأزرار باستخدام الدالة المساعدة
-        result_message, reply_markup = await _create_result_message_and_keyboard(context)
+        result_message, reply_markup = render_result(question, selected_answer)
         await query.edit_message_text(result_message, reply_markup=reply_markup, parse_mode='Markdown')
     else:
         await query.edit_message_text("عذراً، لا يمكن العودة إلى الإجابة.")
@@ -1082,7 +3174,7 @@ async def test_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """اختبار عدد الأسئلة الحقيقي"""
     try:
         # طريقة 1: استخدام count
-        count_response = (
+        count_response = await (
             supabase.table('questions')
             .select('*', count='exact')
             .eq('ai_review_status', 'correct')
@@ -1091,7 +3183,7 @@ async def test_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
         count_method = count_response.count if hasattr(count_response, 'count') else 'Not available'
         
         # طريقة 2: جلب جميع الأسئلة
-        all_response = (
+        all_response = await (
             supabase.table('questions')
             .select('id')
             .eq('ai_review_status', 'correct')
@@ -1100,7 +3192,7 @@ async def test_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
         all_method = len(all_response.data)
         
         # طريقة 3: جلب آخر 1000 سؤال
-        limit_response = (
+        limit_response = await (
             supabase.table('questions')
             .select('id')
             .eq('ai_review_status', 'correct')
@@ -1128,16 +3220,12 @@ async def test_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def db_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """عرض معلومات قاعدة البيانات"""
     try:
-        # معلومات الأسئلة
-        questions_count = get_total_questions_count()
-        
-        # معلومات المستخدمين
-        users_response = supabase.table('target_users').select('telegram_id', count='exact').execute()
-        users_count = users_response.count if hasattr(users_response, 'count') else len(users_response.data)
-        
-        # معلومات الإجابات
-        answers_response = supabase.table('user_answers_bot').select('id', count='exact').execute()
-        answers_count = answers_response.count if hasattr(answers_response, 'count') else len(answers_response.data)
+        # معلومات الأسئلة والمستخدمين والإجابات (من كاش stale-while-revalidate)
+        questions_count, users_count, answers_count = await asyncio.gather(
+            TOTAL_QUESTIONS_CACHE.get(),
+            USERS_COUNT_CACHE.get(),
+            ANSWERS_COUNT_CACHE.get(),
+        )
         
         info_message = (
             "🗄️ **Database Information / معلومات قاعدة البيانات:**\n\n"
@@ -1230,163 +3318,1288 @@ async def test_bot_permissions(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         await update.message.reply_text(error_message, parse_mode='Markdown')
 
-@time_it_sync
-def report_question(user_id: int, question_id: int, report_reason: str):
-    """الإبلاغ عن سؤال"""
-    try:
-        # تحديث السجل الموجود أو إنشاء سجل جديد
-        response = supabase.table('user_answers_bot').update({
-            'is_reported': True,
-            'report_reason': report_reason
-        }).eq('user_id', user_id).eq('question_id', question_id).execute()
-        
-        logger.info("Question %s reported by user %s: %s", question_id, user_id, report_reason)
-        return True
-    except Exception as e:
-        logger.warning("Could not report question %s for user %s: %s", question_id, user_id, e)
-        return False
+@profiled
+async def report_question(user_id: int, question_id: int, report_reason: str):
+    """الإبلاغ عن سؤال"""
+    try:
+        # تحديث السجل الموجود أو إنشاء سجل جديد
+        response = await supabase.table('user_answers_bot').update({
+            'is_reported': True,
+            'report_reason': report_reason
+        }, returning='minimal').eq('user_id', user_id).eq('question_id', question_id).execute()
+        
+        logger.info("Question %s reported by user %s: %s", question_id, user_id, report_reason, extra=DB_LOG)
+        return True
+    except Exception as e:
+        logger.warning("Could not report question %s for user %s: %s", question_id, user_id, e)
+        return False
+
+def _is_channel_member(member) -> bool:
+    """الحالات المقبولة: member, administrator, creator (أو restricted ما زال عضواً)."""
+    if member.status in ('member', 'administrator', 'creator'):
+        return True
+    return member.status == 'restricted' and bool(getattr(member, 'is_member', False))
+
+
+class ChannelMembershipIndex:
+    """فهرس اشتراك المستخدمين في القناة (TTL + LRU) يُحدّث من تحديثات chat_member.
+
+    - العضو يُخزن MEMBERSHIP_TTL، وغير العضو (negative cache) لمدة أقصر.
+    - عند عدم وجوده: الكاش المشترك ثم get_chat_member، بطلب واحد لكل مستخدم مهما تزامنت الطلبات.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_users: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_users = max_users
+        self._entries = OrderedDict()  # telegram_id -> (is_member, expires_at)
+        self._loading = {}
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.events = 0
+
+    def _ttl_for(self, is_member: bool) -> float:
+        return self.ttl if is_member else self.negative_ttl
+
+    def _remember(self, telegram_id: int, is_member: bool):
+        self._entries[telegram_id] = (is_member, time.monotonic() + self._ttl_for(is_member))
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def peek(self, telegram_id: int):
+        """الحالة من الذاكرة فقط، أو None."""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._entries[telegram_id]
+            return None
+        self._entries.move_to_end(telegram_id)
+        return entry[0]
+
+    async def is_member(self, telegram_id: int, bot, force: bool = False) -> bool:
+        if not force:
+            cached = self.peek(telegram_id)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        self.misses += 1
+        # force لا ينضم لتحميل عادي جارٍ (قد يرجع من الكاش المشترك) - يحتاج get_chat_member فعلياً
+        key = (telegram_id, force)
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(telegram_id, bot, force))
+            self._loading[key] = task
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, telegram_id: int, bot, force: bool) -> bool:
+        if not force:
+            shared = await SHARED_CACHE.get("subscription", telegram_id)
+            if shared is not None:
+                self._remember(telegram_id, shared)
+                return shared
+
+        # إزالة @ من معرف القناة إذا كان موجوداً
+        channel_id = TELEGRAM_CHANNEL_ID.lstrip('@')
+        self.api_calls += 1
+        member = await bot.get_chat_member(f"@{channel_id}", telegram_id)
+        is_member = _is_channel_member(member)
+        if is_member:
+            logger.info("User %s is subscribed to channel @%s", telegram_id, channel_id, extra=UPDATE_LOG)
+        else:
+            logger.warning("User %s is NOT subscribed to channel @%s (status: %s)", telegram_id, channel_id, member.status)
+        await self.record(telegram_id, is_member)
+        return is_member
+
+    async def record(self, telegram_id: int, is_member: bool):
+        """تحديث الحالة محلياً وفي الكاش المشترك."""
+        self._remember(telegram_id, is_member)
+        await SHARED_CACHE.set("subscription", telegram_id, is_member, ttl=self._ttl_for(is_member))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'users': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'api_calls': self.api_calls,
+            'events': self.events,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+CHANNEL_MEMBERSHIP = ChannelMembershipIndex(
+    ttl=MEMBERSHIP_TTL,
+    negative_ttl=MEMBERSHIP_NEGATIVE_TTL,
+    max_users=MEMBERSHIP_MAX_USERS,
+)
+
+
+def _is_subscription_channel(chat) -> bool:
+    channel = TELEGRAM_CHANNEL_ID.strip()
+    if not channel or chat is None:
+        return False
+    if channel.lstrip('-').isdigit():
+        return chat.id == int(channel)
+    return (chat.username or '').lower() == channel.lstrip('@').lower()
+
+
+async def handle_channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تحديثات chat_member للقناة (انضمام/مغادرة) → فهرس الاشتراك، بدون طلبات API."""
+    change = update.chat_member
+    if change is None or not _is_subscription_channel(change.chat):
+        return
+    member = change.new_chat_member
+    CHANNEL_MEMBERSHIP.events += 1
+    await CHANNEL_MEMBERSHIP.record(member.user.id, _is_channel_member(member))
+
+
+async def check_channel_subscription(user_id: int, bot, force: bool = False):
+    """التحقق من اشتراك المستخدم في القناة (من الفهرس المحلي غالباً)"""
+    if not CHANNEL_SUBSCRIPTION_REQUIRED:
+        return True
+    
+    try:
+        return await CHANNEL_MEMBERSHIP.is_member(user_id, bot, force=force)
+    except Exception as e:
+        logger.error("Could not check channel subscription for user %s: %s", user_id, e)
+        # في حالة الخطأ، نفترض أن المستخدم مشترك (لعدم إيقاف البوت)
+        return True
+
+async def show_subscription_required(update: Update, context: ContextTypes.DEFAULT_TYPE, is_new_user: bool = False):
+    """عرض رسالة طلب الاشتراك في القناة"""
+    
+    if is_new_user:
+        # للمستخدمين الجدد - بعد 10 أسئلة
+        message = (
+            "🎉 **Congratulations! / مبروك!**\n\n"
+            "You've completed your first 10 questions!\n"
+            "لقد أكملت أول 10 أسئلة!\n\n"
+            "🌟 **To continue learning, please subscribe to our channel:**\n"
+            "🌟 **لمتابعة التعلم، يرجى الاشتراك في قناتنا:**\n\n"
+            f"📢 **Channel:** {TELEGRAM_CHANNEL_ID}\n"
+            f"🔗 **Link:** {TELEGRAM_CHANNEL_LINK}\n\n"
+            "After subscribing, you can continue with more questions!\n"
+            "بعد الاشتراك، يمكنك متابعة المزيد من الأسئلة!"
+        )
+    else:
+        # للمستخدمين القدامى - عند إلغاء الاشتراك
+        message = (
+            "⚠️ **Subscription Required / الاشتراك مطلوب**\n\n"
+            "Your access has been paused.\n"
+            "تم إيقاف وصولك مؤقتاً.\n\n"
+            "🌟 **Please subscribe to our channel to continue:**\n"
+            "🌟 **يرجى الاشتراك في قناتنا للمتابعة:**\n\n"
+            f"📢 **Channel:** {TELEGRAM_CHANNEL_ID}\n"
+            f"🔗 **Link:** {TELEGRAM_CHANNEL_LINK}\n\n"
+            "After subscribing, click 'Check Subscription' below.\n"
+            "بعد الاشتراك، اضغط على 'التحقق من الاشتراك' أدناه."
+        )
+    
+    # إنشاء الأزرار
+    keyboard = [
+        [InlineKeyboardButton("📢 Join Channel / انضم للقناة", url=TELEGRAM_CHANNEL_LINK)],
+        [InlineKeyboardButton("✅ Check Subscription / التحقق من الاشتراك", callback_data="check_subscription")],
+        [InlineKeyboardButton("🏠 Main Menu / القائمة الرئيسية", callback_data="menu")]
+    ]
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    if hasattr(update, 'callback_query') and update.callback_query:
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    else:
+        await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """التحقق من الاشتراك في القناة"""
+    query = update.callback_query
+    await query.answer()
+    
+    user = query.from_user
+    update_last_interaction(user.id)
+    
+    # التحقق من الاشتراك (طلب مباشر: المستخدم يقول إنه اشترك للتو)
+    is_subscribed = await check_channel_subscription(user.id, context.bot, force=True)
+    
+    if is_subscribed:
+        # المستخدم مشترك - يمكنه المتابعة
+        success_message = (
+            "✅ **Subscription Verified! / تم التحقق من الاشتراك!**\n\n"
+            "Welcome back! You can now continue learning.\n"
+            "مرحباً بعودتك! يمكنك الآن متابعة التعلم.\n\n"
+            "Choose what you want to do:\n"
+            "اختر ما تريد القيام به:"
+        )
+        
+        keyboard = [
+            [InlineKeyboardButton("🚀 Start Quiz / بدء الاختبار", callback_data="quiz")],
+            [InlineKeyboardButton("📊 My Stats / إحصائياتي", callback_data="stats")],
+            [InlineKeyboardButton("🏠 Main Menu / القائمة الرئيسية", callback_data="menu")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await query.edit_message_text(success_message, reply_markup=reply_markup, parse_mode='Markdown')
+    else:
+        # المستخدم غير مشترك
+        await show_subscription_required(update, context, is_new_user=False)
+
+# --- Shared state store (sessions + caches) ---
+# الواجهة المشتركة لكل المخازن (كلها async، القيم bytes):
+#   get / set(ttl) / delete / load_all(namespace) / write_batch / close / stats
+# shared=True يعني أن المخزن مشترك بين عدة عمليات/نسخ (Redis) فيجب تحديث الجلسة قبل كل تحديث.
+
+class MemoryStateStore:
+    """مخزن داخل العملية - للتشغيل بنسخة واحدة بدون حفظ، وكبديل محلي في الاختبارات."""
+
+    def __init__(self, shared: bool = False):
+        self.shared = shared
+        self._data = {}
+
+    def _alive(self, entry) -> bool:
+        return entry[1] is None or entry[1] > time.time()
+
+    async def get(self, namespace: str, key: str):
+        entry = self._data.get((namespace, key))
+        if entry is None or not self._alive(entry):
+            return None
+        return entry[0]
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float = None):
+        self._data[(namespace, key)] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, namespace: str, key: str):
+        self._data.pop((namespace, key), None)
+
+    async def load_all(self, namespace: str) -> dict:
+        return {
+            key: entry[0]
+            for (ns, key), entry in self._data.items()
+            if ns == namespace and self._alive(entry)
+        }
+
+    async def write_batch(self, namespace: str, upserts: dict, deletes=()):
+        for key, value in upserts.items():
+            self._data[(namespace, key)] = (value, None)
+        for key in deletes:
+            self._data.pop((namespace, key), None)
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {'backend': 'memory', 'shared': self.shared, 'keys': len(self._data)}
+
+
+class SQLiteStateStore:
+    """مخزن مفتاح/قيمة على SQLite (WAL) - نسخة واحدة، يبقى بعد إعادة التشغيل.
+
+    العمليات الفعلية متزامنة وتنفذ في ثريد (executor اللوب) وليس على اللوب.
+    """
+
+    shared = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            import sqlite3  # يُستورد عند أول استخدام (ليس في مسار الإقلاع)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bot_state ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _get_sync(self, namespace: str, key: str):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value FROM bot_state WHERE namespace = ? AND key = ?"
+                " AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _write_sync(self, namespace: str, upserts: dict, deletes=(), ttl: float = None):
+        """كتابة دفعة واحدة في معاملة واحدة."""
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                if upserts:
+                    conn.executemany(
+                        "INSERT INTO bot_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value,"
+                        " expires_at = excluded.expires_at",
+                        [(namespace, key, value, expires_at) for key, value in upserts.items()],
+                    )
+                if deletes:
+                    conn.executemany(
+                        "DELETE FROM bot_state WHERE namespace = ? AND key = ?",
+                        [(namespace, key) for key in deletes],
+                    )
+
+    def _load_all_sync(self, namespace: str) -> dict:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT key, value FROM bot_state WHERE namespace = ?"
+                " AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, time.time()),
+            ).fetchall()
+        return {key: value for key, value in rows}
+
+    def _close_sync(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    async def _run(func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(None, func, *args)
+        except RuntimeError:
+            # أثناء خروج العملية (atexit) يرفض الـ executor مهاماً جديدة → تنفيذ مباشر
+            return func(*args)
+        return await future
+
+    async def get(self, namespace: str, key: str):
+        return await self._run(self._get_sync, namespace, key)
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float = None):
+        await self._run(self._write_sync, namespace, {key: value}, (), ttl)
+
+    async def delete(self, namespace: str, key: str):
+        await self._run(self._write_sync, namespace, {}, (key,))
+
+    async def load_all(self, namespace: str) -> dict:
+        return await self._run(self._load_all_sync, namespace)
+
+    async def write_batch(self, namespace: str, upserts: dict, deletes=()):
+        await self._run(self._write_sync, namespace, upserts, deletes)
+
+    async def close(self):
+        await self._run(self._close_sync)
+
+    def stats(self) -> dict:
+        return {'backend': 'sqlite', 'shared': self.shared, 'path': self.path}
+
+
+class RedisStateStore:
+    """مخزن مشترك على Redis (أو أي خادم متوافق مع بروتوكول Redis) لعدة workers/نسخ.
+
+    المفاتيح بصيغة {prefix}:{namespace}:{key}. يحتاج مكتبة redis (اختيارية).
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "quizbot", client=None):
+        if client is None:
+            if importlib.util.find_spec("redis") is None:
+                raise RuntimeError("STATE_BACKEND=redis requires the 'redis' package (pip install redis)")
+            import redis.asyncio as aioredis
+            client = aioredis.from_url(url)
+        self.prefix = prefix
+        self._redis = client
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    async def get(self, namespace: str, key: str):
+        return await self._redis.get(self._key(namespace, key))
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float = None):
+        await self._redis.set(self._key(namespace, key), value, px=int(ttl * 1000) if ttl else None)
+
+    async def delete(self, namespace: str, key: str):
+        await self._redis.delete(self._key(namespace, key))
+
+    async def load_all(self, namespace: str) -> dict:
+        prefix = self._key(namespace, "")
+        keys = [key async for key in self._redis.scan_iter(match=prefix + "*", count=1000)]
+        result = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            for raw_key, value in zip(chunk, await self._redis.mget(chunk)):
+                if value is None:
+                    continue
+                if isinstance(raw_key, bytes):
+                    raw_key = raw_key.decode()
+                result[raw_key[len(prefix):]] = value
+        return result
+
+    async def write_batch(self, namespace: str, upserts: dict, deletes=()):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, value in upserts.items():
+                pipe.set(self._key(namespace, key), value)
+            for key in deletes:
+                pipe.delete(self._key(namespace, key))
+            await pipe.execute()
+
+    async def close(self):
+        await self._redis.aclose()
+
+    def stats(self) -> dict:
+        return {'backend': 'redis', 'shared': self.shared, 'prefix': self.prefix}
+
+
+class NearCache:
+    """كاش محلي صغير (TTL + LRU) أمام مخزن الحالة لقيم الكاش المشتركة.
+
+    القراءة من الذاكرة أولاً ثم من المخزن؛ الكتابة للاثنين (write-through).
+    القيم تُخزن كـ pickle في المخزن وككائنات Python محلياً.
+    مع مخزن غير مشترك (نسخة واحدة) يعمل ككاش محلي فقط بمدة الصلاحية كاملة.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store = MemoryStateStore()
+        self._entries = OrderedDict()
+        self.local_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def bind(self, store):
+        self.store = store
+        self._entries.clear()
+
+    def _remember(self, cache_key, value, ttl: float = None):
+        if not self.store.shared:
+            local_ttl = ttl or self.ttl
+        else:
+            local_ttl = min(self.ttl, ttl) if ttl else self.ttl
+        self._entries[cache_key] = (value, time.monotonic() + local_ttl)
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, namespace: str, key, default=None):
+        cache_key = (namespace, key)
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entries.move_to_end(cache_key)
+                self.local_hits += 1
+                return entry[0]
+            del self._entries[cache_key]
+        if not self.store.shared:
+            self.misses += 1
+            return default
+        try:
+            blob = await self.store.get(namespace, str(key))
+        except Exception as e:
+            self.errors += 1
+            logger.warning("State store read failed for %s/%s: %s", namespace, key, e)
+            return default
+        if blob is None:
+            self.misses += 1
+            return default
+        value = pickle.loads(blob)
+        self.store_hits += 1
+        self._remember(cache_key, value)
+        return value
+
+    async def set(self, namespace: str, key, value, ttl: float = None):
+        self._remember((namespace, key), value, ttl)
+        if not self.store.shared:
+            return
+        try:
+            await self.store.set(namespace, str(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ttl)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("State store write failed for %s/%s: %s", namespace, key, e)
+
+    def stats(self) -> dict:
+        lookups = self.local_hits + self.store_hits + self.misses
+        return {
+            'store': self.store.stats(),
+            'entries': len(self._entries),
+            'local_hits': self.local_hits,
+            'store_hits': self.store_hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': round((self.local_hits + self.store_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+SHARED_CACHE = NearCache(ttl=NEAR_CACHE_TTL, max_entries=NEAR_CACHE_MAX_ENTRIES)
+
+
+def _build_state_store():
+    """إنشاء مخزن الحالة حسب STATE_BACKEND."""
+    if STATE_BACKEND == "redis":
+        if not REDIS_URL:
+            raise RuntimeError("STATE_BACKEND=redis requires REDIS_URL")
+        return RedisStateStore(REDIS_URL, prefix=REDIS_KEY_PREFIX)
+    if STATE_BACKEND == "sqlite" and PERSISTENCE_PATH:
+        return SQLiteStateStore(PERSISTENCE_PATH)
+    return MemoryStateStore()
+
+
+# --- Session persistence (context.user_data / bot_data) ---
+
+def _persistable_user_data(data: dict) -> dict:
+    """نسخة من user_data بدون المفاتيح المؤقتة (مهام asyncio وغيرها)."""
+    return {
+        key: value
+        for key, value in data.items()
+        if key not in TRANSIENT_USER_DATA_KEYS and not isinstance(value, asyncio.Future)
+    }
+
+
+class BotStatePersistence(BasePersistence):
+    """PTB persistence لـ user_data و bot_data فوق مخزن الحالة.
+
+    - التحميل مرة واحدة عند initialize.
+    - PTB يستدعي update_* كل update_interval ثانية (خارج مسار معالجة التحديث)،
+      وهنا نحوّلها لـ pickle ونجمعها، ثم الكتابة دفعة واحدة في مهمة خلفية.
+    - مع مخزن مشترك (Redis): تُقرأ جلسة المستخدم قبل كل تحديث (refresh_user_data)
+      وتُكتب مباشرة بعد انتهائه (sync_now)، حتى لو وصل التحديث التالي لنسخة أخرى.
+    """
+
+    USER_NS = "user_data"
+    BOT_NS = "bot_data"
+
+    def __init__(self, store, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self._pending = {self.USER_NS: {}, self.BOT_NS: {}}
+        self._deleted = {self.USER_NS: set(), self.BOT_NS: set()}
+        self._written_digests = {}
+        self._write_task = None
+        # Metrics
+        self.loaded_users = 0
+        self.refreshed = 0
+        self.writes = 0
+        self.rows_written = 0
+        self.write_errors = 0
+        self.last_write_ms = 0.0
+
+    # --- loading ---
+    async def get_user_data(self):
+        rows = await self.store.load_all(self.USER_NS)
+        user_data = {}
+        for key, blob in rows.items():
+            try:
+                user_data[int(key)] = pickle.loads(blob)
+            except Exception as e:
+                logger.warning("Skipping unreadable user_data for %s: %s", key, e)
+                continue
+            self._written_digests[(self.USER_NS, key)] = hash(blob)
+        self.loaded_users = len(user_data)
+        logger.info("Loaded persisted user_data for %s users", self.loaded_users)
+        return user_data
+
+    async def get_bot_data(self):
+        blob = await self.store.get(self.BOT_NS, "bot_data")
+        if blob is None:
+            return {}
+        try:
+            return pickle.loads(blob)
+        except Exception as e:
+            logger.warning("Skipping unreadable bot_data: %s", e)
+            return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return {}
+
+    # --- updates (batched) ---
+    def _stage(self, namespace: str, key: str, value):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning("Cannot persist %s/%s: %s", namespace, key, e)
+            return
+        # PTB يرسل bot_data كل دورة حتى لو ما تغيرت - نتجاهل القيم المطابقة لآخر كتابة
+        digest = hash(blob)
+        if self._written_digests.get((namespace, key)) == digest:
+            return
+        self._written_digests[(namespace, key)] = digest
+        self._deleted[namespace].discard(key)
+        self._pending[namespace][key] = blob
+        self._schedule_write()
+
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # ننتظر دورة واحدة حتى تتجمع كل استدعاءات update_* من نفس الدفعة
+        await asyncio.sleep(0)
+        while any(self._pending.values()) or any(self._deleted.values()):
+            for namespace in (self.USER_NS, self.BOT_NS):
+                upserts, self._pending[namespace] = self._pending[namespace], {}
+                deletes, self._deleted[namespace] = self._deleted[namespace], set()
+                if not upserts and not deletes:
+                    continue
+                started = time.perf_counter()
+                try:
+                    await self.store.write_batch(namespace, upserts, deletes)
+                    self.writes += 1
+                    self.rows_written += len(upserts) + len(deletes)
+                except Exception as e:
+                    self.write_errors += 1
+                    logger.error("Persistence write failed (%s rows): %s", len(upserts) + len(deletes), e)
+                    # نرجعها للدفعة الجاية بدون ما نغطي على قيم أحدث
+                    for key, blob in upserts.items():
+                        self._pending[namespace].setdefault(key, blob)
+                        self._written_digests.pop((namespace, key), None)
+                    self._deleted[namespace].update(deletes)
+                    return
+                self.last_write_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._stage(self.USER_NS, str(user_id), _persistable_user_data(data))
+
+    async def update_bot_data(self, data: dict):
+        self._stage(self.BOT_NS, "bot_data", data)
+
+    async def drop_user_data(self, user_id: int):
+        key = str(user_id)
+        self._pending[self.USER_NS].pop(key, None)
+        self._written_digests.pop((self.USER_NS, key), None)
+        self._deleted[self.USER_NS].add(key)
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        """مع مخزن مشترك: تحميل آخر نسخة من الجلسة إذا غيّرتها نسخة أخرى."""
+        if not self.store.shared:
+            return
+        key = str(user_id)
+        if key in self._pending[self.USER_NS]:
+            return  # عندنا تغييرات محلية أحدث لم تُكتب بعد
+        try:
+            blob = await self.store.get(self.USER_NS, key)
+        except Exception as e:
+            logger.warning("Session refresh failed for user %s: %s", user_id, e)
+            return
+        if blob is None:
+            return
+        digest = hash(blob)
+        if self._written_digests.get((self.USER_NS, key)) == digest:
+            return  # نفس النسخة الموجودة محلياً
+        try:
+            data = pickle.loads(blob)
+        except Exception as e:
+            logger.warning("Skipping unreadable user_data for %s: %s", user_id, e)
+            return
+        transient = {k: user_data[k] for k in TRANSIENT_USER_DATA_KEYS if k in user_data}
+        user_data.clear()
+        user_data.update(data)
+        user_data.update(transient)
+        self._written_digests[(self.USER_NS, key)] = digest
+        self.refreshed += 1
+        # الجلسة كتبتها نسخة أخرى → إجابات هذا المستخدم المخزنة محلياً قد تكون ناقصة
+        USER_STATS.invalidate(user_id)
+        ANSWERED_IDS.invalidate(user_id)
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def _wait_written(self):
+        while self._write_task is not None and not self._write_task.done():
+            await self._write_task
+
+    async def sync_now(self, app):
+        """كتابة جلسات التحديثات المنتهية فوراً (للمخزن المشترك بعد كل تحديث)."""
+        await app.update_persistence()
+        await self._wait_written()
+
+    async def flush(self):
+        """كتابة أي تغييرات معلقة ثم إغلاق المخزن (يُستدعى من application.shutdown)."""
+        await self._wait_written()
+        if any(self._pending.values()) or any(self._deleted.values()):
+            await self._write_pending()
+        await self.store.close()
+
+    def stats(self) -> dict:
+        return {
+            'store': self.store.stats(),
+            'loaded_users': self.loaded_users,
+            'refreshed': self.refreshed,
+            'pending_rows': sum(len(v) for v in self._pending.values()) + sum(len(v) for v in self._deleted.values()),
+            'writes': self.writes,
+            'rows_written': self.rows_written,
+            'write_errors': self.write_errors,
+            'last_write_ms': self.last_write_ms,
+            'update_interval': self.update_interval,
+        }
+
+
+def _build_persistence(store):
+    """إنشاء طبقة الحفظ فوق المخزن (None = بدون حفظ، للمخزن في الذاكرة)."""
+    if isinstance(store, MemoryStateStore):
+        return None
+    return BotStatePersistence(store, update_interval=PERSISTENCE_UPDATE_INTERVAL)
+
+
+# --- Outbound Telegram requests (rate limiting) ---
+
+class TokenBucket:
+    """Token bucket غير متزامن: rate طلب/ثانية مع سماح بدفعة burst. الانتظار بالترتيب (FIFO)."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """انتظار توكن."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """إيقاف الدلو بعد RetryAfter من تيليجرام."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    @property
+    def idle(self) -> bool:
+        return not self._lock.locked() and self._paused_until <= time.monotonic()
+
+
+class _MethodMetrics:
+    __slots__ = ("queued", "sent", "superseded", "retries", "failed", "wait_total", "latency_total", "latency_max")
+
+    def __init__(self):
+        self.queued = 0
+        self.sent = 0
+        self.superseded = 0
+        self.retries = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'superseded': self.superseded,
+            'retries': self.retries,
+            'failed': self.failed,
+            'avg_wait_ms': round(self.wait_total / self.sent * 1000, 1) if self.sent else 0.0,
+            'avg_latency_ms': round(self.latency_total / self.sent * 1000, 1) if self.sent else 0.0,
+            'max_latency_ms': round(self.latency_max * 1000, 1),
+        }
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """جدولة طلبات Bot API الصادرة (يُركّب عبر ApplicationBuilder.rate_limiter).
+
+    - حد عام لكل البوت + حد لكل محادثة (token buckets)، طلبات get* مستثناة.
+    - RetryAfter: إيقاف دلو المحادثة (أو العام) للمدة المطلوبة ثم إعادة المحاولة من الطابور.
+    - تعديل رسالة لم يعد له معنى يُلغى: إذا كان callback أحدث لنفس الرسالة ينتظر في مسار
+      المستخدم (superseded_by)، فمعالجه سيعيد رسم الرسالة (مثلاً نتيجة الإجابة ← السؤال التالي).
+    - إحصائيات لكل method: الطابور، زمن الانتظار، زمن الطلب.
+    """
+
+    SUPERSEDABLE = frozenset({"editMessageText", "editMessageReplyMarkup", "editMessageCaption"})
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float,
+                 group_rate: float, max_retries: int, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chat_buckets = OrderedDict()
+        self._metrics = {}
+        self.superseded_by = None  # (chat_id, message_id) -> bool، يربطه UpdateDispatcher
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # المعرفات السالبة/النصية = مجموعات وقنوات (حدود تيليجرام أقل)
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > self.max_chats:
+                # نحذف أقدم دلو غير مستخدم حالياً
+                for old_id, old_bucket in self._chat_buckets.items():
+                    if old_bucket.idle:
+                        del self._chat_buckets[old_id]
+                        break
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        metrics = self._metrics.get(endpoint)
+        if metrics is None:
+            metrics = self._metrics[endpoint] = _MethodMetrics()
+
+        chat_id = data.get("chat_id")
+        limited = chat_id is not None and not endpoint.startswith("get")
+        if isinstance(chat_id, str):
+            try:
+                chat_id = int(chat_id)
+            except ValueError:
+                pass
+
+        message_id = data.get("message_id")
+        supersedable = (endpoint in self.SUPERSEDABLE and chat_id is not None
+                        and message_id is not None and self.superseded_by is not None)
+
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self.max_retries
+        metrics.queued += 1
+        queued_at = time.perf_counter()
+        try:
+            for attempt in range(max_retries + 1):
+                if supersedable and self.superseded_by(chat_id, message_id):
+                    break
+                if limited:
+                    await self._chat_bucket(chat_id).acquire()
+                    await self.global_bucket.acquire()
+                    if supersedable and self.superseded_by(chat_id, message_id):
+                        break  # وصل callback أحدث أثناء الانتظار (مثلاً إيقاف RetryAfter)
+                started = time.perf_counter()
+                try:
+                    result = await callback(*args, **kwargs)
+                except RetryAfter as exc:
+                    retry_after = exc.retry_after.total_seconds() if hasattr(exc.retry_after, "total_seconds") else exc.retry_after
+                    bucket = self._chat_bucket(chat_id) if limited else self.global_bucket
+                    bucket.pause(float(retry_after) + 0.1)
+                    if attempt == max_retries:
+                        metrics.failed += 1
+                        METRICS.inc("bot_api_errors_total", method=endpoint)
+                        logger.warning("Telegram flood limit on %s (chat %s) after %s retries", endpoint, chat_id, attempt)
+                        raise
+                    metrics.retries += 1
+                    logger.info("Telegram RetryAfter %.1fs on %s (chat %s), retrying", float(retry_after), endpoint, chat_id)
+                    continue
+                except Exception:
+                    METRICS.inc("bot_api_errors_total", method=endpoint)
+                    raise
+                latency = time.perf_counter() - started
+                METRICS.observe("bot_api_request_seconds", latency, method=endpoint)
+                METRICS.observe("bot_api_wait_seconds", started - queued_at, method=endpoint)
+                metrics.sent += 1
+                metrics.wait_total += started - queued_at
+                metrics.latency_total += latency
+                metrics.latency_max = max(metrics.latency_max, latency)
+                return result
+            # callback أحدث سيعدّل نفس الرسالة - هذا التعديل لم يعد له معنى
+            metrics.superseded += 1
+            METRICS.inc("bot_api_superseded_total", method=endpoint)
+            return True
+        finally:
+            metrics.queued -= 1
+
+    def stats(self) -> dict:
+        return {
+            'tracked_chats': len(self._chat_buckets),
+            'methods': {name: metrics.as_dict() for name, metrics in self._metrics.items()},
+        }
+
+
+OUTBOUND_LIMITER = OutboundRateLimiter(
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    chat_rate=OUTBOUND_CHAT_RATE,
+    chat_burst=OUTBOUND_CHAT_BURST,
+    group_rate=OUTBOUND_GROUP_RATE,
+    max_retries=OUTBOUND_MAX_RETRIES,
+)
+
+
+# --- Update dispatch (webhook → process_update) ---
+
+def _update_lane_key(update: Update):
+    """مفتاح الترتيب: المستخدم، ثم المحادثة، وإلا التحديث نفسه (بدون ترتيب)."""
+    if update.effective_user:
+        return ('user', update.effective_user.id)
+    if update.effective_chat:
+        return ('chat', update.effective_chat.id)
+    return ('update', update.update_id)
+
+
+def _callback_message_key(update: Update):
+    """(chat_id, message_id) للرسالة التي ضُغط زرها، أو None."""
+    query = update.callback_query
+    if query is None or query.message is None:
+        return None
+    return (query.message.chat.id, query.message.message_id)
+
+
+class UpdateDispatcher:
+    """مرحلة توزيع التحديثات بين الويبهوك و application.process_update.
+
+    - طابور محدود (DISPATCH_QUEUE_MAX) مع عدد ثابت من العمال (DISPATCH_WORKERS).
+    - مسار (lane) لكل مستخدم: تحديثات نفس المستخدم تتنفذ بالترتيب واحد ورا الثاني،
+      والمستخدمين المختلفين بالتوازي حتى DISPATCH_WORKERS.
+    - LRU لآخر update_id لتجاهل التحديثات المكررة (إعادة الإرسال من تيليجرام).
+    - newer_callback_waiting(): هل ينتظر في المسار callback أحدث لنفس الرسالة
+      (يستخدمه OutboundRateLimiter لإلغاء التعديلات القديمة).
+    - رفض صريح (429/503) عند امتلاء الطابور أو تأخر اللوب، بدل تراكم مهام بلا حد.
+    submit() آمنة من أي ثريد (Flask) أو من داخل اللوب (ASGI).
+    """
+
+    ACCEPTED = "accepted"
+    DUPLICATE = "duplicate"
+    OVERLOADED = "overloaded"
+    LAGGING = "lagging"
+    NOT_RUNNING = "not_running"
+
+    def __init__(self, workers: int, max_queue: int, dedup_size: int, max_loop_lag: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.dedup_size = dedup_size
+        self.max_loop_lag = max_loop_lag
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._queued = 0
+        self._processing = 0
+        self._queue = None
+        self._loop = None
+        self._loop_thread_id = None
+        self._tasks = []
+        self._lanes = {}
+        self._waiting_callbacks = {}  # (chat_id, message_id) -> عدد callbacks المنتظرة في المسارات
+        self.loop_lag = 0.0
+        # Metrics
+        self.accepted = 0
+        self.duplicates = 0
+        self.shed_overloaded = 0
+        self.shed_lagging = 0
+        self.processed = 0
+        self.errors = 0
+        self.lane_deferred = 0
+        self.total_wait_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self):
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._monitor_loop_lag()))
+        logger.info("Update dispatcher started (workers=%s, max_queue=%s)", self.workers, self.max_queue)
+
+    async def stop(self, timeout: float = 10.0):
+        """انتظار انتهاء التحديثات المقبولة ثم إيقاف العمال."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Update dispatcher stopped with %s updates still queued", self._queued)
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, data: dict) -> str:
+        """قبول تحديث خام من الويبهوك أو رفضه (بدون أي عمل ثقيل)."""
+        if not self.running:
+            return self.NOT_RUNNING
+        update_id = data.get("update_id")
+        with self._lock:
+            if update_id is not None:
+                if update_id in self._seen:
+                    self.duplicates += 1
+                    return self.DUPLICATE
+            if self._queued >= self.max_queue:
+                self.shed_overloaded += 1
+                return self.OVERLOADED
+            if self.loop_lag > self.max_loop_lag:
+                self.shed_lagging += 1
+                return self.LAGGING
+            if update_id is not None:
+                self._seen[update_id] = None
+                if len(self._seen) > self.dedup_size:
+                    self._seen.popitem(last=False)
+            self._queued += 1
+            self.accepted += 1
+
+        item = (time.perf_counter(), data)
+        if threading.get_ident() == self._loop_thread_id:
+            self._queue.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        return self.ACCEPTED
+
+    async def _worker(self):
+        while True:
+            received_at, data = await self._queue.get()
+            try:
+                update = Update.de_json(data, application.bot)
+                key = _update_lane_key(update)
+            except Exception as e:
+                with self._lock:
+                    self._queued -= 1
+                self.errors += 1
+                self._queue.task_done()
+                logger.error("Failed to parse update_id=%s: %s", data.get("update_id"), e, exc_info=True)
+                continue
+
+            # لو فيه عامل يشتغل على نفس المستخدم: نضيف للمسار ونرجع فورًا
+            # (العامل ما ينحجز بانتظار قفل مستخدم واحد)
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append((received_at, update))
+                self._track_waiting(update, 1)
+                self.lane_deferred += 1
+                continue
 
-async def check_channel_subscription(user_id: int, bot):
-    """التحقق من اشتراك المستخدم في القناة"""
-    if not CHANNEL_SUBSCRIPTION_REQUIRED:
-        return True
-    
-    try:
-        # Cache key and check
-        now_ts = time.time()
-        cached = _subscription_cache.get(user_id)
-        if cached and now_ts - cached.get('ts', 0) < _SUBSCRIPTION_TTL_SECONDS:
-            return cached.get('ok', True)
+            self._lanes[key] = lane = deque()
+            item = (received_at, update)
+            try:
+                while item is not None:
+                    await self._process(*item)
+                    item = lane.popleft() if lane else None
+                    if item is not None:
+                        self._track_waiting(item[1], -1)
+            finally:
+                del self._lanes[key]
+                for _, pending in lane:
+                    self._track_waiting(pending, -1)
 
-        # إزالة @ من معرف القناة إذا كان موجوداً
-        channel_id = TELEGRAM_CHANNEL_ID.lstrip('@')
-        
-        # التحقق من حالة العضو في القناة
-        member = await bot.get_chat_member(f"@{channel_id}", user_id)
-        
-        # الحالات المقبولة: member, administrator, creator
-        if member.status in ['member', 'administrator', 'creator']:
-            logger.info("User %s is subscribed to channel @%s", user_id, channel_id)
-            _subscription_cache[user_id] = {'ok': True, 'ts': now_ts}
-            return True
+    def _track_waiting(self, update: Update, delta: int):
+        message_key = _callback_message_key(update)
+        if message_key is None:
+            return
+        count = self._waiting_callbacks.get(message_key, 0) + delta
+        if count > 0:
+            self._waiting_callbacks[message_key] = count
         else:
-            logger.warning("User %s is NOT subscribed to channel @%s (status: %s)", user_id, channel_id, member.status)
-            _subscription_cache[user_id] = {'ok': False, 'ts': now_ts}
-            return False
-            
-    except Exception as e:
-        logger.error("Could not check channel subscription for user %s: %s", user_id, e)
-        # في حالة الخطأ، نفترض أن المستخدم مشترك (لعدم إيقاف البوت)
-        return True
+            self._waiting_callbacks.pop(message_key, None)
 
-async def show_subscription_required(update: Update, context: ContextTypes.DEFAULT_TYPE, is_new_user: bool = False):
-    """عرض رسالة طلب الاشتراك في القناة"""
-    
-    if is_new_user:
-        # للمستخدمين الجدد - بعد 10 أسئلة
-        message = (
-            "🎉 **Congratulations! / مبروك!**\n\n"
-            "You've completed your first 10 questions!\n"
-            "لقد أكملت أول 10 أسئلة!\n\n"
-            "🌟 **To continue learning, please subscribe to our channel:**\n"
-            "🌟 **لمتابعة التعلم، يرجى الاشتراك في قناتنا:**\n\n"
-            f"📢 **Channel:** {TELEGRAM_CHANNEL_ID}\n"
-            f"🔗 **Link:** {TELEGRAM_CHANNEL_LINK}\n\n"
-            "After subscribing, you can continue with more questions!\n"
-            "بعد الاشتراك، يمكنك متابعة المزيد من الأسئلة!"
-        )
-    else:
-        # للمستخدمين القدامى - عند إلغاء الاشتراك
-        message = (
-            "⚠️ **Subscription Required / الاشتراك مطلوب**\n\n"
-            "Your access has been paused.\n"
-            "تم إيقاف وصولك مؤقتاً.\n\n"
-            "🌟 **Please subscribe to our channel to continue:**\n"
-            "🌟 **يرجى الاشتراك في قناتنا للمتابعة:**\n\n"
-            f"📢 **Channel:** {TELEGRAM_CHANNEL_ID}\n"
-            f"🔗 **Link:** {TELEGRAM_CHANNEL_LINK}\n\n"
-            "After subscribing, click 'Check Subscription' below.\n"
-            "بعد الاشتراك، اضغط على 'التحقق من الاشتراك' أدناه."
-        )
-    
-    # إنشاء الأزرار
-    keyboard = [
-        [InlineKeyboardButton("📢 Join Channel / انضم للقناة", url=TELEGRAM_CHANNEL_LINK)],
-        [InlineKeyboardButton("✅ Check Subscription / التحقق من الاشتراك", callback_data="check_subscription")],
-        [InlineKeyboardButton("🏠 Main Menu / القائمة الرئيسية", callback_data="menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if hasattr(update, 'callback_query') and update.callback_query:
-        await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
-    else:
-        await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    def newer_callback_waiting(self, chat_id, message_id) -> bool:
+        """callback لنفس الرسالة ينتظر دوره في المسار → سيعيد رسمها بعد التحديث الحالي."""
+        return (chat_id, message_id) in self._waiting_callbacks
 
-async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """التحقق من الاشتراك في القناة"""
-    query = update.callback_query
-    await query.answer()
-    
-    user = query.from_user
-    asyncio.create_task(asyncio.to_thread(update_last_interaction, user.id))
-    
-    # التحقق من الاشتراك
-    is_subscribed = await check_channel_subscription(user.id, context.bot)
-    
-    if is_subscribed:
-        # المستخدم مشترك - يمكنه المتابعة
-        success_message = (
-            "✅ **Subscription Verified! / تم التحقق من الاشتراك!**\n\n"
-            "Welcome back! You can now continue learning.\n"
-            "مرحباً بعودتك! يمكنك الآن متابعة التعلم.\n\n"
-            "Choose what you want to do:\n"
-            "اختر ما تريد القيام به:"
-        )
-        
-        keyboard = [
-            [InlineKeyboardButton("🚀 Start Quiz / بدء الاختبار", callback_data="quiz")],
-            [InlineKeyboardButton("📊 My Stats / إحصائياتي", callback_data="stats")],
-            [InlineKeyboardButton("🏠 Main Menu / القائمة الرئيسية", callback_data="menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(success_message, reply_markup=reply_markup, parse_mode='Markdown')
-    else:
-        # المستخدم غير مشترك
-        await show_subscription_required(update, context, is_new_user=False)
+    async def _process(self, received_at: float, update: Update):
+        with self._lock:
+            self._queued -= 1
+            self._processing += 1
+        started = time.perf_counter()
+        self.total_wait_seconds += started - received_at
+        METRICS.observe("bot_webhook_queue_seconds", started - received_at)
+        profile, watchdog = PROFILER.start_update(update.update_id, concurrent=self._processing - 1)
+        try:
+            await application.process_update(update)
+            elapsed = time.perf_counter() - started
+            METRICS.observe("bot_update_seconds", elapsed)
+            PROFILER.finish_update(update.update_id, elapsed, profile, watchdog)
+            profile = watchdog = None
+            self.processed += 1
+            if self.processed == 1:
+                STARTUP_TIMELINE.mark('first_update')
+            persistence = application.persistence
+            if persistence is not None and persistence.store.shared:
+                # النسخة التالية قد تستقبل تحديث هذا المستخدم - نكتب الجلسة الآن
+                await persistence.sync_now(application)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            logger.error("Failed to process update_id=%s: %s", update.update_id, e, exc_info=True)
+        finally:
+            if profile is not None or watchdog is not None:
+                PROFILER.finish_update(update.update_id, time.perf_counter() - started, profile, watchdog)
+            with self._lock:
+                self._processing -= 1
+            self._queue.task_done()
+
+    async def _monitor_loop_lag(self, interval: float = 0.25):
+        """قياس تأخر اللوب: الفرق بين موعد الاستيقاظ المتوقع والفعلي."""
+        while True:
+            started = self._loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(0.0, self._loop.time() - started - interval)
+
+    def stats(self) -> dict:
+        started = self.processed + self.errors
+        return {
+            'running': self.running,
+            'workers': self.workers,
+            'queue_depth': self._queued,
+            'queue_max': self.max_queue,
+            'processing': self._processing,
+            'active_lanes': len(self._lanes),
+            'lane_deferred': self.lane_deferred,
+            'waiting_callbacks': len(self._waiting_callbacks),
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'shed_overloaded': self.shed_overloaded,
+            'shed_lagging': self.shed_lagging,
+            'processed': self.processed,
+            'errors': self.errors,
+            'loop_lag_ms': round(self.loop_lag * 1000, 1),
+            'avg_queue_wait_ms': round(self.total_wait_seconds / started * 1000, 1) if started else 0.0,
+        }
+
+
+UPDATE_DISPATCHER = UpdateDispatcher(
+    workers=DISPATCH_WORKERS,
+    max_queue=DISPATCH_QUEUE_MAX,
+    dedup_size=DISPATCH_DEDUP_SIZE,
+    max_loop_lag=DISPATCH_MAX_LOOP_LAG,
+)
+OUTBOUND_LIMITER.superseded_by = UPDATE_DISPATCHER.newer_callback_waiting
+
+
+def dispatch_webhook_update(data):
+    """منطق الويبهوك المشترك بين Flask و ASGI: يرجع (status, payload, headers)."""
+    if not app_ready.is_set():
+        logger.warning("Webhook hit but app not ready.")
+        return 503, {'error': 'Bot not ready'}, {'Retry-After': '1'}
+
+    if not data or not isinstance(data, dict):
+        logger.warning("Webhook hit with empty body.")
+        return 400, {'error': 'No update data'}, {}
+
+    # %.1000s: التحويل لنص يتم فقط إذا اجتاز السجل العينة
+    logger.info("WEBHOOK RECEIVED: %.1000s", data, extra={'category': 'webhook_payload'})
+    result = UPDATE_DISPATCHER.submit(data)
+    update_id = data.get("update_id")
+
+    if result == UpdateDispatcher.ACCEPTED:
+        logger.info("WEBHOOK DISPATCHED update_id=%s", update_id, extra=UPDATE_LOG)
+        # رجّع 200 فورًا عشان تيليجرام ما يعيد الإرسال
+        return 200, {'status': 'ok'}, {}
+    if result == UpdateDispatcher.DUPLICATE:
+        logger.info("WEBHOOK DUPLICATE update_id=%s ignored", update_id, extra=UPDATE_LOG)
+        return 200, {'status': 'duplicate'}, {}
+    if result == UpdateDispatcher.OVERLOADED:
+        logger.warning("WEBHOOK SHED update_id=%s (queue full)", update_id)
+        return 429, {'error': 'Too many pending updates'}, {'Retry-After': '1'}
+    if result == UpdateDispatcher.LAGGING:
+        logger.warning("WEBHOOK SHED update_id=%s (loop lag %.3fs)", update_id, UPDATE_DISPATCHER.loop_lag)
+        return 503, {'error': 'Overloaded'}, {'Retry-After': '1'}
+    return 503, {'error': 'Bot not ready'}, {}
 
 # Flask app for Cloud Run
 app = Flask(__name__)
 
+def _health_payload():
+    """Health data shared by the Flask and ASGI /health endpoints."""
+    # Check if bot is initialized
+    bot_status = "initialized" if _initialized and application is not None else "not_initialized"
+
+    # Check environment variables
+    env_status = {
+        'TELEGRAM_TOKEN': 'set' if TELEGRAM_TOKEN else 'missing',
+        'SUPABASE_URL': 'set' if SUPABASE_URL else 'missing',
+        'SUPABASE_KEY': 'set' if SUPABASE_KEY else 'missing'
+    }
+
+    # Check Supabase connection
+    supabase_status = "connected" if supabase is not None else "not_connected"
+
+    return {
+        'status': 'healthy',
+        'bot': 'Vignora Medical Questions Bot',
+        'timestamp': datetime.now().isoformat(),
+        'bot_status': bot_status,
+        'supabase_status': supabase_status,
+        'environment_variables': env_status,
+        'initialized': _initialized,
+        'ready': app_ready.is_set(),
+        'answer_queue': ANSWER_WRITER.stats(),
+        'last_seen': LAST_SEEN.stats(),
+        'question_pool': QUESTION_POOL.stats(),
+        'answered_cache': ANSWERED_IDS.stats(),
+        'user_stats': USER_STATS.stats(),
+        'total_questions_cache': TOTAL_QUESTIONS_CACHE.stats(),
+        'dispatcher': UPDATE_DISPATCHER.stats(),
+        'persistence': application.persistence.stats() if application is not None and application.persistence else None,
+        'shared_cache': SHARED_CACHE.stats(),
+        'render_cache': RENDER_CACHE.stats(),
+        'outbound': OUTBOUND_LIMITER.stats(),
+        'channel_membership': CHANNEL_MEMBERSHIP.stats(),
+        'known_users': KNOWN_USERS.stats(),
+        'single_flight': SINGLE_FLIGHT.stats(),
+        'startup': STARTUP_TIMELINE.stats(),
+        'profiler': PROFILER.stats(),
+        'logging': LOG_SAMPLER.stats(),
+        'version': '3.0'
+    }
+
+def _on_bot_loop(func, timeout: float = 5):
+    """تشغيل func على لوب البوت من ثريد Flask: stats() الخدمات تُعدَّل هناك، وقراءتها من ثريد آخر
+    قد ترمي "dictionary changed size during iteration". في وضع ASGI نحن على اللوب أصلاً."""
+    if SERVER_MODE == "asgi" or loop is None or not loop.is_running():
+        return func()
+
+    async def call():
+        return func()
+
+    return asyncio.run_coroutine_threadsafe(call(), loop).result(timeout=timeout)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for Cloud Run"""
     try:
-        # Check if bot is initialized
-        bot_status = "initialized" if _initialized and application is not None else "not_initialized"
-        
-        # Check environment variables
-        env_status = {
-            'TELEGRAM_TOKEN': 'set' if TELEGRAM_TOKEN else 'missing',
-            'SUPABASE_URL': 'set' if SUPABASE_URL else 'missing',
-            'SUPABASE_KEY': 'set' if SUPABASE_KEY else 'missing'
-        }
-        
-        # Check Supabase connection
-        supabase_status = "connected" if supabase is not None else "not_connected"
-        
-        return jsonify({
-            'status': 'healthy',
-            'bot': 'Vignora Medical Questions Bot',
-            'timestamp': datetime.now().isoformat(),
-            'bot_status': bot_status,
-            'supabase_status': supabase_status,
-            'environment_variables': env_status,
-            'initialized': _initialized,
-            'ready': app_ready.is_set(),
-            'version': '3.0'
-        }), 200
+        return jsonify(_on_bot_loop(_health_payload)), 200
     except Exception as e:
         logger.error("Health check failed: %s", e)
         return jsonify({
@@ -1395,6 +4608,63 @@ def health_check():
             'timestamp': datetime.now().isoformat()
         }), 500
 
+def _metric_name(*parts) -> str:
+    return "_".join("".join(c if c.isalnum() else "_" for c in str(part)) for part in parts)
+
+def _metrics_text() -> str:
+    """/metrics: الـ histograms والعدادات + gauges من stats() كل خدمة (عمق الطوابير، نسب إصابة الكاش)."""
+    gauges = {'bot_ready': int(app_ready.is_set())}
+    for section, stats in _health_payload().items():
+        if not isinstance(stats, dict):
+            continue
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges[_metric_name('bot', section, key)] = value
+    return METRICS.render(gauges)
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics endpoint"""
+    try:
+        return Response(_on_bot_loop(_metrics_text), status=200, content_type=METRICS_CONTENT_TYPE)
+    except Exception as e:
+        logger.error("Metrics collection failed: %s", e, exc_info=True)
+        return Response(f"# metrics collection failed: {e}\n", status=500, content_type=METRICS_CONTENT_TYPE)
+
+def _profile_payload(params=None):
+    """/profile: GET يرجع التجميعات وآخر الالتقاطات، و POST يضبط capture_every/slow_ms/sample_rate."""
+    if params:
+        slow_ms = params.get('slow_ms')
+        PROFILER.configure(
+            capture_every=params.get('capture_every'),
+            slow_seconds=float(slow_ms) / 1000 if slow_ms is not None else None,
+            sample_rate=params.get('sample_rate'),
+        )
+    return {'stats': PROFILER.stats(), 'captures': PROFILER.captures()}
+
+def _profile_access(authorization: str):
+    """None إذا مسموح، وإلا (status, payload): 404 بدون PROFILE_ENDPOINT_TOKEN و 401 لتوكن خاطئ."""
+    if not PROFILE_ENDPOINT_TOKEN:
+        return 404, {'error': 'Not found'}
+    if not hmac.compare_digest((authorization or '').encode(), f"Bearer {PROFILE_ENDPOINT_TOKEN}".encode()):
+        return 401, {'error': 'Unauthorized'}
+    return None
+
+@app.route('/profile', methods=['GET', 'POST'])
+def profile():
+    """Profiler aggregates and slow-update captures (for debugging, token required)"""
+    denied = _profile_access(request.headers.get('Authorization'))
+    if denied is not None:
+        status, payload = denied
+        return jsonify(payload), status
+    try:
+        params = request.get_json(silent=True) if request.method == 'POST' else None
+        return jsonify(_on_bot_loop(lambda: _profile_payload(params))), 200
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/', methods=['GET'])
 def home():
     """Home endpoint"""
@@ -1403,6 +4673,7 @@ def home():
         'status': 'active',
         'endpoints': {
             'health': '/health',
+            'metrics': '/metrics',
             'webhook': '/webhook',
             'init': '/init'
         }
@@ -1514,31 +4785,143 @@ def ping_telegram():
 def webhook():
     """Webhook endpoint for Telegram updates"""
     try:
-        if not app_ready.is_set():
-            logger.warning("Webhook hit but app not ready.")
-            return jsonify({'error': 'Bot not ready'}), 503
+        data = request.get_json(silent=True)
+        status, payload, headers = dispatch_webhook_update(data)
+        return jsonify(payload), status, headers
 
-        data = request.get_json()
-        if not data:
-            logger.warning("Webhook hit with empty body.")
-            return jsonify({'error': 'No update data'}), 400
+    except Exception as e:
+        logger.error("Error in webhook: %s", e, exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
-        logger.info("WEBHOOK RECEIVED: %s", str(data)[:1000])
-        update = Update.de_json(data, application.bot)
+# --- ASGI app (SERVER_MODE=asgi) ---
+# نفس نقاط /webhook و /health و /init لكن على لوب البوت نفسه بدون أي انتقال بين الثريدات.
+# التشغيل: SERVER_MODE=asgi uvicorn telegram_bot:asgi_app --host 0.0.0.0 --port 8080
 
-        # ✅ شغّل المعالجة على اللوب الخلفي بدون انتظار نتيجة (fire-and-forget)
-        try:
-            asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
-            logger.info("WEBHOOK DISPATCHED update_id=%s", data.get("update_id"))
-        except Exception as e:
-            logger.error("Failed to dispatch update to loop: %s", e, exc_info=True)
+try:
+    import orjson
 
-        # رجّع 200 فورًا عشان تيليجرام ما يعيد الإرسال
-        return jsonify({'status': 'ok'}), 200
+    def _json_loads(body: bytes):
+        return orjson.loads(body)
+
+    def _json_dumps(payload) -> bytes:
+        return orjson.dumps(payload, default=str)
+except ImportError:  # orjson اختياري
+    def _json_loads(body: bytes):
+        return json.loads(body)
+
+    def _json_dumps(payload) -> bytes:
+        return json.dumps(payload, default=str).encode()
+
+async def _asgi_send_json(send, status: int, payload, headers: dict = None):
+    await _asgi_send(send, status, _json_dumps(payload), 'application/json', headers)
+
+async def _asgi_send(send, status: int, body: bytes, content_type: str, headers: dict = None):
+    raw_headers = [
+        (b'content-type', content_type.encode()),
+        (b'content-length', str(len(body)).encode()),
+    ]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), str(value).encode()))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': raw_headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _asgi_read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
 
+async def _asgi_webhook(body: bytes):
+    try:
+        data = _json_loads(body) if body else None
+    except ValueError:
+        data = None
+    return dispatch_webhook_update(data)
+
+async def _asgi_init():
+    ok = await ensure_initialized_async()
+    payload = {
+        'status': 'success' if ok else 'failed',
+        'message': 'Bot initialized successfully' if ok else 'Failed to initialize bot',
+        'initialized': _initialized,
+        'ready': app_ready.is_set(),
+        'timestamp': datetime.now().isoformat()
+    }
+    return (200 if ok else 500), payload
+
+async def _asgi_lifespan(receive, send):
+    init_task = None
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if FAST_START:
+                # الخادم يبدأ الاستماع فوراً والتهيئة تكمل على نفس اللوب
+                init_task = asyncio.create_task(ensure_initialized_async())
+            elif not await ensure_initialized_async():
+                logger.critical("🚨 BOT FAILED TO INITIALIZE ON STARTUP! 🚨")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if init_task is not None and not init_task.done():
+                await asyncio.wait([init_task], timeout=30)
+            try:
+                await _shutdown_application()
+            except Exception as e:
+                logger.error("ASGI shutdown failed: %s", e, exc_info=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def _asgi_header(scope, name: bytes):
+    for key, value in scope.get('headers', ()):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+async def asgi_app(scope, receive, send):
+    """Minimal ASGI application serving the bot endpoints on the bot's own event loop."""
+    if scope['type'] == 'lifespan':
+        await _asgi_lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+    headers = None
+    try:
+        if path == '/webhook' and method == 'POST':
+            status, payload, headers = await _asgi_webhook(await _asgi_read_body(receive))
+        elif path == '/health' and method == 'GET':
+            status, payload = 200, _health_payload()
+        elif path == '/profile' and method in ('GET', 'POST'):
+            denied = _profile_access(_asgi_header(scope, b'authorization'))
+            if denied is not None:
+                status, payload = denied
+            else:
+                body = await _asgi_read_body(receive) if method == 'POST' else b''
+                status, payload = 200, _profile_payload(_json_loads(body) if body else None)
+        elif path == '/metrics' and method == 'GET':
+            await _asgi_send(send, 200, _metrics_text().encode(), METRICS_CONTENT_TYPE)
+            return
+        elif path == '/init' and method == 'POST':
+            status, payload = await _asgi_init()
+        elif path == '/' and method == 'GET':
+            status, payload = 200, {
+                'message': 'Vignora Medical Questions Bot is running!',
+                'status': 'active',
+                'endpoints': {'health': '/health', 'metrics': '/metrics', 'webhook': '/webhook', 'init': '/init'}
+            }
+        else:
+            status, payload = 404, {'error': 'Not found'}
     except Exception as e:
-        logger.error("Error in webhook: %s", e, exc_info=True)
-        return jsonify({'error': str(e)}), 500
+        logger.error("Error in ASGI endpoint %s: %s", path, e, exc_info=True)
+        status, payload = 500, {'error': str(e)}
+    await _asgi_send_json(send, status, payload, headers)
 
 # process_update function removed - now handled directly in webhook endpoint
 
@@ -1552,18 +4935,19 @@ application = None
 supabase = None
 _initialized = False
 _init_lock = threading.Lock()
+_async_init_lock = asyncio.Lock()
 
-# أنشئ لوب جديد
-loop = asyncio.new_event_loop()
+# اللوب الذي يعمل عليه البوت:
+# - WSGI (gunicorn/Flask): لوب خلفي في ثريد مستقل
+# - ASGI: لوب الخادم نفسه (يُعيَّن في lifespan)
+loop = None
+_loop_thread = None
 
 # شغّل اللوب في ثريد خلفي، وداخل الثريد عيّن اللوب الحالي ثم run_forever
 def _loop_runner():
     asyncio.set_event_loop(loop)
     loop.run_forever()
 
-_loop_thread = threading.Thread(target=_loop_runner, daemon=True)
-_loop_thread.start()
-
 # (اختياري) تحقّق أنه شغّال
 def _log_loop_running():
     try:
@@ -1571,116 +4955,221 @@ def _log_loop_running():
     except Exception as e:
         print(f"[DBG] loop check failed: {e}")
 
-loop.call_soon_threadsafe(_log_loop_running)
+if SERVER_MODE != "asgi":
+    # أنشئ لوب جديد
+    loop = asyncio.new_event_loop()
+    _loop_thread = threading.Thread(target=_loop_runner, daemon=True)
+    _loop_thread.start()
+    loop.call_soon_threadsafe(_log_loop_running)
 
 # Event to signal when app is ready
 app_ready = threading.Event()
 
-def ensure_initialized():
-    """Ensure the bot is initialized (thread-safe)"""
-    global _initialized, application, supabase
-    
-    if _initialized:
-        return True
-    
-    with _init_lock:
-        if _initialized:  # Double-check after acquiring lock
-            return True
-            
+async def _start_background_services():
+    """تشغيل الخدمات الخلفية على لوب البوت."""
+    await ANSWER_WRITER.start()
+    await LAST_SEEN.start()
+    if QUESTION_POOL_ENABLED:
+        await QUESTION_POOL.start()
+    await KNOWN_USERS.start()
+    await UPDATE_DISPATCHER.start()
+
+async def _stop_background_services():
+    """تفريغ وإيقاف الخدمات الخلفية."""
+    await UPDATE_DISPATCHER.stop()
+    await ANSWER_WRITER.stop()
+    await LAST_SEEN.stop()
+    await QUESTION_POOL.stop()
+    await KNOWN_USERS.stop()
+    if supabase is not None:
+        await supabase.aclose()
+
+def _flush_on_exit():
+    """تفريغ الطوابير وحفظ الجلسات عند إيقاف العملية (SIGTERM من Cloud Run).
+
+    نفس مسار ASGI: الخدمات الخلفية ثم application.stop/shutdown (update_persistence + flush المخزن).
+    """
+    if loop is None or not loop.is_running() or SERVER_MODE == "asgi":
+        return  # في وضع ASGI يتم التفريغ في lifespan shutdown
+    try:
+        asyncio.run_coroutine_threadsafe(_shutdown_application(), loop).result(timeout=25)
+    except Exception as e:
+        logger.error("Failed to shut down the bot on exit: %s", e)
+
+atexit.register(_flush_on_exit)
+
+def _build_application():
+    """Validate the environment, create the Supabase client and build the PTB application."""
+    global application, supabase
+
+    # 1. Validate environment variables
+    logger.info("Validating environment variables...")
+    validate_environment()
+    logger.info("✅ Environment variables validated successfully.")
+
+    # 2. Initialize Supabase client
+    logger.info("Initializing Supabase client...")
+    supabase = AsyncSupabaseClient(SUPABASE_URL, SUPABASE_KEY)
+    logger.info("✅ Supabase client created successfully.")
+
+    # 3. Build the Telegram bot application
+    logger.info("Building Telegram bot application...")
+
+    # مهلات واضحة
+    req = HTTPXRequest(
+        connect_timeout=5,
+        read_timeout=20,
+        write_timeout=20,
+        pool_timeout=10,
+        connection_pool_size=50
+    )
+
+    builder = Application.builder() \
+        .token(TELEGRAM_TOKEN) \
+        .request(req) \
+        .rate_limiter(OUTBOUND_LIMITER)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    state_store = _build_state_store()
+    SHARED_CACHE.bind(state_store)
+    persistence = _build_persistence(state_store)
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
+
+    # Add all handlers (observe_handler: زمن كل handler في /metrics)
+    application.add_handler(CommandHandler("start", observe_handler(start)))
+    application.add_handler(MessageHandler(filters.CONTACT, observe_handler(handle_contact)))
+    application.add_handler(CallbackQueryHandler(observe_handler(send_question), pattern="^quiz$"))
+    application.add_handler(CallbackQueryHandler(observe_handler(handle_answer), pattern=f"^(answer_|{CB_ANSWER}:)"))
+    application.add_handler(CallbackQueryHandler(observe_handler(show_stats), pattern="^stats$"))
+    application.add_handler(CallbackQueryHandler(observe_handler(show_quiz_menu), pattern="^menu$"))
+    application.add_handler(CallbackQueryHandler(observe_handler(end_session), pattern="^end_session$"))
+    application.add_handler(CallbackQueryHandler(observe_handler(handle_report), pattern=f"^(report$|{CB_REPORT}:)"))
+    application.add_handler(CallbackQueryHandler(observe_handler(handle_report_reason), pattern=f"^report_incorrect_|^report_typo_|^report_unclear_|^report_topic_|^{CB_REPORT_REASON}:"))
+    application.add_handler(CallbackQueryHandler(observe_handler(back_to_answer), pattern=f"^(back_to_answer$|{CB_BACK}:)"))
+    application.add_handler(CallbackQueryHandler(observe_handler(check_subscription), pattern="^check_subscription$"))
+    application.add_handler(ChatMemberHandler(observe_handler(handle_channel_member_update), ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(CallbackQueryHandler(observe_handler(show_about), pattern="^about$"))
+
+    # Add admin handlers (optional)
+    try:
+        application.add_handler(CommandHandler("test_count", test_count))
+        application.add_handler(CommandHandler("db_info", db_info))
+        application.add_handler(CommandHandler("test_bot_permissions", test_bot_permissions))
+    except Exception as e:
+        logger.warning("Could not add admin handlers: %s", e)
+
+    # (diagnostic handlers removed)
+
+    # Add error handler for logging
+    async def _log_ptb_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         try:
+            logger.exception("Handler exception", exc_info=context.error)
+        except Exception:
+            logger.error("Handler exception (no context.error?)")
+
+    application.add_error_handler(_log_ptb_error)
+
+
+async def _start_application():
+    """Initialize and start PTB and the background services on the current loop."""
+    logger.info("Initializing and starting the application...")
+
+    # Supabase (فتح الاتصال) و PTB (getMe + تحميل الجلسات) بالتوازي
+    async def _warm_supabase():
+        await supabase.warmup()
+        STARTUP_TIMELINE.mark('supabase')
+
+    async def _initialize_ptb():
+        await application.initialize()
+        STARTUP_TIMELINE.mark('ptb_init')
+
+    await asyncio.gather(_warm_supabase(), _initialize_ptb())
+    logger.info("✅ Application initialized successfully.")
+
+    await application.start()
+    STARTUP_TIMELINE.mark('ptb_start')
+    logger.info("✅ Application started successfully.")
+
+    await _start_background_services()
+    STARTUP_TIMELINE.mark('services')
+    logger.info("✅ Background services started.")
+
+async def _initialize_async():
+    """Build and start the bot on the running loop; shared by the WSGI and ASGI paths."""
+    global _initialized
+    try:
+        _build_application()
+        await _start_application()
+    except Exception as e:
+        logger.critical("❌ Failed to initialize bot: %s", e, exc_info=True)
+        return False
+
+    _initialized = True
+    app_ready.set()
+    STARTUP_TIMELINE.mark('ready')
+    logger.info("✅ Bot fully initialized and running (startup %s).", STARTUP_TIMELINE.phases)
+    return True
+
+async def _shutdown_application():
+    """Flush background services and stop PTB (ASGI lifespan shutdown / WSGI atexit)."""
+    global _initialized
+    await _stop_background_services()
+    if application is not None and _initialized:
+        await application.stop()
+        await application.shutdown()
+    _initialized = False
+    app_ready.clear()
+
+_init_future = None
+
+def start_initialization():
+    """Start initialization on the background loop without waiting for it (WSGI mode)."""
+    global _init_future
+    with _init_lock:
+        # محاولة جديدة فقط إذا فشلت السابقة
+        if _init_future is None or (_init_future.done() and not _initialized):
             logger.info("Starting bot initialization...")
-            
-            # 1. Validate environment variables
-            logger.info("Validating environment variables...")
-            validate_environment()
-            logger.info("✅ Environment variables validated successfully.")
-            
-            # 2. Initialize Supabase client
-            logger.info("Initializing Supabase client...")
-            supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-            logger.info("✅ Supabase client created successfully.")
-            
-            # 3. Build the Telegram bot application
-            logger.info("Building Telegram bot application...")
-            
-            # مهلات واضحة
-            req = HTTPXRequest(
-                connect_timeout=5,
-                read_timeout=20,
-                write_timeout=20,
-                pool_timeout=10,
-                connection_pool_size=50
-            )
-            
-            application = Application.builder() \
-                .token(TELEGRAM_TOKEN) \
-                .request(req) \
-                .build()
-            
-            # Add all handlers
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
-            application.add_handler(CallbackQueryHandler(send_question, pattern="^quiz$"))
-            application.add_handler(CallbackQueryHandler(handle_answer, pattern="^answer_"))
-            application.add_handler(CallbackQueryHandler(show_stats, pattern="^stats$"))
-            application.add_handler(CallbackQueryHandler(show_quiz_menu, pattern="^menu$"))
-            application.add_handler(CallbackQueryHandler(end_session, pattern="^end_session$"))
-            application.add_handler(CallbackQueryHandler(handle_report, pattern="^report$"))
-            application.add_handler(CallbackQueryHandler(handle_report_reason, pattern="^report_incorrect_|^report_typo_|^report_unclear_|^report_topic_"))
-            application.add_handler(CallbackQueryHandler(back_to_answer, pattern="^back_to_answer$"))
-            application.add_handler(CallbackQueryHandler(check_subscription, pattern="^check_subscription$"))
-            application.add_handler(CallbackQueryHandler(show_about, pattern="^about$"))
-            
-            # Add admin handlers (optional)
-            try:
-                application.add_handler(CommandHandler("test_count", test_count))
-                application.add_handler(CommandHandler("db_info", db_info))
-                application.add_handler(CommandHandler("test_bot_permissions", test_bot_permissions))
-            except Exception as e:
-                logger.warning("Could not add admin handlers: %s", e)
-            
-            # (diagnostic handlers removed)
-            
-            # Add error handler for logging
-            async def _log_ptb_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-                try:
-                    logger.exception("Handler exception", exc_info=context.error)
-                except Exception:
-                    logger.error("Handler exception (no context.error?)")
-            
-            application.add_error_handler(_log_ptb_error)
-            
-            # ✅ Initialize and start the application properly
-            logger.info("Initializing and starting the application...")
-            
-            # شغّل initialize + start على اللوب الخلفي
-            f1 = asyncio.run_coroutine_threadsafe(application.initialize(), loop)
-            f1.result(timeout=30)
-            logger.info("✅ Application initialized successfully.")
-            
-            f2 = asyncio.run_coroutine_threadsafe(application.start(), loop)
-            f2.result(timeout=30)
-            logger.info("✅ Application started successfully.")
-            
-            _initialized = True
-            app_ready.set()
-            logger.info("✅ Bot fully initialized and running.")
-            
-            # تحقق من التوكن (غير قاتل) - سيتم فحصه عبر /ping-telegram
-            logger.info("✅ Bot ready. Use /ping-telegram endpoint to test Telegram connectivity.")
-            
+            _init_future = asyncio.run_coroutine_threadsafe(_initialize_async(), loop)
+        return _init_future
+
+def ensure_initialized(timeout: float = 60):
+    """Ensure the bot is initialized (thread-safe, WSGI mode) - waits for the background init."""
+    if _initialized:
+        return True
+    try:
+        return start_initialization().result(timeout=timeout)
+    except Exception as e:
+        logger.critical("❌ Bot initialization did not complete: %s", e, exc_info=True)
+        return False
+
+async def ensure_initialized_async():
+    """Ensure the bot is initialized on the running loop (ASGI mode)"""
+    global loop
+
+    if _initialized:
+        return True
+
+    async with _async_init_lock:
+        if _initialized:
             return True
-            
-        except Exception as e:
-            logger.critical("❌ Failed to initialize bot: %s", e, exc_info=True)
-            return False
+        logger.info("Starting bot initialization (ASGI)...")
+        loop = asyncio.get_running_loop()
+        return await _initialize_async()
+
+STARTUP_TIMELINE.mark('import')
 
-# Eagerly initialize the bot when the module is loaded by Gunicorn.
-# This is the recommended pattern for Cloud Run with --preload.
-if not ensure_initialized():
-    # If initialization fails, the application will not be ready.
-    # Gunicorn will still start, but webhook calls will fail.
-    logger.critical("🚨 BOT FAILED TO INITIALIZE ON STARTUP! 🚨")
+# In WSGI mode initialization starts when the module is loaded by Gunicorn.
+# With FAST_START the worker serves requests immediately (/webhook returns 503 until ready);
+# in ASGI mode initialization happens in the lifespan startup instead.
+if SERVER_MODE != "asgi":
+    if FAST_START:
+        start_initialization()
+    elif not ensure_initialized():
+        # If initialization fails, the application will not be ready.
+        # Gunicorn will still start, but webhook calls will fail.
+        logger.critical("🚨 BOT FAILED TO INITIALIZE ON STARTUP! 🚨")
 
 def main_polling():
     """Main function for local execution (polling mode)."""
@@ -1699,7 +5188,8 @@ def main_polling():
     logger.info("Bot is running and ready to receive messages via polling.")
     
     # Run polling in the global event loop
-    future = asyncio.run_coroutine_threadsafe(application.run_polling(), loop)
+    # chat_member غير مفعّل افتراضياً في getUpdates - نطلب كل الأنواع لفهرس الاشتراك
+    future = asyncio.run_coroutine_threadsafe(application.run_polling(allowed_updates=Update.ALL_TYPES), loop)
     future.result()  # This will run indefinitely
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+"""Import telegram_bot without a WSGI server, background loop or real backends."""
+
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# قبل استيراد البوت (نفس إعداد perf/bench.py)
+os.environ.update({
+    "SERVER_MODE": "asgi",
+    "TELEGRAM_TOKEN": "123456:TEST",
+    "SUPABASE_URL": "http://supabase.test",
+    "SUPABASE_KEY": "test",
+    "STATE_BACKEND": "memory",
+    "LOG_FORMAT": "text",
+})
+sys.path.insert(0, REPO_ROOT)
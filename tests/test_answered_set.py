@@ -0,0 +1,49 @@
+from telegram_bot import AnsweredSet
+
+
+def test_membership_in_sorted_array():
+    answered = AnsweredSet()
+    answered.update([30, 10, 20, 10])
+    assert len(answered) == 3
+    assert 10 in answered and 20 in answered and 30 in answered
+    assert 15 not in answered and 0 not in answered and 31 not in answered
+    assert answered.nbytes == 3 * 4
+
+
+def test_ignores_none_and_negative_ids():
+    answered = AnsweredSet()
+    answered.update([None, -1, 5])
+    assert len(answered) == 1
+    assert -1 not in answered
+
+
+def test_switches_to_bitmap_when_smaller():
+    answered = AnsweredSet()
+    answered.update(range(63))
+    assert answered._bits is None
+    answered.add(63)
+    assert answered._bits is not None
+    assert answered.nbytes == 8  # 64 معرف في 8 بايت بدل 256
+    assert len(answered) == 64
+    assert all(question_id in answered for question_id in range(64))
+    assert 64 not in answered
+
+
+def test_sparse_ids_stay_in_array():
+    answered = AnsweredSet()
+    answered.update(range(0, 64_000, 1000))
+    assert answered._bits is None
+    assert answered.nbytes == 64 * 4
+    assert 63_000 in answered and 63_001 not in answered
+
+
+def test_bitmap_out_of_range_ids():
+    answered = AnsweredSet()
+    answered.update(range(64))
+    assert 10_000 not in answered
+    answered.add(10_000)
+    assert 10_000 in answered
+    assert 9_999 not in answered
+    assert answered.nbytes == (10_000 >> 3) + 1
+    answered.add(10_000)  # مكرر
+    assert len(answered) == 65
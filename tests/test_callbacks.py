@@ -0,0 +1,41 @@
+import pytest
+
+from telegram_bot import CB_ANSWER, CB_BACK, CB_REPORT, CB_REPORT_REASON, encode_callback, parse_callback
+
+
+@pytest.mark.parametrize("data", [
+    "answer_A", "report", "back_to_answer", "report_incorrect_12", "quiz", "", None,
+])
+def test_legacy_and_plain_data_is_not_v1(data):
+    assert parse_callback(data) is None
+
+
+@pytest.mark.parametrize("data", ["a1:", "a1:abc:A", "a1::A", "r1:1.5:B"])
+def test_malformed_question_id(data):
+    assert parse_callback(data) is None
+
+
+def test_v1_answer():
+    assert parse_callback("a1:123:B") == (CB_ANSWER, 123, "B")
+
+
+def test_v1_report_reason_keeps_rest():
+    assert parse_callback("rp1:7:C:i") == (CB_REPORT_REASON, 7, "C:i")
+
+
+def test_v1_without_rest():
+    assert parse_callback("b1:7") == (CB_BACK, 7, "")
+
+
+@pytest.mark.parametrize("kind,parts", [
+    (CB_ANSWER, (42, "A")),
+    (CB_REPORT, (42, "D")),
+    (CB_REPORT_REASON, (42, "A", "t")),
+    (CB_BACK, (42, "C")),
+])
+def test_round_trip(kind, parts):
+    data = encode_callback(kind, *parts)
+    assert len(data.encode()) <= 64
+    parsed_kind, question_id, rest = parse_callback(data)
+    assert (parsed_kind, question_id) == (kind, parts[0])
+    assert rest == ":".join(parts[1:])
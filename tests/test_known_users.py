@@ -0,0 +1,61 @@
+import asyncio
+from array import array
+
+from telegram_bot import KnownUserIndex
+
+
+def make_index(ids=()):
+    index = KnownUserIndex(refresh_interval=60, full_refresh_interval=3600)
+    index._sorted = array('q', ids)
+    return index
+
+
+def test_merge_into_empty():
+    index = make_index()
+    index._merge([30, 10, 20, 10])
+    assert list(index._sorted) == [10, 20, 30]
+
+
+def test_merge_front_middle_back():
+    index = make_index([10, 20, 30])
+    index._merge([40, 5, 25, 15])
+    assert list(index._sorted) == [5, 10, 15, 20, 25, 30, 40]
+
+
+def test_merge_skips_existing_and_duplicate_ids():
+    index = make_index([10, 20, 30])
+    index._merge([30, 10, 25, 25, 20])
+    assert list(index._sorted) == [10, 20, 25, 30]
+
+
+def test_merge_nothing_keeps_array():
+    index = make_index([10, 20])
+    index._merge([])
+    assert list(index._sorted) == [10, 20]
+
+
+def test_add_merges_recent_at_threshold():
+    index = make_index([100])
+    index.MERGE_THRESHOLD = 3
+    for telegram_id in (3, 1, 100, 2):
+        index.add(telegram_id)
+    assert list(index._sorted) == [1, 2, 3, 100]
+    assert not index._recent
+    assert len(index) == 4
+    assert 2 in index and 4 not in index
+
+
+def test_full_load_keeps_ids_merged_while_loading():
+    index = make_index([10])
+    index.MERGE_THRESHOLD = 2
+
+    async def fetch_all():
+        for telegram_id in (100, 101, 102):  # دمج في المصفوفة القديمة أثناء انتظار الصفحات
+            index.add(telegram_id)
+        await asyncio.sleep(0)
+        return array('q', [10, 20]), 2
+
+    index._fetch_all = fetch_all
+    asyncio.run(index._load_all())
+    assert list(index._sorted) == [10, 20, 100, 101, 102]
+    assert not index._recent